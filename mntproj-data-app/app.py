@@ -2,12 +2,21 @@
 
 """Entry point for Mountain Project data analyzer"""
 
+import gzip
+import json
 import logging
 import os
 import sys
-from flask import Flask, render_template, request, redirect, url_for
+from flask import Flask, Response, render_template, request, redirect, url_for, jsonify
 from constants import LOG_DIR , LOG_FILE_FLASK_APP, LOG_FORMAT
-from scrape_mntproj import start_scrape_mntproj
+from constants import SCRAPE_JOB_WORKERS, SCRAPE_JOB_RETENTION_MINS, SCRAPE_JOB_DB, STREAM_HEARTBEAT_SECS
+from constants import SAME_ROUTE_MAX_LIMIT, API_SIMILAR_MAX_LIMIT, API_GZIP_MIN_BYTES
+from constants import CACHE_WARMER_ENABLED, CACHE_WARMER_INTERVAL_MINS, CACHE_WARMER_REQUEST_BUDGET
+from cache_warmer import CacheWarmer
+from metrics import METRICS
+from scrape_jobs import ScrapeJobQueue
+from route_similarity import SIMILARITY_METRICS
+from scrape_mntproj import start_scrape_mntproj, get_cached_results, get_cached_similar_users
 
 # LOG_LEVEL = logging.DEBUG
 LOG_LEVEL = logging.INFO
@@ -24,6 +33,12 @@ logging.basicConfig(filename=LOG_FILE, level=LOG_LEVEL, format=LOG_FORMAT)
 logging.info("Starting Mountain Project Data Analyzer")
 logging.info("Python version: %s", sys.version)
 
+def validate_metric(metric):
+    "Validate similarity metric from user"
+    if metric not in SIMILARITY_METRICS:
+        return f"metric must be one of: {', '.join(SIMILARITY_METRICS)}", 400
+    return metric, 200
+
 def validate_input(mp_uid_name):
     "Validate input from user"
     if len(mp_uid_name) > 100:
@@ -35,26 +50,211 @@ def validate_input(mp_uid_name):
         return "UID/name not valid", 400
     return (mntproj_uid, mntproj_name), 200
 
+def validate_page(offset, limit):
+    "Validate paging offset and limit from user"
+    try:
+        offset = int(offset)
+        limit = int(limit)
+    except ValueError:
+        return "offset and limit must be integers", 400
+    if offset < 0 or limit < 1 or limit > API_SIMILAR_MAX_LIMIT:
+        return f"offset must be 0 or more and limit 1 to {API_SIMILAR_MAX_LIMIT}", 400
+    return (offset, limit), 200
+
+def json_response(data, status=200):
+    "JSON response, gzip compressed if the client accepts it and it is at least API_GZIP_MIN_BYTES"
+    body = json.dumps(data).encode()
+    response = Response(body, status=status, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if len(body) >= API_GZIP_MIN_BYTES and request.accept_encodings['gzip'] > 0:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def sse_event(event, data):
+    "Format a server-sent event with JSON data"
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def job_events(job):
+    "Server-sent events for a job's progress and partial results, ending with its results or error"
+    version = -1
+    sent_partial_results = None
+    while True:
+        new_version = job.wait_for_change(version, STREAM_HEARTBEAT_SECS)
+        if new_version == version:
+            yield ": keep-alive\n\n"
+            continue
+        version = new_version
+        if job.status == "failed":
+            yield sse_event("error", {"error": job.error})
+            return
+        if job.status == "finished":
+            yield sse_event("results", {"results": job.results})
+            return
+        yield sse_event("progress", {"status": job.status,
+                                     "routes_done": job.routes_done,
+                                     "routes_total": job.routes_total})
+        if job.partial_results is not None and job.partial_results is not sent_partial_results:
+            sent_partial_results = job.partial_results
+            yield sse_event("partial", {"routes_done": job.routes_done,
+                                        "routes_total": job.routes_total,
+                                        "results": sent_partial_results})
+
+def event_stream(events):
+    "Response streaming server-sent events, unbuffered by proxies"
+    return Response(events, mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 app = Flask(__name__)
+scrape_job_queue = ScrapeJobQueue(start_scrape_mntproj, SCRAPE_JOB_WORKERS, SCRAPE_JOB_RETENTION_MINS, SCRAPE_JOB_DB)
+cache_warmer = CacheWarmer(CACHE_WARMER_INTERVAL_MINS, CACHE_WARMER_REQUEST_BUDGET, scrape_job_queue.busy)
+
+def start_cache_warmer():
+    "Run the cache warmer in the background in this process, called by the entry point and gunicorn.conf.py"
+    if CACHE_WARMER_ENABLED:
+        cache_warmer.start()
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     "Input form for Mnt Proj scraper"
     if request.method == 'POST':
         mp_uid_name = request.form.get('input_field')
-        return redirect(url_for('results', uid_name=mp_uid_name))
+        metric = request.form.get('metric', 'overlap')
+        return redirect(url_for('results', uid_name=mp_uid_name, metric=metric))
     return render_template('index.html')
 
 @app.route('/results')
 def results():
-    "Mnt Proj scrape results"
+    "Show cached results, or submit a Mnt Proj scrape and show its progress"
+    mp_uid_name = request.args.get('uid_name', '')
+    parsed_mp_uid_name = validate_input(mp_uid_name)
+    if parsed_mp_uid_name[1] == 400:
+        return parsed_mp_uid_name
+    mntproj_uid, mntproj_name = parsed_mp_uid_name[0]
+    parsed_metric = validate_metric(request.args.get('metric', 'overlap'))
+    if parsed_metric[1] == 400:
+        return parsed_metric
+    cached_results = get_cached_results(mntproj_uid, parsed_metric[0], scrape_job_queue.store)
+    if cached_results is not None:
+        return render_template('results.html', results=cached_results)
+    job = scrape_job_queue.submit(mntproj_uid, mntproj_name, parsed_metric[0])
+    return redirect(url_for('job_page', job_id=job.job_id))
+
+@app.route('/results/stream')
+def results_stream():
+    "Stream a Mnt Proj scrape's progress, partial results and results as server-sent events"
     mp_uid_name = request.args.get('uid_name', '')
     parsed_mp_uid_name = validate_input(mp_uid_name)
     if parsed_mp_uid_name[1] == 400:
         return parsed_mp_uid_name
     mntproj_uid, mntproj_name = parsed_mp_uid_name[0]
-    scrape_results = start_scrape_mntproj(mntproj_uid, mntproj_name)
-    return render_template('results.html', results=scrape_results)
+    parsed_metric = validate_metric(request.args.get('metric', 'overlap'))
+    if parsed_metric[1] == 400:
+        return parsed_metric
+    cached_results = get_cached_results(mntproj_uid, parsed_metric[0], scrape_job_queue.store)
+    if cached_results is not None:
+        return event_stream([sse_event("results", {"results": cached_results})])
+    job = scrape_job_queue.submit(mntproj_uid, mntproj_name, parsed_metric[0])
+    return event_stream(job_events(job))
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    "Submit a Mnt Proj scrape, returns the job ID"
+    mp_uid_name = request.form.get('uid_name', request.args.get('uid_name', ''))
+    parsed_mp_uid_name = validate_input(mp_uid_name)
+    if parsed_mp_uid_name[1] == 400:
+        return parsed_mp_uid_name
+    mntproj_uid, mntproj_name = parsed_mp_uid_name[0]
+    parsed_metric = validate_metric(request.form.get('metric', request.args.get('metric', 'overlap')))
+    if parsed_metric[1] == 400:
+        return parsed_metric
+    job = scrape_job_queue.submit(mntproj_uid, mntproj_name, parsed_metric[0])
+    return jsonify(job.to_dict()), 202
+
+@app.route('/jobs/<job_id>')
+def job_page(job_id):
+    "Mnt Proj scrape progress page"
+    job = scrape_job_queue.get(job_id)
+    if job is None:
+        return "Job not found", 404
+    return render_template('job.html', job=job)
+
+@app.route('/jobs/<job_id>/status')
+def job_status(job_id):
+    "Mnt Proj scrape status and progress"
+    job = scrape_job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/events')
+def job_event_stream(job_id):
+    "Mnt Proj scrape progress, partial results and results as server-sent events"
+    job = scrape_job_queue.get(job_id)
+    if job is None:
+        return "Job not found", 404
+    return event_stream(job_events(job))
+
+@app.route('/jobs/<job_id>/results')
+def job_results(job_id):
+    "Mnt Proj scrape results"
+    job = scrape_job_queue.get(job_id)
+    if job is None:
+        return "Job not found", 404
+    if job.status == "failed":
+        return f"Job failed: {job.error}", 500
+    if job.status != "finished":
+        return redirect(url_for('job_page', job_id=job_id))
+    return render_template('results.html', results=job.results)
+
+@app.route('/api/similar/<mp_uid>')
+def api_similar_users(mp_uid):
+    "Users with the most similar tick lists as JSON a page at a time, or 202 with the scrape job while not ready"
+    if mp_uid.isdigit() is False:
+        return json_response({"error": "UID not valid"}, 400)
+    parsed_metric = validate_metric(request.args.get('metric', 'overlap'))
+    if parsed_metric[1] == 400:
+        return json_response({"error": parsed_metric[0]}, 400)
+    metric = parsed_metric[0]
+    parsed_page = validate_page(request.args.get('offset', 0), request.args.get('limit', SAME_ROUTE_MAX_LIMIT))
+    if parsed_page[1] == 400:
+        return json_response({"error": parsed_page[0]}, 400)
+    offset, limit = parsed_page[0]
+
+    similar_users = get_cached_similar_users(mp_uid, metric, scrape_job_queue.store)
+    if similar_users is None:
+        job = scrape_job_queue.latest(mp_uid, metric)
+        if job is None or job.status in ("finished", "failed"):
+            if request.args.get('name') is None:
+                if job is not None and job.status == "failed":
+                    return json_response({"error": f"Job failed: {job.error}"}, 500)
+                return json_response({"error": "Results not ready, name is needed to find them"}, 400)
+            parsed_mp_uid_name = validate_input(f"{mp_uid}/{request.args.get('name')}")
+            if parsed_mp_uid_name[1] == 400:
+                return json_response({"error": parsed_mp_uid_name[0]}, 400)
+            job = scrape_job_queue.submit(mp_uid, parsed_mp_uid_name[0][1], metric)
+        response = json_response(job.to_dict(), 202)
+        response.headers['Location'] = url_for('job_status', job_id=job.job_id)
+        return response
+
+    next_offset = offset + limit if offset + limit < len(similar_users) else None
+    return json_response({"uid": mp_uid,
+                          "metric": metric,
+                          "offset": offset,
+                          "limit": limit,
+                          "total": len(similar_users),
+                          "next_offset": next_offset,
+                          "results": [{"user_id": user_id,
+                                       "name": name,
+                                       "count": same_route_count,
+                                       "percent": round(score * 100, 1)}
+                                      for user_id, name, same_route_count, score in similar_users.page(offset, limit)]})
+
+@app.route('/metrics')
+def metrics():
+    "Scrape phase timers and counters in the Prometheus text format"
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
+    start_cache_warmer()
     app.run(debug=True)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Find other Mountain Project users with the most routes in common,
+for every user in MNTPROJ_USER_IDS_FILE.
+Routes from all tick lists are fetched once, then each user's results
+are written to BATCH_RESULTS_DIR.
+
+Example usage, 1st arg is cached data limit in minutes:
+python batch_mntproj.py
+python batch_mntproj.py 60
+
+Options:
+-n  Try to use cached users' csv files
+-r  Resume an unfinished batch run, skipping routes it already refreshed
+-m  Similarity metric: overlap (default), jaccard, cosine or idf
+"""
+
+import logging
+import os
+import sys
+from datetime import datetime
+
+import requests
+import yaml
+from requests.adapters import HTTPAdapter
+
+import scrape_mntproj
+from constants import MNTPROJ_USER_IDS_FILE, ROUTE_TICKS_CACHE_DB
+from constants import LOG_DIR, LOG_FILE_BATCH_MNTPROJ, LOG_FORMAT
+from constants import CHECKPOINT_DIR, FETCH_WORKERS, BATCH_RESULTS_DIR, USER_INDEX_FILE
+from common_functions import CsvFetchError
+from route_similarity import RouteUserMatrix, SIMILARITY_METRICS
+from scrape_mntproj import ScrapeMntProj, get_user_routes, rank_users
+from user_similarity_index import UserMinHashIndex
+
+LOG_LEVEL = logging.INFO
+LOG_FILE = f"{LOG_DIR}/{LOG_FILE_BATCH_MNTPROJ}"
+
+
+def start_batch_mntproj(mntproj_user_ids):
+    """Get all users' csv files, fetch the union of their routes once, and rank each user"""
+
+    start_time = datetime.now().timestamp()
+
+    logging.info("Creating session")
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=FETCH_WORKERS))
+    session.mount("http://", HTTPAdapter(pool_maxsize=FETCH_WORKERS))
+
+    user_routes = {}
+    for mp_name, mp_uid in mntproj_user_ids.items():
+        try:
+            user_routes[mp_name] = get_user_routes(mp_uid, mp_name, session)
+        except CsvFetchError as err:
+            logging.error("Could not get tick list for %s, skipping user: %s", mp_name, err)
+
+    routes = {}
+    for routes_one_user in user_routes.values():
+        for route_id, route_name in routes_one_user.items():
+            routes.setdefault(route_id, route_name)
+    logging.info("%s routes from %s users, %s in total", len(routes), len(user_routes),
+                 sum(len(routes_one_user) for routes_one_user in user_routes.values()))
+
+    scrape_mnt_proj = ScrapeMntProj(ROUTE_TICKS_CACHE_DB, session,
+                                    checkpoint_file=f"{CHECKPOINT_DIR}/batch_checkpoint.json")
+
+    logging.info("Getting route ticks for all routes from either cached data or API")
+    scrape_mnt_proj.evaluate_routes(list(routes.items()), "batch", resume=scrape_mntproj.RESUME_SCRAPE)
+
+    logging.info("Closing session")
+    session.close()
+
+    logging.info("Saving new route data")
+    scrape_mnt_proj.dump_cached_data()
+
+    # Fold the route users this run added to the index's pending file into the index
+    if os.path.isfile(USER_INDEX_FILE):
+        UserMinHashIndex.load(USER_INDEX_FILE).save(USER_INDEX_FILE)
+
+    logging.info("Building route user matrix")
+    route_user_matrix = RouteUserMatrix.from_cache(scrape_mnt_proj.route_ticks_cached_data, routes)
+
+    os.makedirs(BATCH_RESULTS_DIR, exist_ok=True)
+    for mp_name, routes_one_user in user_routes.items():
+        mp_uid = mntproj_user_ids[mp_name]
+        logging.info("Ranking users for %s", mp_name)
+        results = rank_users(route_user_matrix, routes_one_user, mp_uid, scrape_mntproj.SIMILARITY_METRIC,
+                             scrape_mnt_proj.route_ticks_cached_data)
+        results_file = f"{BATCH_RESULTS_DIR}/{mp_name}_{mp_uid}_results.txt"
+        with open(results_file, 'w', encoding='utf-8') as open_results_file:
+            open_results_file.write('\n'.join(results) + '\n')
+        logging.info("Saved %s", results_file)
+    scrape_mnt_proj.route_ticks_cached_data.close()
+
+    end_time = datetime.now().timestamp()
+    runtime = end_time - start_time
+    logging.info("Batch scraper finished for %s users in %.2f seconds", len(user_routes), runtime)
+
+
+if __name__ == "__main__":
+
+    if '-h' in sys.argv:
+        print(__doc__)
+        sys.exit(2)
+
+    if len(sys.argv) > 1:
+        try:
+            scrape_mntproj.CHECK_MP_LIMIT_MINS = int(sys.argv[1])
+        except ValueError:
+            pass
+
+    if '-n' in sys.argv:
+        scrape_mntproj.GET_USER_CSV = False
+    if '-r' in sys.argv:
+        scrape_mntproj.RESUME_SCRAPE = True
+    if '-m' in sys.argv:
+        scrape_mntproj.SIMILARITY_METRIC = sys.argv[sys.argv.index('-m') + 1] if sys.argv[-1] != '-m' else ''
+        if scrape_mntproj.SIMILARITY_METRIC not in SIMILARITY_METRICS:
+            print("Similarity metric must be one of:", ', '.join(SIMILARITY_METRICS))
+            sys.exit(2)
+
+    if os.path.isdir(LOG_DIR) is False:
+        print(LOG_DIR + " not found, logging to local logs directory")
+        os.makedirs("logs", exist_ok=True)
+        LOG_FILE = f"logs/{LOG_FILE_BATCH_MNTPROJ}"
+
+    logging.basicConfig(filename=LOG_FILE, level=LOG_LEVEL, format=LOG_FORMAT)
+    logging.info("Starting batch Mountain Project scraper")
+    logging.info("Python version: %s", sys.version)
+
+    logging.info("Opening %s",  MNTPROJ_USER_IDS_FILE)
+    try:
+        with open(MNTPROJ_USER_IDS_FILE, encoding='utf-8') as open_mntproj_user_ids:
+            user_ids = yaml.safe_load(open_mntproj_user_ids)
+    except (FileNotFoundError, PermissionError) as err:
+        logging.critical(err)
+        sys.exit(1)
+
+    start_batch_mntproj(user_ids)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""
+Benchmark the scrapers against fake_mntproj.py instead of mountainproject.com.
+Runs start_scrape_mntproj, compare_csv.py and the Flask app's /results endpoint
+with a cold cache, a warm cache, and a warm cache with every route rechecked.
+Reports wall time, requests/sec, peak RSS and cache I/O time for each phase.
+Each phase runs in its own process in a temporary directory, the local cache and csv files are not used.
+The cold compare_csv.py phase only clears the csv files, it checks consistency against the route cache
+left by the scrape phases.
+
+Example:
+python benchmark_mntproj.py
+python benchmark_mntproj.py --routes 5000 --users 5000 --latency-ms 20 --error-rate 0.02
+python benchmark_mntproj.py --bench-users 5,50 --json benchmark.json
+
+Cache I/O time is time spent in RouteTicksCache methods, summed over worker threads.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from functools import wraps
+
+import requests
+import yaml
+
+from constants import MNTPROJ_USER_IDS_FILE, ROUTE_TICKS_CACHE_DB, USER_TICK_CSV_DIR, CHECKPOINT_DIR
+from constants import LOG_FORMAT
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TARGETS = ("scrape", "compare_csv", "flask")
+SCENARIOS = ("cold", "warm", "recheck")
+CACHE_IO_METHODS = ("get", "reload", "route_ids", "iter_route_user_ids", "user_names", "user_route_counts",
+                    "commit", "import_json", "close")
+
+
+class CacheIOTimer:
+    """Wraps RouteTicksCache methods to add up the time spent in them, calls nested in another are not counted twice"""
+
+    def __init__(self) -> None:
+        self.seconds = 0.0
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def wrap(self, method):
+        """Timed version of a cache method"""
+        @wraps(method)
+        def timed_method(*args, **kwargs):
+            depth = getattr(self.local, "depth", 0)
+            self.local.depth = depth + 1
+            start_time = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.local.depth = depth
+                if depth == 0:
+                    elapsed = time.perf_counter() - start_time
+                    with self.lock:
+                        self.seconds += elapsed
+                        self.calls += 1
+        return timed_method
+
+    def install(self, cache_class):
+        """Time cache_class methods from now on"""
+        for method_name in CACHE_IO_METHODS:
+            setattr(cache_class, method_name, self.wrap(getattr(cache_class, method_name)))
+
+
+def run_phase(target, scenario, bench_users, fetch_rate):
+    """Run one target in this process, returns cache I/O stats"""
+
+    # pylint: disable=import-outside-toplevel
+    import runpy
+    import scrape_mntproj
+    from route_cache import RouteTicksCache
+
+    cache_io_timer = CacheIOTimer()
+    cache_io_timer.install(RouteTicksCache)
+
+    # Cached routes are used as is when warm, and all rechecked for new ticks with recheck
+    scrape_mntproj.CHECK_MP_LIMIT_MINS = 0 if scenario == "recheck" else 10 ** 6
+    scrape_mntproj.RATE_LIMITER.rate = fetch_rate
+    scrape_mntproj.RATE_LIMITER.max_rate = fetch_rate
+
+    if target == "scrape":
+        for mp_name, mp_uid in bench_users.items():
+            scrape_mntproj.start_scrape_mntproj(mp_uid, mp_name)
+
+    elif target == "compare_csv":
+        mp_names = list(bench_users)
+        for mp_name1, mp_name2 in zip(mp_names, mp_names[1:] + mp_names[:1]):
+            # The consistency check reads the route cache left by the other targets
+            sys.argv = (["compare_csv.py", mp_name1, mp_name2] + (["-n"] if scenario != "cold" else [])
+                        + (["-c"] if os.path.isfile(ROUTE_TICKS_CACHE_DB) else []))
+            with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+                runpy.run_path(f"{SCRIPT_DIR}/compare_csv.py", run_name="__main__")
+
+    elif target == "flask":
+        import app
+        client = app.app.test_client()
+        for mp_name, mp_uid in bench_users.items():
+            job = client.post('/jobs', data={'uid_name': f"{mp_uid}/{mp_name}"}).get_json()
+            while job["status"] not in ("finished", "failed"):
+                time.sleep(0.05)
+                job = client.get(f"/jobs/{job['job_id']}/status").get_json()
+            if job["status"] == "failed":
+                raise RuntimeError(f"Scrape job failed: {job['error']}")
+            client.get(f"/jobs/{job['job_id']}/results")
+
+    return {"cache_io_secs": cache_io_timer.seconds, "cache_io_calls": cache_io_timer.calls}
+
+
+def free_port():
+    """Unused local TCP port"""
+    with socket.socket() as open_socket:
+        open_socket.bind(("127.0.0.1", 0))
+        return open_socket.getsockname()[1]
+
+
+def start_fake_server(args, port):
+    """Start fake_mntproj.py and wait until it answers"""
+    fake_server = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, f"{SCRIPT_DIR}/fake_mntproj.py", "--port", str(port), "--users", str(args.users),
+         "--routes", str(args.routes), "--mean-ticks", str(args.mean_ticks), "--seed", str(args.seed),
+         "--latency-ms", str(args.latency_ms), "--error-rate", str(args.error_rate), "--retry-after", "0"]
+        + (["--rate-limit", str(args.rate_limit)] if args.rate_limit else []),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/stats", timeout=1)
+            return fake_server
+        except requests.ConnectionError:
+            if fake_server.poll() is not None:
+                break
+            time.sleep(0.2)
+    fake_server.kill()
+    sys.exit("fake_mntproj.py did not start")
+
+
+def run_benchmark(args):
+    """Run every target and scenario, each in its own process, and collect the measurements"""
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    work_dir = tempfile.mkdtemp(prefix="mntproj_benchmark_")
+    bench_users = {f"user-{user_id}": int(user_id) for user_id in args.bench_users.split(',')}
+    with open(f"{work_dir}/{MNTPROJ_USER_IDS_FILE}", 'w', encoding='utf-8') as open_user_ids:
+        yaml.safe_dump(bench_users, open_user_ids)
+
+    print(f"Starting fake_mntproj.py with {args.routes} routes and {args.users} users")
+    fake_server = start_fake_server(args, port)
+    env = dict(os.environ, MNTPROJ_BASE_URL=base_url)
+
+    measurements = []
+    try:
+        for target in args.targets.split(','):
+            for scenario in SCENARIOS:
+                if scenario == "cold":
+                    # compare_csv.py doesn't fill the route cache, its cold run only downloads the csv files again
+                    cached_paths = [USER_TICK_CSV_DIR, CHECKPOINT_DIR]
+                    if target != "compare_csv":
+                        cached_paths += [ROUTE_TICKS_CACHE_DB, f"{ROUTE_TICKS_CACHE_DB}-wal",
+                                         f"{ROUTE_TICKS_CACHE_DB}-shm"]
+                    for cached in cached_paths:
+                        cached_path = f"{work_dir}/{cached}"
+                        if os.path.isdir(cached_path):
+                            shutil.rmtree(cached_path)
+                        elif os.path.exists(cached_path):
+                            os.remove(cached_path)
+                server_stats = requests.get(f"{base_url}/stats", timeout=10).json()
+
+                start_time = time.perf_counter()
+                phase = subprocess.Popen(  # pylint: disable=consider-using-with
+                    [sys.executable, os.path.abspath(__file__), "--run-phase", target, "--scenario", scenario,
+                     "--fetch-rate", str(args.fetch_rate)],
+                    cwd=work_dir, env=env, stdout=subprocess.PIPE, text=True)
+                phase_output = phase.stdout.read()
+                _, status, rusage = os.wait4(phase.pid, 0)
+                wall_time = time.perf_counter() - start_time
+                phase.returncode = os.waitstatus_to_exitcode(status)
+                if phase.returncode != 0:
+                    sys.exit(f"{target} {scenario} phase failed, see logs in {work_dir}/logs")
+
+                phase_stats = json.loads(phase_output.strip().splitlines()[-1])
+                new_server_stats = requests.get(f"{base_url}/stats", timeout=10).json()
+                num_requests = new_server_stats["requests"] - server_stats["requests"]
+                measurements.append({
+                    "target": target,
+                    "scenario": scenario,
+                    "wall_secs": round(wall_time, 3),
+                    "requests": num_requests,
+                    "http_429": new_server_stats["http_429"] - server_stats["http_429"],
+                    "requests_per_sec": round(num_requests / wall_time, 1),
+                    "peak_rss_mb": round(rusage.ru_maxrss / 1024, 1),
+                    "cache_io_secs": round(phase_stats["cache_io_secs"], 3),
+                    "cache_io_calls": phase_stats["cache_io_calls"]})
+                print_measurement(measurements[-1], header=len(measurements) == 1)
+    finally:
+        fake_server.terminate()
+        fake_server.wait()
+        if args.keep:
+            print("Benchmark files kept in", work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return measurements
+
+
+def print_measurement(measurement, header=False):
+    """Print one row of the results table"""
+    row_format = "{:<12} {:<8} {:>9} {:>9} {:>6} {:>9} {:>9} {:>10}"
+    if header:
+        print(row_format.format("target", "scenario", "wall s", "requests", "429s", "req/s", "peak MB",
+                                "cache io s"))
+    print(row_format.format(measurement["target"], measurement["scenario"], measurement["wall_secs"],
+                            measurement["requests"], measurement["http_429"], measurement["requests_per_sec"],
+                            measurement["peak_rss_mb"], measurement["cache_io_secs"]))
+
+
+def main():
+    """Run the benchmark, or one phase of it in a phase process"""
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000, help="users in the fake data set")
+    parser.add_argument('--routes', type=int, default=2000, help="routes in the fake data set")
+    parser.add_argument('--mean-ticks', type=int, default=40, help="mean ticks per route in the fake data set")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, default=0, help="mean latency added by the fake server")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of API requests answered with 429")
+    parser.add_argument('--rate-limit', type=float, default=None, help="fake server requests/sec limit")
+    parser.add_argument('--fetch-rate', type=float, default=200.0, help="scraper's max requests/sec")
+    parser.add_argument('--bench-users', default="10,100", help="comma separated fake user IDs to scrape")
+    parser.add_argument('--targets', default=','.join(TARGETS), help="comma separated targets to run")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--keep', action='store_true', help="keep the temporary cache, csv and log files")
+    parser.add_argument('--run-phase', choices=TARGETS, help=argparse.SUPPRESS)
+    parser.add_argument('--scenario', choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_phase:
+        os.makedirs("logs", exist_ok=True)
+        logging.basicConfig(filename="logs/benchmark_mntproj.log", level=logging.INFO, format=LOG_FORMAT)
+        with open(MNTPROJ_USER_IDS_FILE, encoding='utf-8') as open_mntproj_user_ids:
+            phase_users = yaml.safe_load(open_mntproj_user_ids)
+        print(json.dumps(run_phase(args.run_phase, args.scenario, phase_users, args.fetch_rate)))
+        sys.exit(0)
+
+    results = run_benchmark(args)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as open_json:
+            json.dump(results, open_json, indent=2)
+
+
+if __name__ == "__main__":
+    main()
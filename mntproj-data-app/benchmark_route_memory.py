@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Compare the memory of loaded routes as RouteRecords with one users table, against the nested dicts
+used before, where each route kept its own user ID to name dict.
+Loads every route of a synthetic cache database with each, measuring traced Python memory with
+tracemalloc, and times building the route user matrix from the records.
+Then loads the routes again from a memory mapped snapshot of the database, whose pages are not counted
+since they are shared with other processes through the page cache.
+
+Example:
+python benchmark_route_memory.py
+python benchmark_route_memory.py --users 20000 --routes 50000 --mean-ticks 40
+"""
+
+import argparse
+import gc
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+from fake_mntproj import SyntheticMntProj
+from route_cache import RouteTicksCache, ROUTE_FIELDS
+from route_similarity import RouteUserMatrix
+from route_snapshot import write_snapshot
+
+
+def write_synthetic_cache(cache_db_file, synthetic):
+    """Save the synthetic routes and their users in a cache database"""
+    route_ticks_cache = RouteTicksCache(cache_db_file)
+    for route_id in synthetic.route_ids:
+        ticks = synthetic.route_ticks[route_id]
+        route_ticks_cache.update_route(route_id, route_name=f"route-{route_id}", last_total_mp=len(ticks),
+                                       cache_last_updated="2024-06-01 00:00:00",
+                                       mp_last_checked="2024-06-01 00:00:00", newest_tick_id=ticks[0][0])
+        route_ticks_cache.replace_user_ticks(route_id, {user_id: synthetic.user_name(user_id)
+                                                        for _, user_id in ticks})
+    route_ticks_cache.commit()
+    route_ticks_cache.close()
+
+
+def load_nested_dicts(cache_db_file, route_ids):
+    """Load routes the way RouteTicksCache did before RouteRecords"""
+    conn = sqlite3.connect(cache_db_file)
+    routes = {}
+    for route_id in route_ids:
+        row = conn.execute(f"SELECT {', '.join(ROUTE_FIELDS)} FROM routes WHERE route_id = ?",
+                           (route_id,)).fetchone()
+        route = dict(zip(ROUTE_FIELDS, row))
+        route["user_ticks"] = dict(conn.execute(
+            "SELECT user_id, user_name FROM route_users WHERE route_id = ?", (route_id,)))
+        routes[route_id] = route
+    conn.close()
+    return routes
+
+
+def load_route_records(cache_db_file, route_ids):
+    """Load routes as RouteRecords"""
+    route_ticks_cache = RouteTicksCache(cache_db_file)
+    for route_id in route_ids:
+        route_ticks_cache.get(route_id)
+    return route_ticks_cache
+
+
+def measure_load(load_function, cache_db_file, route_ids):
+    """Load time, and traced memory still held by what was loaded"""
+    gc.collect()
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    loaded = load_function(cache_db_file, route_ids)
+    load_time = time.perf_counter() - start_time
+    gc.collect()
+    loaded_memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return loaded, load_time, loaded_memory
+
+
+def compare_route_memory(cache_db_file, route_ids):
+    """Print the memory and load time of the routes as nested dicts and as RouteRecords"""
+    nested_routes, nested_time, nested_memory = measure_load(load_nested_dicts, cache_db_file, route_ids)
+    num_route_users = sum(len(route["user_ticks"]) for route in nested_routes.values())
+    print(f"{len(nested_routes)} routes, {num_route_users} route users")
+    print(f"nested dicts:  {nested_memory / 1024 / 1024:.1f} MB, loaded in {nested_time:.2f} s")
+    del nested_routes
+
+    records_cache, records_time, records_memory = measure_load(load_route_records, cache_db_file, route_ids)
+    print(f"route records: {records_memory / 1024 / 1024:.1f} MB, loaded in {records_time:.2f} s, "
+          f"{len(records_cache.users)} users in the users table")
+    print(f"{nested_memory / max(records_memory, 1):.1f}x less memory")
+
+    start_time = time.perf_counter()
+    RouteUserMatrix.from_cache(records_cache, route_ids)
+    print(f"Route user matrix from route records in {time.perf_counter() - start_time:.2f} s")
+    records_cache.close()
+
+
+def measure_snapshot_load(cache_db_file, route_ids):
+    """Print the memory and load time of the routes as RouteRecords from a snapshot of the database"""
+    start_time = time.perf_counter()
+    write_snapshot(cache_db_file)
+    print(f"Wrote snapshot in {time.perf_counter() - start_time:.2f} s")
+    snapshot_cache, snapshot_time, snapshot_memory = measure_load(load_route_records, cache_db_file, route_ids)
+    print(f"route records from snapshot: {snapshot_memory / 1024 / 1024:.1f} MB, "
+          f"loaded in {snapshot_time:.2f} s")
+    snapshot_cache.close()
+
+
+def main():
+    """Run the memory benchmark with the sizes given on the command line"""
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--routes', type=int, default=20000)
+    parser.add_argument('--mean-ticks', type=float, default=25)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"Generating {args.routes} routes and {args.users} users")
+    synthetic_data = SyntheticMntProj(args.users, args.routes, args.mean_ticks, args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        synthetic_cache_db = f"{tmp_dir}/route_ticks_cache.db"
+        write_synthetic_cache(synthetic_cache_db, synthetic_data)
+        compare_route_memory(synthetic_cache_db, synthetic_data.route_ids)
+        measure_snapshot_load(synthetic_cache_db, synthetic_data.route_ids)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Compare the streaming tick csv reader with the previous pandas path.
+Times parsing a synthetic tick-export csv file with each, with peak Python memory from tracemalloc,
+and the import time of each, measured in a new interpreter.
+
+Example:
+python benchmark_tick_csv.py
+python benchmark_tick_csv.py --ticks 100000 --repeat 5
+
+pandas is not a dependency of the app, install it to include it in the comparison.
+"""
+
+import argparse
+import csv
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from tick_csv import read_tick_routes
+
+TICK_CSV_HEADER = ["Date", "Route", "Rating", "Notes", "URL", "Pitches", "Location", "Avg Stars", "Your Stars",
+                   "Style", "Lead Style", "Route Type", "Your Rating", "Length", "Rating Code"]
+
+
+def write_tick_csv(csv_file, num_ticks, num_routes, seed):
+    """Write a synthetic tick-export csv file, routes are ticked more than once"""
+    rng = random.Random(seed)
+    with open(csv_file, 'w', encoding='utf-8', newline='') as open_csv_file:
+        csv_writer = csv.writer(open_csv_file)
+        csv_writer.writerow(TICK_CSV_HEADER)
+        for _ in range(num_ticks):
+            route_id = 105700000 + rng.randrange(num_routes)
+            csv_writer.writerow(["2024-06-01", f"Route {route_id}", "5.10a", 'Fun, "sustained"\nSecond line',
+                                 f"https://www.mountainproject.com/route/{route_id}/route-{route_id}",
+                                 1, "Somewhere > Crag", 3.2, -1, "Lead", "Redpoint", "Sport", "", 80, 2200])
+
+
+def read_tick_routes_pandas(csv_file):
+    """The pandas path used before tick_csv.py"""
+    import pandas as pd  # pylint: disable=import-outside-toplevel
+    df = pd.read_csv(csv_file)
+    route_urls = df['URL'].drop_duplicates().reset_index(drop=True)
+    routes = {}
+    for route_url in route_urls:
+        try:
+            _,_,_,_, route_id_from_url, route_name_from_url = route_url.split('/')
+        except ValueError:
+            continue
+        routes.setdefault(route_id_from_url, route_name_from_url)
+    return routes
+
+
+def time_parse(read_function, csv_file, repeat):
+    """Best time of repeat runs, and peak traced memory of one run"""
+    read_function(csv_file)  # warm up imports and the file cache
+    best_time = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        routes = read_function(csv_file)
+        best_time = min(best_time, time.perf_counter() - start_time)
+    tracemalloc.start()
+    read_function(csv_file)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return routes, best_time, peak_memory
+
+
+def time_import(module_name):
+    """Seconds to import a module in a new interpreter, None if it can't be imported"""
+    with tempfile.TemporaryDirectory() as import_dir:  # app.py creates a logs directory
+        import_result = subprocess.run(
+            [sys.executable, "-c",
+             f"import time; start_time = time.perf_counter(); import {module_name}; "
+             "print(time.perf_counter() - start_time)"],
+            cwd=import_dir, env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True, check=False)
+    if import_result.returncode != 0:
+        return None
+    return float(import_result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ticks', type=int, default=20000, help="rows in the synthetic tick list")
+    parser.add_argument('--routes', type=int, default=5000, help="distinct routes in the synthetic tick list")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tick_csv_file = f"{tmp_dir}/ticks.csv"
+        write_tick_csv(tick_csv_file, args.ticks, args.routes, args.seed)
+        print(f"Tick list: {args.ticks} ticks, {os.path.getsize(tick_csv_file) / 1024 / 1024:.1f} MB")
+
+        csv_routes, csv_time, csv_memory = time_parse(read_tick_routes, tick_csv_file, args.repeat)
+        print(f"tick_csv: {len(csv_routes)} routes in {csv_time * 1000:.1f} ms, "
+              f"peak {csv_memory / 1024 / 1024:.1f} MB")
+        try:
+            pandas_routes, pandas_time, pandas_memory = time_parse(read_tick_routes_pandas, tick_csv_file,
+                                                                   args.repeat)
+        except ImportError:
+            print("pandas:   not installed")
+        else:
+            print(f"pandas:   {len(pandas_routes)} routes in {pandas_time * 1000:.1f} ms, "
+                  f"peak {pandas_memory / 1024 / 1024:.1f} MB, same routes: {pandas_routes == csv_routes}")
+
+    for import_module in ("tick_csv", "pandas", "scrape_mntproj", "app"):
+        import_time = time_import(import_module)
+        print(f"import {import_module}:",
+              "not installed" if import_time is None else f"{import_time * 1000:.0f} ms")
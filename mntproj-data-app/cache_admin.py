@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Maintenance for the route cache database.
+
+Example usage:
+python cache_admin.py stats
+python cache_admin.py compact
+python cache_admin.py compact -d
+python cache_admin.py snapshot
+python cache_admin.py audit
+python cache_admin.py audit -r
+
+compact evicts routes not looked up within ROUTE_CACHE_LIM_MIN, then the least recently
+looked up routes until at most ROUTE_CACHE_MAX_ROUTE_USERS route users remain,
+and rebuilds the database file to reclaim the space.
+Evicted routes are fetched again in full the next time they are looked up.
+
+snapshot writes the memory mapped snapshot of route users read by every process on the host,
+compact also rewrites it.
+
+audit checks every tick list csv file in USER_TICK_CSV_DIR against the cached route users, listing routes
+a user ticked but is missing from, and routes a user is cached on but didn't tick.
+Users missing from every cached route they ticked are skipped, their ticks are likely private.
+
+With ROUTE_CACHE_SHARDS set, every command covers all shards, and snapshots are written for the shard files
+on this host.
+
+Options:
+-d  Dry run, report what would be evicted without changing the cache
+-r  Repair, fetch every page of each inconsistent route found by audit and replace its cached users
+"""
+
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from constants import ROUTE_TICKS_CACHE_DB, ROUTE_CACHE_LIM_MIN, ROUTE_CACHE_MAX_ROUTE_USERS
+from constants import ROUTE_LOCK_DIR, ROUTE_LOCK_STRIPES, USER_TICK_CSV_DIR, FETCH_WORKERS
+from constants import LOG_DIR, LOG_FILE_CACHE_ADMIN, LOG_FORMAT
+from route_lock import RouteLock
+from route_shards import open_route_cache, route_cache_exists, write_snapshots
+from scrape_mntproj import ScrapeMntProj, RouteFetchError
+from tick_csv import read_tick_routes
+
+LOG_LEVEL = logging.INFO
+LOG_FILE = f"{LOG_DIR}/{LOG_FILE_CACHE_ADMIN}"
+
+
+def print_size_stats(size_stats):
+    """Print the database size and row counts"""
+    print(f"{size_stats['routes']} routes, {size_stats['route_users']} route users, "
+          f"{size_stats['bytes'] / 1024 / 1024:.1f} MB ({size_stats['free_bytes'] / 1024 / 1024:.1f} MB free)")
+
+
+def compact_cache(route_ticks_cached_data, dry_run=False):
+    """Evict routes by age and size cap, then vacuum the database, returns bytes reclaimed"""
+
+    size_before = route_ticks_cached_data.size_stats()
+    print_size_stats(size_before)
+
+    evicted_routes = route_ticks_cached_data.eviction_candidates(ROUTE_CACHE_LIM_MIN, ROUTE_CACHE_MAX_ROUTE_USERS)
+    evicted_route_users = sum(route_user_count for _, route_user_count in evicted_routes)
+    logging.info("Evicting %s routes with %s route users", len(evicted_routes), evicted_route_users)
+    print(f"{'Would evict' if dry_run else 'Evicting'} {len(evicted_routes)} routes "
+          f"with {evicted_route_users} route users")
+    if dry_run:
+        return 0
+
+    for route_id, _ in evicted_routes:
+        # Under the route lock, a scrape fetching the route meanwhile sees it missing and fetches all pages
+        with RouteLock(ROUTE_LOCK_DIR, route_id, ROUTE_LOCK_STRIPES):
+            route_ticks_cached_data.delete_route(route_id)
+
+    logging.info("Vacuuming %s", ROUTE_TICKS_CACHE_DB)
+    route_ticks_cached_data.vacuum()
+
+    size_after = route_ticks_cached_data.size_stats()
+    print_size_stats(size_after)
+    reclaimed_bytes = size_before["bytes"] - size_after["bytes"]
+    logging.info("Compacted %s, reclaimed %s bytes", ROUTE_TICKS_CACHE_DB, reclaimed_bytes)
+    print(f"Reclaimed {reclaimed_bytes / 1024 / 1024:.1f} MB")
+    print("Wrote snapshot of", write_snapshots(ROUTE_TICKS_CACHE_DB), "routes")
+    return reclaimed_bytes
+
+
+def user_csv_files(user_csv_dir):
+    """User name, user ID and file name of each tick list csv file in user_csv_dir, the newest file per user ID"""
+    csv_files = {}
+    for csv_filename in sorted(os.listdir(user_csv_dir)) if os.path.isdir(user_csv_dir) else []:
+        if csv_filename.endswith('_ticks.csv') is False:
+            continue
+        mp_name, _, mp_uid = csv_filename[:-len('_ticks.csv')].rpartition('_')
+        if mp_name == '' or mp_uid.isdigit() is False:
+            continue
+        csv_file = f"{user_csv_dir}/{csv_filename}"
+        user_csv_file = csv_files.get(int(mp_uid))
+        if user_csv_file is None or os.path.getmtime(csv_file) > os.path.getmtime(user_csv_file[2]):
+            csv_files[int(mp_uid)] = (mp_name, int(mp_uid), csv_file)
+    return list(csv_files.values())
+
+
+def audit_cache(route_ticks_cached_data, csv_files):
+    """
+    Compare users' tick lists with the cached route users in one pass.
+    Each route and user pair is encoded as one integer, route ID times the number of users plus the user's row,
+    for the tick lists and for the cache, and the two are compared with array set operations.
+    Only routes in the cache are compared. Returns route ID to a list of user name and problem.
+    """
+
+    user_ids = np.array([mp_uid for _, mp_uid, _ in csv_files], dtype=np.int64)
+    num_users = max(len(csv_files), 1)
+    tick_list_pairs = []
+    for user_row, (_, _, csv_file) in enumerate(csv_files):
+        tick_list_pairs.extend((int(route_id), user_row) for route_id in read_tick_routes(csv_file)
+                               if route_id.isdigit())
+    tick_list_pairs = np.array(tick_list_pairs, dtype=np.int64).reshape(-1, 2)
+    cached_route_ids = np.array([int(route_id) for route_id in route_ticks_cached_data.route_ids()
+                                 if route_id.isdigit()], dtype=np.int64)
+    tick_list_pairs = tick_list_pairs[np.isin(tick_list_pairs[:, 0], cached_route_ids)]
+
+    cached_pairs = route_ticks_cached_data.user_route_pairs(user_ids.tolist())
+    user_order = np.argsort(user_ids, kind='stable')
+    cached_user_rows = user_order[np.searchsorted(user_ids[user_order], cached_pairs[:, 1])]
+
+    tick_list_keys = tick_list_pairs[:, 0] * num_users + tick_list_pairs[:, 1]
+    cached_keys = cached_pairs[:, 0] * num_users + cached_user_rows
+    missing_keys = tick_list_keys[~np.isin(tick_list_keys, cached_keys)]
+    extra_keys = np.setdiff1d(cached_keys, tick_list_keys)
+
+    # Users missing from every cached route they ticked don't share their ticks publicly
+    private_users = np.flatnonzero((np.bincount(tick_list_pairs[:, 1], minlength=num_users) > 0) &
+                                   (np.bincount(cached_user_rows, minlength=num_users) == 0))
+    for user_row in private_users:
+        logging.info("%s is missing from every cached route in their tick list, skipping", csv_files[user_row][0])
+    missing_keys = missing_keys[~np.isin(missing_keys % num_users, private_users)]
+
+    inconsistencies = {}
+    for keys, problem in ((missing_keys, "missing from route tick list"), (extra_keys, "not in tick list")):
+        for route_id, user_row in zip((keys // num_users).tolist(), (keys % num_users).tolist()):
+            inconsistencies.setdefault(str(route_id), []).append((csv_files[user_row][0], problem))
+    return inconsistencies
+
+
+def repair_routes(route_ids):
+    """Fetch every page of route_ids and replace their cached users, returns the route IDs that failed"""
+
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=FETCH_WORKERS))
+    session.mount("http://", HTTPAdapter(pool_maxsize=FETCH_WORKERS))
+    scrape_mnt_proj = ScrapeMntProj(ROUTE_TICKS_CACHE_DB, session)
+    route_names = {route_id: scrape_mnt_proj.route_ticks_cached_data[route_id].route_name for route_id in route_ids}
+    failed_route_ids = []
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        futures = {executor.submit(scrape_mnt_proj.refresh_route, route_id, route_names[route_id]): route_id
+                   for route_id in route_ids}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except RouteFetchError as err:
+                logging.error("Failed to repair route/%s: %s", futures[future], err)
+                failed_route_ids.append(futures[future])
+    session.close()
+    scrape_mnt_proj.route_ticks_cached_data.close()
+    return failed_route_ids
+
+
+def print_inconsistencies(route_ticks_cached_data, inconsistencies):
+    """Print each inconsistent route with its users and problems"""
+    for route_id, route_problems in sorted(inconsistencies.items()):
+        route_name = route_ticks_cached_data[route_id].route_name
+        for user_name, problem in route_problems:
+            print(route_id, route_name, "-", user_name, problem)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ("stats", "compact", "snapshot", "audit"):
+        print(__doc__)
+        sys.exit(2)
+
+    if route_cache_exists(ROUTE_TICKS_CACHE_DB) is False:
+        print(ROUTE_TICKS_CACHE_DB, "not found")
+        sys.exit(1)
+
+    if os.path.isdir(LOG_DIR) is False:
+        print(LOG_DIR + " not found, logging to local logs directory")
+        os.makedirs("logs", exist_ok=True)
+        LOG_FILE = f"logs/{LOG_FILE_CACHE_ADMIN}"
+
+    logging.basicConfig(filename=LOG_FILE, level=LOG_LEVEL, format=LOG_FORMAT)
+    logging.info("Starting cache admin %s", sys.argv[1])
+
+    route_ticks_cache = open_route_cache(ROUTE_TICKS_CACHE_DB)
+    if sys.argv[1] == "stats":
+        print_size_stats(route_ticks_cache.size_stats())
+    elif sys.argv[1] == "snapshot":
+        print("Wrote snapshot of", write_snapshots(ROUTE_TICKS_CACHE_DB), "routes")
+    elif sys.argv[1] == "audit":
+        audit_csv_files = user_csv_files(USER_TICK_CSV_DIR)
+        cache_inconsistencies = audit_cache(route_ticks_cache, audit_csv_files)
+        print_inconsistencies(route_ticks_cache, cache_inconsistencies)
+        print(f"{len(cache_inconsistencies)} inconsistent routes for {len(audit_csv_files)} users")
+        logging.info("Audit found %s inconsistent routes for %s users", len(cache_inconsistencies),
+                     len(audit_csv_files))
+        if '-r' in sys.argv and len(cache_inconsistencies) > 0:
+            print("Repairing", len(cache_inconsistencies), "routes")
+            failed_routes = repair_routes(sorted(cache_inconsistencies))
+            route_ticks_cache.close()
+            route_ticks_cache = open_route_cache(ROUTE_TICKS_CACHE_DB)
+            remaining_inconsistencies = audit_cache(route_ticks_cache, audit_csv_files)
+            print(f"{len(failed_routes)} routes failed, {len(remaining_inconsistencies)} inconsistent routes remain")
+            print_inconsistencies(route_ticks_cache, remaining_inconsistencies)
+    else:
+        compact_cache(route_ticks_cache, dry_run='-d' in sys.argv)
+    route_ticks_cache.close()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+Refresh popular cached routes before users request them.
+Routes not checked on Mountain Project within CHECK_MP_LIMIT_MINS are ranked by lookup count
+times time since last checked, and the top routes are refreshed with at most
+CACHE_WARMER_REQUEST_BUDGET route page requests per pass.
+Only one warmer runs on a host at a time. The Flask app runs one in the background.
+The warmer also rewrites the route cache snapshot when it is older than ROUTE_SNAPSHOT_INTERVAL_MINS,
+and folds the user similarity index's pending file into the index once it passes USER_INDEX_PENDING_FOLD_MB.
+
+Example usage:
+python cache_warmer.py     # one pass
+python cache_warmer.py -l  # a pass every CACHE_WARMER_INTERVAL_MINS
+"""
+
+import fcntl
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import timedelta
+
+import requests
+
+import scrape_mntproj
+from constants import ROUTE_TICKS_CACHE_DB, ROUTE_LOCK_DIR, ROUTE_SNAPSHOT_INTERVAL_MINS, TIMESTAMP_STR_FORMAT
+from constants import CACHE_WARMER_INTERVAL_MINS, CACHE_WARMER_REQUEST_BUDGET, ROUTE_LOOKUP_WINDOW_MINS
+from constants import USER_INDEX_FILE, USER_INDEX_PENDING_FOLD_MB
+from constants import LOG_DIR, LOG_FILE_CACHE_WARMER, LOG_FORMAT
+from metrics import METRICS
+from route_shards import local_cache_files, route_cache_exists
+from route_snapshot import snapshot_file_for, write_snapshot
+from scrape_mntproj import ScrapeMntProj, RouteFetchError, RequestBudgetError
+from user_similarity_index import fold_pending
+
+LOG_LEVEL = logging.INFO
+LOG_FILE = f"{LOG_DIR}/{LOG_FILE_CACHE_WARMER}"
+
+WARMER_LOCK_FILE = f"{ROUTE_LOCK_DIR}/cache_warmer.lock"
+
+
+class CacheWarmer:
+    """
+    Periodically refreshes the most popular stale routes.
+    is_busy is called before and during each pass, the pass stops while it returns True
+    so interactive scrapes get the rate limit to themselves.
+    """
+
+    def __init__(self, interval_mins, request_budget, is_busy=None) -> None:
+        self.interval_secs = interval_mins * 60
+        self.request_budget = request_budget
+        self.is_busy = is_busy if is_busy is not None else lambda: False
+        self.open_lock_file = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def acquire_host_lock(self):
+        """Become the host's warmer if no other process is, the lock is held until the process exits"""
+        if self.open_lock_file is not None:
+            return True
+        os.makedirs(ROUTE_LOCK_DIR, exist_ok=True)
+        open_lock_file = open(WARMER_LOCK_FILE, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+        try:
+            fcntl.flock(open_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            open_lock_file.close()
+            return False
+        self.open_lock_file = open_lock_file
+        logging.info("Cache warmer running in process %s", os.getpid())
+        return True
+
+    def warm(self):
+        """Refresh the top stale routes within the request budget, returns the number of routes refreshed"""
+
+        if route_cache_exists(ROUTE_TICKS_CACHE_DB) is False or self.is_busy():
+            return 0
+
+        session = requests.Session()
+        scrape_mnt_proj = ScrapeMntProj(ROUTE_TICKS_CACHE_DB, session, request_budget=self.request_budget)
+        # Refreshes by the warmer are not lookups, or warmed routes would rank higher every pass
+        scrape_mnt_proj.route_ticks_cached_data.record_lookups = False
+        try:
+            checked_before = scrape_mnt_proj.date_time_now - timedelta(minutes=scrape_mntproj.CHECK_MP_LIMIT_MINS)
+            accessed_after = scrape_mnt_proj.date_time_now - timedelta(minutes=ROUTE_LOOKUP_WINDOW_MINS)
+            routes = scrape_mnt_proj.route_ticks_cached_data.routes_to_warm(
+                scrape_mnt_proj.date_time_now.strftime(TIMESTAMP_STR_FORMAT),
+                checked_before.strftime(TIMESTAMP_STR_FORMAT), accessed_after.strftime(TIMESTAMP_STR_FORMAT),
+                self.request_budget)
+            logging.info("Cache warmer found %s stale routes", len(routes))
+
+            routes_refreshed = 0
+            for route_id, route_name, _ in routes:
+                if scrape_mnt_proj.page_requests >= self.request_budget or self.stop_event.is_set():
+                    break
+                if self.is_busy():
+                    logging.info("Scrape jobs running, pausing cache warmer")
+                    break
+                try:
+                    scrape_mnt_proj.evaluate_cached_data(route_id, route_name)
+                except RequestBudgetError:
+                    logging.info("Cache warmer request budget used up during route/%s", route_id)
+                    break
+                except RouteFetchError as err:
+                    logging.error("Cache warmer failed to get route/%s: %s", route_id, err)
+                    continue
+                routes_refreshed += 1
+
+            scrape_mnt_proj.dump_cached_data()
+        finally:
+            session.close()
+            scrape_mnt_proj.route_ticks_cached_data.close()
+
+        METRICS.inc("cache_warmer_routes_total", routes_refreshed)
+        METRICS.inc("cache_warmer_requests_total", scrape_mnt_proj.page_requests)
+        logging.info("Cache warmer refreshed %s routes with %s requests", routes_refreshed,
+                     scrape_mnt_proj.page_requests)
+        return routes_refreshed
+
+    def refresh_snapshot(self):
+        """Rewrite the snapshot of each route cache file on this host if older than ROUTE_SNAPSHOT_INTERVAL_MINS"""
+        for cache_db_file in local_cache_files(ROUTE_TICKS_CACHE_DB):
+            snapshot_file = snapshot_file_for(cache_db_file)
+            if os.path.isfile(cache_db_file) is False or self.is_busy():
+                continue
+            if os.path.isfile(snapshot_file) and\
+            time.time() - os.path.getmtime(snapshot_file) < ROUTE_SNAPSHOT_INTERVAL_MINS * 60:
+                continue
+            write_snapshot(cache_db_file, snapshot_file)
+
+    def fold_user_index(self):
+        """Fold the user similarity index's pending file into the index once past USER_INDEX_PENDING_FOLD_MB"""
+        if self.is_busy() is False and fold_pending(USER_INDEX_FILE, USER_INDEX_PENDING_FOLD_MB):
+            logging.info("Cache warmer folded pending route users into %s", USER_INDEX_FILE)
+
+    def run(self):
+        """Warm every interval until stopped, while this process holds the host lock"""
+        while self.stop_event.wait(self.interval_secs) is False:
+            if self.acquire_host_lock() is False:
+                continue
+            try:
+                self.warm()
+                self.refresh_snapshot()
+                self.fold_user_index()
+            except (sqlite3.Error, OSError) as err:
+                logging.error("Cache warmer pass failed: %s", err)
+
+    def start(self):
+        """Run in a background thread, if not already running"""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.run, name="cache-warmer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop after the current route"""
+        self.stop_event.set()
+
+
+if __name__ == "__main__":
+
+    if '-h' in sys.argv:
+        print(__doc__)
+        sys.exit(2)
+
+    if os.path.isdir(LOG_DIR) is False:
+        print(LOG_DIR + " not found, logging to local logs directory")
+        os.makedirs("logs", exist_ok=True)
+        LOG_FILE = f"logs/{LOG_FILE_CACHE_WARMER}"
+
+    logging.basicConfig(filename=LOG_FILE, level=LOG_LEVEL, format=LOG_FORMAT)
+    logging.info("Starting cache warmer")
+
+    cache_warmer = CacheWarmer(CACHE_WARMER_INTERVAL_MINS, CACHE_WARMER_REQUEST_BUDGET)
+    if cache_warmer.acquire_host_lock() is False:
+        print("Another cache warmer is running on this host")
+        sys.exit(1)
+    if '-l' in sys.argv:
+        cache_warmer.warm()
+        cache_warmer.refresh_snapshot()
+        cache_warmer.fold_user_index()
+        cache_warmer.run()
+    else:
+        print("Refreshed", cache_warmer.warm(), "routes")
+        cache_warmer.refresh_snapshot()
+        cache_warmer.fold_user_index()
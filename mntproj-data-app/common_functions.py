@@ -1,30 +1,86 @@
 """Common functions for mntproj-compare"""
 
+import json
 import logging
 import os
-import sys
-from constants import USER_TICK_CSV_DIR, USER_PROFILE_BASE_URL
+import threading
+import time
+from json import JSONDecodeError
+
+import requests
+
+from constants import USER_TICK_CSV_DIR, USER_PROFILE_BASE_URL, USER_CSV_TTL_MINS
+from metrics import METRICS
+
+
+class CsvFetchError(Exception):
+    """A user's csv tick list could not be fetched from Mountain Project"""
+
+
+def load_csv_metadata(csv_metadata_file):
+    """Load the ETag, Last-Modified and fetch time saved with a csv file, empty if missing"""
+    try:
+        with open(csv_metadata_file, encoding='utf-8') as open_metadata_file:
+            return json.load(open_metadata_file)
+    except (FileNotFoundError, PermissionError, JSONDecodeError):
+        return {}
+
+
+def write_file_atomic(file_name, content):
+    """Write to a temporary file and rename it, so readers never see a partly written file"""
+    tmp_file_name = f"{file_name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file_name, 'wb') as open_file:
+        open_file.write(content)
+    os.replace(tmp_file_name, file_name)
+
 
 def get_csv_file(mntproj_user_id, mntproj_user_name, session, user_csv_file, refresh_csv_file):
-    """Get Mountain Project csv tick list"""
+    """
+    Get Mountain Project csv tick list.
+    With refresh_csv_file, a csv file fetched within USER_CSV_TTL_MINS is used as is, and an older one
+    is requested again with its ETag and Last-Modified, so an unchanged tick list is not downloaded.
+    Raises CsvFetchError if the request fails.
+    """
 
     os.makedirs(USER_TICK_CSV_DIR, exist_ok=True)
 
     user_profile_url = f"{USER_PROFILE_BASE_URL}/{mntproj_user_id}/{mntproj_user_name}"
     user_tick_csv_export_url = user_profile_url + '/' + 'tick-export'
 
-    if os.path.isfile(user_csv_file) is False or refresh_csv_file is True:
-        logging.info("Getting %s", user_tick_csv_export_url)
-        try:
-            response = session.get(user_tick_csv_export_url, timeout=10)
-        except session.RequestException as err:
-            logging.critical(err)
-            sys.exit(1)
-        if response.status_code == 200:
-            with open(user_csv_file, 'wb') as open_file:
-                open_file.write(response.content)
-        else:
-            logging.critical("HTTP status code: %s", response.status_code)
-            sys.exit(1)
-    else:
+    csv_metadata_file = user_csv_file + '.meta.json'
+    csv_metadata = load_csv_metadata(csv_metadata_file) if os.path.isfile(user_csv_file) else {}
+
+    if os.path.isfile(user_csv_file) and refresh_csv_file is False:
         logging.info("Using cached %s", user_csv_file)
+        METRICS.inc("csv_requests_total", result="cached")
+        return
+    if time.time() - csv_metadata.get("fetched", 0) < USER_CSV_TTL_MINS * 60:
+        logging.info("Using %s fetched within %s minutes", user_csv_file, USER_CSV_TTL_MINS)
+        METRICS.inc("csv_requests_total", result="cached")
+        return
+
+    request_headers = {}
+    if csv_metadata.get("etag") is not None:
+        request_headers["If-None-Match"] = csv_metadata["etag"]
+    if csv_metadata.get("last_modified") is not None:
+        request_headers["If-Modified-Since"] = csv_metadata["last_modified"]
+
+    logging.info("Getting %s", user_tick_csv_export_url)
+    try:
+        response = session.get(user_tick_csv_export_url, headers=request_headers, timeout=10)
+    except requests.RequestException as err:
+        raise CsvFetchError(f"{user_tick_csv_export_url}: {err}") from err
+
+    if response.status_code == 304:
+        logging.info("%s not modified, using cached %s", user_tick_csv_export_url, user_csv_file)
+        METRICS.inc("csv_requests_total", result="not_modified")
+    elif response.status_code == 200:
+        write_file_atomic(user_csv_file, response.content)
+        csv_metadata = {"etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified")}
+        METRICS.inc("csv_requests_total", result="downloaded")
+    else:
+        raise CsvFetchError(f"{user_tick_csv_export_url}: HTTP status code {response.status_code}")
+
+    csv_metadata["fetched"] = time.time()
+    write_file_atomic(csv_metadata_file, json.dumps(csv_metadata).encode())
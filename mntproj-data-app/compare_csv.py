@@ -4,128 +4,132 @@ Compare Mountain Project tick lists
 
 Example:
 python compare_csv.py mp-user1 mp-user2
+python compare_csv.py mp-user1 mp-user2 mp-user3 -o common_routes.csv
+python compare_csv.py -a -p mp-user1,mp-user2
 
 Options:
 -n  Don't get new csv files, use cached files
--p  Print common routes
--c  Check consistency between user's tick list and each route's tick list
- 
+-p  Print common routes, with more than two users the pair to print follows: -p mp-user1,mp-user2
+-c  Check consistency between user's tick list and each route's tick list, for the pair printed with -p
+-a  Compare everyone in MNTPROJ_USER_IDS_FILE
+-o  With more than two users, write the common route matrix to this csv file instead of printing it
+
+With more than two users, the number of routes in common for every pair is printed as a csv table,
+one row and one column per user, with each user's own route count on the diagonal.
+
 MNTPROJ_USER_IDS_FILE yaml file example:
 thomas-anderson: 111111111
 suzy-bishop: 222222222
 """
 
-import json
+import csv
 import logging
 import os
 import sys
 
-import pandas as pd
+import numpy as np
 import requests
 import yaml
 
-from common_functions import get_csv_file
-from constants import MNTPROJ_USER_IDS_FILE, USER_TICK_CSV_DIR, ROUTE_TICKS_CACHE_FILE
+from common_functions import get_csv_file, CsvFetchError
+from route_shards import open_route_cache, route_cache_exists
+from tick_csv import read_tick_routes
+from constants import MNTPROJ_USER_IDS_FILE, USER_TICK_CSV_DIR, ROUTE_TICKS_CACHE_DB
 from constants import LOG_DIR , LOG_FILE_COMPARE_CSV, LOG_FORMAT
 
 LOG_LEVEL = logging.INFO
 LOG_FILE = f"{LOG_DIR}/{LOG_FILE_COMPARE_CSV}"
 
-if __name__ == "__main__":
-
-    if len(sys.argv) < 3:
-        print(__doc__)
-        sys.exit(2)
-
-    mntproj_user_name1 = sys.argv[1]
-    mntproj_user_name2 = sys.argv[2]
-
-    if os.path.isdir(LOG_DIR) is False:
-        print(LOG_DIR + " not found, logging to local logs directory")
-        os.makedirs("logs", exist_ok=True)
-        LOG_FILE = f"logs/{LOG_FILE_COMPARE_CSV}"
-
-    logging.basicConfig(filename=LOG_FILE, level=LOG_LEVEL, format=LOG_FORMAT)
-    logging.info("Starting Compare CSV for %s and %s", mntproj_user_name1, mntproj_user_name2)
-    logging.info("Python version: %s", sys.version)
-
-    REFRESH_CSV_FILE = True
-    PRINT_COMMON = False
-    CHECK_CONSISTENCY = False
-
-    if '-n' in sys.argv:
-        REFRESH_CSV_FILE = False
-    if '-p' in sys.argv:
-        PRINT_COMMON = True
-    if '-c' in sys.argv:
-        CHECK_CONSISTENCY = True
-
-    with open(MNTPROJ_USER_IDS_FILE, encoding='utf-8') as open_mntproj_user_ids:
-        mntproj_user_ids = yaml.safe_load(open_mntproj_user_ids)
-
-    MNTPROJ_USER_ID1 = str(mntproj_user_ids[mntproj_user_name1])
-    MNTPROJ_USER_ID2 = str(mntproj_user_ids[mntproj_user_name2])
-
-    session = requests.Session()
-
-    CSV_FILENAME1 = f"{USER_TICK_CSV_DIR}/{mntproj_user_name1}_{MNTPROJ_USER_ID1}_ticks.csv"
-    get_csv_file(MNTPROJ_USER_ID1, mntproj_user_name1, session, CSV_FILENAME1, REFRESH_CSV_FILE)
-    df1 = pd.read_csv(CSV_FILENAME1)
-
-    CSV_FILENAME2 = f"{USER_TICK_CSV_DIR}/{mntproj_user_name2}_{MNTPROJ_USER_ID2}_ticks.csv"
-    get_csv_file(MNTPROJ_USER_ID2, mntproj_user_name2, session, CSV_FILENAME2, REFRESH_CSV_FILE)
-    df2 = pd.read_csv(CSV_FILENAME2)
-
-    session.close()
-
-    # Another method for removing duplicates routes from the user's tick list:
-    # route_urls = df['URL'].drop_duplicates().reset_index(drop=True)
-
-    df1_unique_url = df1['URL'].unique()
-    df2_unique_url = df2['URL'].unique()
-
-    common_route_urls = list(set(df1_unique_url) & set(df2_unique_url))
-
-    if PRINT_COMMON is True:
-        for common_route_url in common_route_urls:
-            common_route_url_split = common_route_url.split('/')
-            route_id = common_route_url_split[4]
-            route_name = common_route_url_split[5]
-            print(route_id, route_name)
+def load_user_routes(mntproj_user_names, mntproj_user_ids, session, refresh_csv_files):
+    """Get each user's csv file once and read the unique routes in it, user name to routes"""
+    user_routes = {}
+    for mntproj_user_name in mntproj_user_names:
+        mntproj_user_id = str(mntproj_user_ids[mntproj_user_name])
+        csv_filename = f"{USER_TICK_CSV_DIR}/{mntproj_user_name}_{mntproj_user_id}_ticks.csv"
+        get_csv_file(mntproj_user_id, mntproj_user_name, session, csv_filename, refresh_csv_files)
+        user_routes[mntproj_user_name] = read_tick_routes(csv_filename)
+    return user_routes
+
+
+def common_route_matrix(user_routes):
+    """
+    Routes in common for every pair of users, in the order of user_routes.
+    Routes are numbered as they are first seen, and the user by route incidence matrix
+    is multiplied by its transpose, so the diagonal holds each user's route count.
+    """
+    route_index = {}
+    user_rows = []
+    route_cols = []
+    for user_row, routes in enumerate(user_routes.values()):
+        for route_id in routes:
+            route_cols.append(route_index.setdefault(route_id, len(route_index)))
+            user_rows.append(user_row)
+    # float32 counts are exact up to 2**24 routes, and use the BLAS matrix multiply
+    user_route_ticks = np.zeros((len(user_routes), len(route_index)), dtype=np.float32)
+    user_route_ticks[user_rows, route_cols] = 1
+    return (user_route_ticks @ user_route_ticks.T).astype(np.int64)
+
+
+def write_common_route_matrix(mntproj_user_names, common_routes, open_csv_file):
+    """Write the common route matrix as a csv table with user names as the header row and first column"""
+    csv_writer = csv.writer(open_csv_file)
+    csv_writer.writerow(["user"] + list(mntproj_user_names))
+    for mntproj_user_name, common_route_counts in zip(mntproj_user_names, common_routes):
+        csv_writer.writerow([mntproj_user_name] + common_route_counts.tolist())
+
+
+def output_common_route_matrix(mntproj_user_names, user_routes, matrix_csv_file):
+    """Count the routes in common for every pair of users, and write them to matrix_csv_file or print them"""
+    logging.info("Counting common routes for %s users", len(mntproj_user_names))
+    common_routes = common_route_matrix({mntproj_user_name: user_routes[mntproj_user_name]
+                                         for mntproj_user_name in mntproj_user_names})
+    if matrix_csv_file is not None:
+        with open(matrix_csv_file, 'w', encoding='utf-8', newline='') as open_matrix_file:
+            write_common_route_matrix(mntproj_user_names, common_routes, open_matrix_file)
+        print(f"Wrote common routes for {len(mntproj_user_names)} users to {matrix_csv_file}")
+    else:
+        write_common_route_matrix(mntproj_user_names, common_routes, sys.stdout)
+
+
+def compare_pair(mntproj_user_name1, mntproj_user_name2, mntproj_user_ids, user_routes, print_common,
+                 check_consistency):
+    """Print the routes two users have in common, and check them against the route cache"""
+
+    mntproj_user_id1 = str(mntproj_user_ids[mntproj_user_name1])
+    mntproj_user_id2 = str(mntproj_user_ids[mntproj_user_name2])
+    routes1 = user_routes[mntproj_user_name1]
+    routes2 = user_routes[mntproj_user_name2]
+    common_route_ids = [route_id for route_id in routes1 if route_id in routes2]
+
+    if print_common is True:
+        for route_id in common_route_ids:
+            print(route_id, routes1[route_id])
         print()
 
-    print("Common routes:", len(common_route_urls))
+    print("Common routes:", len(common_route_ids))
 
-    if CHECK_CONSISTENCY is True:
-        if PRINT_COMMON is True:
+    if check_consistency is True:
+        if print_common is True:
             print()
         print("Checking for inconsistencies between the second user's tick list and each route's tick list.")
 
-        try:
-            with open(ROUTE_TICKS_CACHE_FILE, encoding='utf-8') as open_cached_route_file:
-                route_ticks_cached_data = json.load(open_cached_route_file)
-        except FileNotFoundError:
-            logging.error("%s not found, cannot complete check", ROUTE_TICKS_CACHE_FILE)
+        if route_cache_exists(ROUTE_TICKS_CACHE_DB) is False:
+            logging.error("%s not found, cannot complete check", ROUTE_TICKS_CACHE_DB)
             logging.info("Compare CSV finished for %s and %s", mntproj_user_name1, mntproj_user_name2)
             sys.exit(1)
-
-        common_route_ids = []
-        for common_route_url in common_route_urls:
-            common_route_url_split = common_route_url.split('/')
-            route_id = common_route_url_split[4]
-            common_route_ids.append(route_id)
+        route_ticks_cached_data = open_route_cache(ROUTE_TICKS_CACHE_DB)
 
         inconsistencies = {}
         for route_id in common_route_ids:
             if route_id in route_ticks_cached_data:
-                route_name = route_ticks_cached_data[route_id]["route_name"]
-                user_name_get1 = route_ticks_cached_data[route_id]["user_ticks"].get(MNTPROJ_USER_ID1)
-                user_name_get2 = route_ticks_cached_data[route_id]["user_ticks"].get(MNTPROJ_USER_ID2)
-                if user_name_get1 is None:
+                route_name = route_ticks_cached_data[route_id].route_name
+                if route_ticks_cached_data[route_id].has_user(mntproj_user_id1) is False:
                     inconsistencies[route_id] = (route_name, mntproj_user_name1)
-                elif user_name_get2 is None:
+                elif route_ticks_cached_data[route_id].has_user(mntproj_user_id2) is False:
                     inconsistencies[route_id] = (route_name, mntproj_user_name2)
 
+        route_ticks_cached_data.close()
+
         if len(inconsistencies) != 0:
             print("Inconsistencies found:")
             for route_id in inconsistencies:
@@ -135,4 +139,71 @@ if __name__ == "__main__":
         else:
             print("No inconsistencies found.")
 
-    logging.info("Compare CSV finished for %s and %s", mntproj_user_name1, mntproj_user_name2)
+
+def main():
+    """Compare the tick lists of the users given on the command line"""
+
+    # Skip options, the -o file name and the -p pair
+    mntproj_user_names = [arg for arg_i, arg in enumerate(sys.argv[1:], 1)
+                          if arg.startswith('-') is False and sys.argv[arg_i - 1] != '-o' and ',' not in arg]
+    if len(mntproj_user_names) < 2 and '-a' not in sys.argv:
+        print(__doc__)
+        sys.exit(2)
+
+    log_file = LOG_FILE
+    if os.path.isdir(LOG_DIR) is False:
+        print(LOG_DIR + " not found, logging to local logs directory")
+        os.makedirs("logs", exist_ok=True)
+        log_file = f"logs/{LOG_FILE_COMPARE_CSV}"
+
+    refresh_csv_file = '-n' not in sys.argv
+    print_common = '-p' in sys.argv
+    check_consistency = '-c' in sys.argv
+    print_pair = None
+    if print_common is True and sys.argv[-1] != '-p' and ',' in sys.argv[sys.argv.index('-p') + 1]:
+        print_pair = sys.argv[sys.argv.index('-p') + 1].split(',')
+    matrix_csv_file = sys.argv[sys.argv.index('-o') + 1] if '-o' in sys.argv and sys.argv[-1] != '-o' else None
+
+    with open(MNTPROJ_USER_IDS_FILE, encoding='utf-8') as open_mntproj_user_ids:
+        mntproj_user_ids = yaml.safe_load(open_mntproj_user_ids)
+
+    if '-a' in sys.argv:
+        mntproj_user_names = list(mntproj_user_ids)
+    mntproj_user_names = list(dict.fromkeys(mntproj_user_names))
+    if print_pair is not None and len(print_pair) != 2:
+        print("-p takes two users separated by a comma: -p mp-user1,mp-user2")
+        sys.exit(2)
+    if print_pair is None and len(mntproj_user_names) == 2:
+        print_pair = mntproj_user_names
+    for mntproj_user_name in mntproj_user_names + (print_pair or []):
+        if mntproj_user_name not in mntproj_user_ids:
+            print(mntproj_user_name, "not found in", MNTPROJ_USER_IDS_FILE)
+            sys.exit(2)
+
+    logging.basicConfig(filename=log_file, level=LOG_LEVEL, format=LOG_FORMAT)
+    logging.info("Starting Compare CSV for %s", ', '.join(mntproj_user_names))
+    logging.info("Python version: %s", sys.version)
+
+    session = requests.Session()
+    try:
+        all_user_routes = load_user_routes(dict.fromkeys(mntproj_user_names + (print_pair or [])),
+                                           mntproj_user_ids, session, refresh_csv_file)
+    except CsvFetchError as err:
+        logging.critical(err)
+        sys.exit(1)
+    session.close()
+
+    if len(mntproj_user_names) > 2:
+        output_common_route_matrix(mntproj_user_names, all_user_routes, matrix_csv_file)
+
+    if print_pair is not None:
+        if len(mntproj_user_names) > 2:
+            print()
+        compare_pair(print_pair[0], print_pair[1], mntproj_user_ids, all_user_routes, print_common,
+                     check_consistency)
+
+    logging.info("Compare CSV finished for %s", ', '.join(mntproj_user_names))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,25 @@
 """Constants for mntproj-compare scripts"""
 
+import os
+
 MNTPROJ_USER_IDS_FILE = 'mntproj_user_ids.yaml'
-ROUTE_TICKS_CACHE_FILE = 'route_ticks_cache.json'
+ROUTE_TICKS_CACHE_FILE = 'route_ticks_cache.json'  # imported into ROUTE_TICKS_CACHE_DB when empty
+ROUTE_TICKS_CACHE_DB = 'route_ticks_cache.db'
+ROUTE_SNAPSHOT_INTERVAL_MINS = 60  # the cache warmer rewrites route_ticks_cache.snapshot when older than this
+# Routes split across shards by a hash of the route ID, for nodes sharing one cache. Either a number of local
+# shard files next to ROUTE_TICKS_CACHE_DB, or a comma separated list of shard files and shard_server.py URLs,
+# the same list in the same order on every node. Empty or 1 for one database.
+ROUTE_CACHE_SHARDS = os.environ.get("ROUTE_CACHE_SHARDS", "")
+ROUTE_CACHE_SHARD_TIMEOUT = 30  # seconds to wait for a shard_server.py
 
-MNT_PROJ_BASE_URL = "https://www.mountainproject.com"
+# MNTPROJ_BASE_URL points the scrapers at another server, like fake_mntproj.py
+MNT_PROJ_BASE_URL = os.environ.get("MNTPROJ_BASE_URL", "https://www.mountainproject.com").rstrip('/')
 API_V2_ROUTES = "api/v2/routes"
+ROUTE_TICKS_PER_PAGE = 250
 
 USER_PROFILE_BASE_URL = f"{MNT_PROJ_BASE_URL}/user"
 USER_TICK_CSV_DIR = 'user_tick_csv'
+USER_CSV_TTL_MINS = 60  # csv files fetched within this are not requested again, older ones are revalidated
 
 TIMESTAMP_STR_FORMAT = '%Y-%m-%d %H:%M:%S'
 
@@ -19,7 +31,62 @@ LOG_DIR = 'logs'
 LOG_FILE_SCRAPE_MNTPROJ = 'scrape_mntproj.log'
 LOG_FILE_FLASK_APP = 'app.log'
 LOG_FILE_COMPARE_CSV = 'compare_csv.log'
+LOG_FILE_BATCH_MNTPROJ = 'batch_mntproj.log'
+LOG_FILE_USER_INDEX = 'user_similarity_index.log'
+LOG_FILE_CACHE_ADMIN = 'cache_admin.log'
+LOG_FILE_CACHE_WARMER = 'cache_warmer.log'
 
 CHECK_MP_LIMIT_MINS = 1  # 60, 1440, 10080
-# ROUTE_CACHE_LIM_MIN = 43800
+ROUTE_CACHE_LIM_MIN = 525600  # 43800, 525600, routes not looked up within this are evicted
+ROUTE_CACHE_MAX_ROUTE_USERS = 5000000  # least recently looked up routes are evicted past this many route users
 SAME_ROUTE_MAX_LIMIT = 50
+BATCH_RESULTS_DIR = 'batch_results'
+
+# Concurrent route tick fetching, rates are in requests per second
+FETCH_WORKERS = 4
+FETCH_RATE_INITIAL = 2.0
+FETCH_RATE_MIN = 0.2
+FETCH_RATE_MAX = 10.0
+FETCH_RATE_INCREASE = 0.05
+FETCH_RATE_DECREASE = 0.5
+NOCACHE_PAGE_QUEUE_SIZE = 32  # fetched pages waiting to be counted by scrape_mntproj_nocache.py
+
+# Background scrape jobs for the Flask app
+SCRAPE_JOB_WORKERS = 2
+SCRAPE_JOB_RETENTION_MINS = 60
+SCRAPE_JOB_DB = 'scrape_jobs.db'  # job status and results shared by the app's worker processes
+SCRAPE_JOB_POLL_SECS = 1  # workers not running a job check it for changes this often
+SCRAPE_JOB_STALE_MINS = 60  # running jobs without a heartbeat within this are failed, their worker stopped
+SCRAPE_JOB_HEARTBEAT_SECS = 60  # how often a worker records that its running jobs are still running
+PARTIAL_RESULTS_SECS = 10  # rankings of the routes done so far are streamed at most this often
+STREAM_HEARTBEAT_SECS = 15  # idle event streams send a comment this often so proxies keep them open
+
+# JSON API of similar users, each ranking keeps the API_SIMILAR_MAX_USERS most similar users to page through
+API_SIMILAR_MAX_USERS = 5000
+API_SIMILAR_MAX_LIMIT = 500  # most users per page
+API_GZIP_MIN_BYTES = 1024  # smaller responses are sent uncompressed
+
+# Route data is saved every CHECKPOINT_ROUTES routes or CHECKPOINT_SECS seconds during a scrape
+CHECKPOINT_DIR = 'checkpoints'
+CHECKPOINT_ROUTES = 50
+CHECKPOINT_SECS = 60
+
+# Lock files that let one worker on the host fetch a route while others wait for its result
+ROUTE_LOCK_DIR = 'route_locks'
+ROUTE_LOCK_STRIPES = 1024
+
+# MinHash index of every cached user's route set, MINHASH_NUM_HASHES must be a multiple of MINHASH_BANDS
+USER_INDEX_FILE = 'user_minhash_index.npz'
+USER_INDEX_PENDING_FOLD_MB = 16  # the cache warmer folds the index's pending file into it past this size
+MINHASH_NUM_HASHES = 64
+MINHASH_BANDS = 32
+
+# Rankings cached in memory by the Flask app, reused while none of the user's routes changed
+RESULT_CACHE_TTL_MINS = 60
+RESULT_CACHE_MAX_MB = 64
+
+# Background refresh of the most looked up stale routes, run by the Flask app, one warmer per host
+CACHE_WARMER_ENABLED = True
+CACHE_WARMER_INTERVAL_MINS = 10
+CACHE_WARMER_REQUEST_BUDGET = 200  # route page requests per pass
+ROUTE_LOOKUP_WINDOW_MINS = 10080  # only routes looked up within this are warmed, older lookups stop counting
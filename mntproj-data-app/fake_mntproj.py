@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+Local stand-in for Mountain Project serving synthetic tick lists,
+for load testing and benchmarks without hitting mountainproject.com.
+Serves user tick-export csv files with ETags and paginated route ticks from the v2 API,
+and can add latency and HTTP 429 responses to API requests.
+
+Example:
+python fake_mntproj.py --users 5000 --routes 20000 --port 5001
+python fake_mntproj.py --latency-ms 50 --error-rate 0.02 --rate-limit 20
+MNTPROJ_BASE_URL=http://127.0.0.1:5001 python scrape_mntproj.py thomas-anderson
+
+User IDs are 1 to --users, named user-<id>.
+GET /stats shows request counts, POST /stats/reset clears them.
+"""
+
+import argparse
+import csv
+import io
+import random
+import threading
+import time
+import zlib
+
+import numpy as np
+from flask import Flask, Response, jsonify, request
+
+
+class SyntheticMntProj:
+    """Synthetic routes and ticks, route popularity and user activity both follow a Zipf-like curve"""
+
+    def __init__(self, num_users, num_routes, mean_ticks_per_route, seed) -> None:
+        rng = np.random.default_rng(seed)
+        self.num_users = num_users
+        self.route_ids = [str(105700000 + route_i) for route_i in range(num_routes)]
+        route_popularity = 1 / np.arange(1, num_routes + 1) ** 0.8
+        route_ticks = np.maximum(1, rng.poisson(route_popularity / route_popularity.mean() * mean_ticks_per_route))
+        user_activity = 1 / np.arange(1, num_users + 1) ** 0.7
+        user_activity /= user_activity.sum()
+
+        self.route_ticks = {}
+        self.user_routes = {}
+        tick_id = 1
+        for route_id, num_ticks in zip(self.route_ids, route_ticks):
+            tick_user_ids = rng.choice(num_users, size=int(num_ticks), p=user_activity) + 1
+            # Newest first, like the API
+            self.route_ticks[route_id] = [(tick_id + tick_i, int(user_id))
+                                          for tick_i, user_id in reversed(list(enumerate(tick_user_ids)))]
+            tick_id += int(num_ticks)
+            for user_id in tick_user_ids:
+                self.user_routes.setdefault(int(user_id), set()).add(route_id)
+        self.private_users = set(rng.choice(num_users, size=max(1, num_users // 50), replace=False) + 1)
+
+    def user_name(self, user_id):
+        """Synthetic user name"""
+        return f"user-{user_id}"
+
+    def tick_export_csv(self, user_id):
+        """User's tick list in the tick-export csv format"""
+        csv_file = io.StringIO()
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(["Date", "Route", "Rating", "Notes", "URL", "Pitches", "Location", "Avg Stars",
+                             "Your Stars", "Style", "Lead Style", "Route Type", "Your Rating", "Length",
+                             "Rating Code"])
+        for route_id in sorted(self.user_routes.get(user_id, ())):
+            csv_writer.writerow(["2024-06-01", f"Route {route_id}", "5.10a", "Fun, sustained",
+                                 f"https://www.mountainproject.com/route/{route_id}/route-{route_id}",
+                                 1, "Somewhere > Crag", 3.2, -1, "Lead", "Redpoint", "Sport", "", 80, 2200])
+        return csv_file.getvalue()
+
+    def route_ticks_page(self, route_id, per_page, page, base_url):
+        """One page of a route's ticks in the v2 API format"""
+        ticks = self.route_ticks.get(route_id, [])
+        page_ticks = ticks[(page - 1) * per_page:page * per_page]
+        data = []
+        for tick_id, user_id in page_ticks:
+            user = False if user_id in self.private_users else {"id": user_id, "name": self.user_name(user_id)}
+            data.append({"id": tick_id, "date": "2024-06-01 00:00:00", "user": user})
+        next_page_url = None
+        if page * per_page < len(ticks):
+            next_page_url = f"{base_url}/api/v2/routes/{route_id}/ticks?per_page={per_page}&page={page + 1}"
+        return {"current_page": page, "data": data, "next_page_url": next_page_url,
+                "per_page": per_page, "total": len(ticks)}
+
+
+def create_app(synthetic_mntproj, latency_ms=0, error_rate=0.0, rate_limit=None, retry_after=1):
+    """Flask app serving synthetic_mntproj, with latency, random 429s and an optional requests/sec limit"""
+
+    fake_app = Flask(__name__)
+    stats = {"requests": 0, "route_pages": 0, "csv_downloads": 0, "csv_not_modified": 0, "http_429": 0}
+    stats_lock = threading.Lock()
+    bucket = {"tokens": rate_limit or 0, "last_refill": time.monotonic()}
+
+    def rate_limited():
+        if random.random() < error_rate:
+            return True
+        if rate_limit is None:
+            return False
+        with stats_lock:
+            now = time.monotonic()
+            bucket["tokens"] = min(rate_limit, bucket["tokens"] + (now - bucket["last_refill"]) * rate_limit)
+            bucket["last_refill"] = now
+            if bucket["tokens"] < 1:
+                return True
+            bucket["tokens"] -= 1
+        return False
+
+    @fake_app.before_request
+    def before_request():
+        if request.path.startswith("/stats"):
+            return None
+        with stats_lock:
+            stats["requests"] += 1
+        if latency_ms > 0:
+            time.sleep(random.uniform(0.5, 1.5) * latency_ms / 1000)
+        # Only the API is throttled, the scrapers don't retry tick-export downloads
+        if request.path.startswith("/api/") and rate_limited():
+            with stats_lock:
+                stats["http_429"] += 1
+            return Response("Too Many Requests", status=429, headers={"Retry-After": str(retry_after)})
+        return None
+
+    @fake_app.route('/user/<int:user_id>/<user_name>/tick-export')
+    def tick_export(user_id, user_name):  # pylint: disable=unused-argument
+        tick_export_csv = synthetic_mntproj.tick_export_csv(user_id)
+        etag = f'"{zlib.crc32(tick_export_csv.encode()):08x}"'
+        if request.headers.get("If-None-Match") == etag:
+            with stats_lock:
+                stats["csv_not_modified"] += 1
+            return Response(status=304, headers={"ETag": etag})
+        with stats_lock:
+            stats["csv_downloads"] += 1
+        return Response(tick_export_csv, mimetype="text/csv", headers={"ETag": etag})
+
+    @fake_app.route('/api/v2/routes/<route_id>/ticks')
+    def route_ticks(route_id):
+        with stats_lock:
+            stats["route_pages"] += 1
+        per_page = request.args.get('per_page', 250, type=int)
+        page = request.args.get('page', 1, type=int)
+        return jsonify(synthetic_mntproj.route_ticks_page(route_id, per_page, page, request.host_url.rstrip('/')))
+
+    @fake_app.route('/stats', methods=['GET'])
+    def get_stats():
+        with stats_lock:
+            return jsonify(stats)
+
+    @fake_app.route('/stats/reset', methods=['POST'])
+    def reset_stats():
+        with stats_lock:
+            for stat in stats:
+                stats[stat] = 0
+            return jsonify(stats)
+
+    return fake_app
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--routes', type=int, default=20000)
+    parser.add_argument('--mean-ticks', type=int, default=40, help="mean ticks per route")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, default=0, help="mean added latency per request")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument('--rate-limit', type=float, default=None, help="requests/sec before answering 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds sent with 429")
+    parser.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args()
+
+    print(f"Generating {args.routes} routes and {args.users} users")
+    synthetic_data = SyntheticMntProj(args.users, args.routes, args.mean_ticks, args.seed)
+    create_app(synthetic_data, args.latency_ms, args.error_rate, args.rate_limit, args.retry_after).run(
+        host="127.0.0.1", port=args.port, threaded=True)
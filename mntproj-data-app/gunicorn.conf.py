@@ -0,0 +1,11 @@
+"""
+Gunicorn settings, read from the directory Gunicorn is started in.
+Threads started before a worker is forked do not run in it, so each worker starts its own cache warmer,
+only one of which warms at a time.
+"""
+
+
+def post_worker_init(worker):  # pylint: disable=unused-argument
+    """Start the cache warmer once the worker has loaded the app"""
+    import app  # pylint: disable=import-outside-toplevel
+    app.start_cache_warmer()
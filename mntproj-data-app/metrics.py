@@ -0,0 +1,109 @@
+"""Counters and timers for scrape phases, exported in the Prometheus text format"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the timer histogram buckets
+TIMER_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class MetricsRegistry:
+    """
+    Thread safe counters and histogram timers, labelled by keyword arguments.
+    Metrics are kept per process, with Gunicorn each worker reports its own.
+    """
+
+    def __init__(self, prefix) -> None:
+        self.prefix = prefix
+        self.descriptions = {}
+        self.counters = {}
+        self.timers = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, metric_type, description):
+        """Set the type, counter or histogram, and the help text of a metric"""
+        self.descriptions[name] = (metric_type, description)
+
+    def inc(self, name, amount=1, **labels):
+        """Add to a counter"""
+        key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        """Add a duration to a timer"""
+        key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                timer = self.timers[key] = {"buckets": [0] * len(TIMER_BUCKETS), "count": 0, "sum": 0.0}
+            for bucket_i, bucket in enumerate(TIMER_BUCKETS):
+                if seconds <= bucket:
+                    timer["buckets"][bucket_i] += 1
+            timer["count"] += 1
+            timer["sum"] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Time a block of code, including blocks that raise"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timers = sorted(self.timers.items())
+
+        lines = []
+        described = set()
+
+        def add_description(name, metric_type):
+            if name in described:
+                return
+            described.add(name)
+            metric_type, description = self.descriptions.get(name, (metric_type, name))
+            lines.append(f"# HELP {self.prefix}_{name} {description}")
+            lines.append(f"# TYPE {self.prefix}_{name} {metric_type}")
+
+        for (name, labels), value in counters:
+            add_description(name, "counter")
+            lines.append(f"{self.prefix}_{name}{format_labels(labels)} {value}")
+
+        for (name, labels), timer in timers:
+            add_description(name, "histogram")
+            for bucket, bucket_count in zip(TIMER_BUCKETS + ("+Inf",), timer["buckets"] + [timer["count"]]):
+                lines.append(f"{self.prefix}_{name}_bucket{format_labels(labels + (('le', bucket),))} {bucket_count}")
+            lines.append(f"{self.prefix}_{name}_sum{format_labels(labels)} {timer['sum']:.6f}")
+            lines.append(f"{self.prefix}_{name}_count{format_labels(labels)} {timer['count']}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    """Prometheus label set, empty if there are no labels"""
+    if len(labels) == 0:
+        return ""
+    escaped_labels = ((label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                      for label, value in labels)
+    return '{' + ','.join(f'{label}="{value}"' for label, value in escaped_labels) + '}'
+
+
+# Shared by every scrape in the process, exported by the Flask app on /metrics
+METRICS = MetricsRegistry("mntproj")
+METRICS.describe("phase_seconds", "histogram", "Time spent in each scrape phase")
+METRICS.describe("scrapes_total", "counter", "Scrapes finished, by result")
+METRICS.describe("route_cache_lookups_total", "counter",
+                 "Route cache hits and misses, by the path that decided them")
+METRICS.describe("route_page_requests_total", "counter", "Route tick list page requests, by HTTP status")
+METRICS.describe("route_page_seconds", "histogram", "Time for each route tick list page request, including retries")
+METRICS.describe("route_page_retries_total", "counter", "Route tick list page requests retried after HTTP 429")
+METRICS.describe("route_fetch_errors_total", "counter", "Routes that could not be fetched")
+METRICS.describe("csv_requests_total", "counter", "User csv tick lists, by cached, not modified, or downloaded")
+METRICS.describe("cache_warmer_routes_total", "counter", "Routes refreshed by the cache warmer")
+METRICS.describe("cache_warmer_requests_total", "counter", "Route page requests made by the cache warmer")
+METRICS.describe("result_cache_lookups_total", "counter", "Cached ranking lookups, by hit or miss")
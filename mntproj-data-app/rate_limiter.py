@@ -0,0 +1,75 @@
+"""Adaptive rate limiting for Mountain Project API requests"""
+
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+def parse_retry_after(retry_after):
+    """Get the number of seconds to wait from a Retry-After header value"""
+    if retry_after is None:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket shared by all threads making requests.
+    The rate increases additively after each successful request and decreases
+    multiplicatively after each HTTP 429 (AIMD), so requests run close to the
+    upstream limit. Retry-After pauses all threads for the given time.
+    """
+
+    def __init__(self, rate, min_rate, max_rate, increase, decrease, burst=1) -> None:
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        """Add tokens for the time since the last refill"""
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """Wait until a request can be made"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait_time)
+
+    def on_success(self):
+        """Additively increase the rate after a successful request"""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_rate_limited(self, retry_after=None):
+        """Multiplicatively decrease the rate after HTTP 429, and pause for retry_after seconds"""
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = 0
+            if retry_after is not None:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+            return self.rate
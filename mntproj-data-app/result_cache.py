@@ -0,0 +1,99 @@
+"""In memory cache of computed rankings, so repeat lookups skip the scrape"""
+
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class CachedResult:
+    """
+    A ranking with the route IDs it was computed from and their version stamp.
+    similar_users is the longer ranking the JSON API pages through, if there is one.
+    """
+
+    __slots__ = ("results", "route_ids", "version", "similar_users", "created", "size")
+
+    def __init__(self, results, route_ids, version, similar_users=None, age_secs=0) -> None:
+        self.results = results
+        self.route_ids = route_ids
+        self.version = version
+        self.similar_users = similar_users
+        self.created = time.monotonic() - age_secs
+        self.size = (sys.getsizeof(results) + sum(sys.getsizeof(line) for line in results) +
+                     sys.getsizeof(route_ids) + sum(sys.getsizeof(route_id) for route_id in route_ids) +
+                     sys.getsizeof(version) + (sys.getsizeof(similar_users) if similar_users is not None else 0))
+
+
+class ResultCache:
+    """
+    Rankings keyed by user ID and metric, evicted least recently used first once max_bytes is reached.
+    An entry is only returned within ttl_mins and while the version stamp of its routes,
+    from RouteTicksCache.routes_version, is unchanged. Past the TTL the user's routes are
+    rechecked on Mountain Project by a full scrape.
+    """
+
+    def __init__(self, ttl_mins, max_bytes) -> None:
+        self.ttl_secs = ttl_mins * 60
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, mp_uid, metric, routes_version):
+        """
+        Get the cached ranking for a user and metric, None if missing, expired or out of date.
+        routes_version is called with the entry's route IDs to get their current version stamp.
+        """
+        entry = self.get_entry(mp_uid, metric, routes_version)
+        return entry.results if entry is not None else None
+
+    def get_entry(self, mp_uid, metric, routes_version):
+        """Get the CachedResult for a user and metric, None if missing, expired or out of date"""
+        key = (str(mp_uid), metric)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry.created > self.ttl_secs:
+                logging.info("Cached results for %s %s expired", mp_uid, metric)
+                self.remove(key)
+                return None
+        # Checked outside the lock, it reads the database
+        if routes_version(entry.route_ids) != entry.version:
+            logging.info("Routes changed since results for %s %s were cached", mp_uid, metric)
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    self.remove(key)
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return entry
+
+    def put(self, mp_uid, metric, results, route_ids, version, similar_users=None, age_secs=0):
+        """
+        Cache a ranking, evicting the least recently used entries to stay under max_bytes, returns its CachedResult.
+        age_secs is how long ago the ranking was computed, counted against the TTL.
+        """
+        key = (str(mp_uid), metric)
+        entry = CachedResult(list(results), tuple(route_ids), version, similar_users, age_secs)
+        if entry.size > self.max_bytes:
+            logging.info("Results for %s %s too large to cache, %s bytes", mp_uid, metric, entry.size)
+            return entry
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = entry
+            self.total_bytes += entry.size
+            while self.total_bytes > self.max_bytes:
+                evicted_key, _ = next(iter(self.entries.items()))
+                logging.info("Evicting cached results for %s %s", *evicted_key)
+                self.remove(evicted_key)
+        return entry
+
+    def remove(self, key):
+        """Remove an entry, the lock must be held"""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
@@ -0,0 +1,506 @@
+"""SQLite backed cache of Mountain Project route tick data"""
+
+import hashlib
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from json import JSONDecodeError
+
+import numpy as np
+
+from constants import TIMESTAMP_STR_FORMAT, ROUTE_LOOKUP_WINDOW_MINS
+from route_snapshot import RouteSnapshot, route_version, snapshot_file_for
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS routes (
+    route_id TEXT PRIMARY KEY,
+    route_name TEXT,
+    last_total_mp INTEGER,
+    cache_last_updated TEXT,
+    mp_last_checked TEXT,
+    newest_tick_id TEXT,
+    last_accessed TEXT,
+    lookup_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS route_users (
+    route_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    user_name TEXT,
+    PRIMARY KEY (route_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS route_users_user_id ON route_users (user_id);
+"""
+
+ROUTE_FIELDS = ("route_name", "last_total_mp", "cache_last_updated", "mp_last_checked", "newest_tick_id")
+
+# Columns added after the routes table was first created, added to older databases on open
+ROUTE_COLUMNS_ADDED = {"newest_tick_id": "TEXT", "last_accessed": "TEXT", "lookup_count": "INTEGER NOT NULL DEFAULT 0"}
+
+USER_ID_DTYPE = np.int64
+
+
+class UserTable:
+    """
+    User names by user ID, each name is kept once however many routes the user ticked.
+    Users not loaded from the database are looked up in the snapshot, if there is one.
+    """
+
+    __slots__ = ("names", "snapshot")
+
+    def __init__(self, snapshot=None) -> None:
+        self.names = {}
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, user_id, user_name):
+        """Add or rename a user, returns True if the user is new or the name changed"""
+        if self.name(user_id) == user_name:
+            return False
+        self.names[user_id] = user_name
+        return True
+
+    def name(self, user_id):
+        """Get a user's name, None if not loaded"""
+        user_name = self.names.get(int(user_id))
+        if user_name is None and self.snapshot is not None:
+            user_name = self.snapshot.user_name(int(user_id))
+        return user_name
+
+
+class RouteRecord:
+    """A loaded route's fields, with the IDs of the users who ticked it as a sorted array"""
+
+    __slots__ = ROUTE_FIELDS + ("user_ids",)
+
+    def __init__(self, route_name=None, last_total_mp=0, cache_last_updated=None, mp_last_checked=None,
+                 newest_tick_id=None, user_ids=None) -> None:
+        self.route_name = route_name
+        self.last_total_mp = last_total_mp
+        self.cache_last_updated = cache_last_updated
+        self.mp_last_checked = mp_last_checked
+        self.newest_tick_id = newest_tick_id
+        self.user_ids = user_ids if user_ids is not None else np.array([], dtype=USER_ID_DTYPE)
+
+    def has_user(self, user_id):
+        """Check if a user ticked the route"""
+        user_i = np.searchsorted(self.user_ids, int(user_id))
+        return bool(user_i < len(self.user_ids) and self.user_ids[user_i] == int(user_id))
+
+
+class RouteTicksCache:
+    """
+    Route tick data keyed by route ID.
+    Routes are read from the database the first time they are looked up, as RouteRecords
+    holding user IDs, with user names kept once in the users table.
+    A route's user IDs are read from the memory mapped snapshot instead while its version matches.
+    Only routes and route users that changed are written back on commit.
+    Lookups of saved routes are recorded in last_accessed and lookup_count on commit,
+    for eviction and the cache warmer. A route looked up several times between commits counts once.
+    lookup_count starts again from 1 when a route is looked up after ROUTE_LOOKUP_WINDOW_MINS without lookups.
+    Routes written without a lookup, like refreshes by the cache warmer, keep their last_accessed and lookup_count.
+    """
+
+    def __init__(self, cache_db_file, legacy_json_file=None) -> None:
+        self.cache_db_file = cache_db_file
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(cache_db_file, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(CACHE_SCHEMA)
+        self.add_missing_columns()
+        self.routes = {}
+        self.snapshot = RouteSnapshot.open(snapshot_file_for(cache_db_file))
+        self.users = UserTable(self.snapshot)
+        self.dirty_routes = set()
+        self.new_user_ticks = {}
+        self.removed_user_ticks = {}
+        self.accessed_routes = set()
+        self.record_lookups = True
+        if legacy_json_file is not None:
+            self.import_json(legacy_json_file)
+
+    def __contains__(self, route_id):
+        return self.get(route_id) is not None
+
+    def __getitem__(self, route_id):
+        route = self.get(route_id)
+        if route is None:
+            raise KeyError(route_id)
+        return route
+
+    def add_missing_columns(self):
+        """Add columns missing from a database created by an older version"""
+        route_columns = {row[1] for row in self.conn.execute("PRAGMA table_info(routes)")}
+        with self.conn:
+            for column, column_type in ROUTE_COLUMNS_ADDED.items():
+                if column not in route_columns:
+                    self.conn.execute(f"ALTER TABLE routes ADD COLUMN {column} {column_type}")
+
+    def get(self, route_id, default=None):
+        """Get a route, loading it from the database if not already loaded"""
+        with self.lock:
+            if route_id in self.routes:
+                if self.record_lookups:
+                    self.accessed_routes.add(route_id)
+                return self.routes[route_id]
+            route = self.read_route(route_id)
+            if route is None:
+                return default
+            self.routes[route_id] = route
+            if self.record_lookups:
+                self.accessed_routes.add(route_id)
+            return route
+
+    def read_route(self, route_id):
+        """Read a saved route with its user IDs, from the snapshot while its version matches, None if not saved"""
+        with self.lock:
+            route = self.read_saved_route(route_id)
+            if route is not None and route.user_ids is None:
+                route.user_ids = self.load_route_user_ids(route_id)
+            return route
+
+    def read_saved_route(self, route_id):
+        """Read a saved route's fields, with its user IDs only if the snapshot has its version, None if not saved"""
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT {', '.join(ROUTE_FIELDS)} FROM routes WHERE route_id = ?", (route_id,)).fetchone()
+            if row is None:
+                return None
+            route = RouteRecord(*row)
+            route.user_ids = None
+            if self.snapshot is not None:
+                route.user_ids = self.snapshot.route_user_ids(
+                    route_id, route_version(route.cache_last_updated, route.last_total_mp, route.newest_tick_id))
+            return route
+
+    def read_route_users(self, route_id):
+        """Read a route's users from the database, as user ID and name rows sorted by user ID"""
+        with self.lock:
+            return self.conn.execute("SELECT CAST(user_id AS INTEGER), user_name FROM route_users"
+                                     " WHERE route_id = ? ORDER BY 1", (route_id,)).fetchall()
+
+    def load_route_user_ids(self, route_id):
+        """Read a route's sorted user IDs from the database, adding their names to the users table"""
+        user_rows = self.read_route_users(route_id)
+        user_names = self.users.names
+        for user_id, user_name in user_rows:
+            # A name fetched in this run is newer than the saved one
+            if user_id not in user_names:
+                user_names[user_id] = user_name
+        return np.fromiter((user_id for user_id, _ in user_rows), dtype=USER_ID_DTYPE, count=len(user_rows))
+
+    def reload(self, route_id):
+        """Drop a loaded route without unsaved changes, so the next lookup reads what other workers saved"""
+        with self.lock:
+            if route_id not in self.dirty_routes and route_id not in self.new_user_ticks and\
+            route_id not in self.removed_user_ticks:
+                self.routes.pop(route_id, None)
+            return self.get(route_id)
+
+    def route_ids(self):
+        """Get all cached route IDs"""
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT route_id FROM routes")]
+
+    def iter_route_user_ids(self):
+        """
+        Yield each saved route ID with the IDs of the users who ticked it, without loading routes.
+        Reads with its own connection so other threads can use the cache meanwhile.
+        """
+        scan_conn = sqlite3.connect(self.cache_db_file, timeout=60)
+        try:
+            rows = scan_conn.execute("SELECT route_id, user_id FROM route_users ORDER BY route_id")
+            for route_id, route_rows in itertools.groupby(rows, key=lambda row: row[0]):
+                yield route_id, [user_id for _, user_id in route_rows]
+        finally:
+            scan_conn.close()
+
+    def user_names(self, user_ids):
+        """Get the cached names of user IDs"""
+        names = {}
+        with self.lock:
+            for user_id in user_ids:
+                row = self.conn.execute("SELECT user_name FROM route_users WHERE user_id = ? LIMIT 1",
+                                        (str(user_id),)).fetchone()
+                if row is not None:
+                    names[str(user_id)] = row[0]
+        return names
+
+    def user_route_counts(self, user_ids):
+        """Count the saved routes of each user ID, in the order of user_ids"""
+        counts = {}
+        with self.lock:
+            for chunk_start in range(0, len(user_ids), 500):
+                chunk = [str(user_id) for user_id in user_ids[chunk_start:chunk_start + 500]]
+                counts.update(self.conn.execute(
+                    f"SELECT user_id, COUNT(*) FROM route_users WHERE user_id IN ({', '.join('?' for _ in chunk)})"
+                    " GROUP BY user_id", chunk))
+        return [counts.get(str(user_id), 0) for user_id in user_ids]
+
+    def user_route_pairs(self, user_ids):
+        """Saved route ID and user ID of every route ticked by user_ids, as an array of integer pairs"""
+        pairs = []
+        with self.lock:
+            for chunk_start in range(0, len(user_ids), 500):
+                chunk = [str(user_id) for user_id in user_ids[chunk_start:chunk_start + 500]]
+                pairs.extend(self.conn.execute(
+                    "SELECT CAST(route_id AS INTEGER), CAST(user_id AS INTEGER) FROM route_users"
+                    f" WHERE user_id IN ({', '.join('?' for _ in chunk)})", chunk))
+        return np.array(pairs, dtype=np.int64).reshape(-1, 2)
+
+    def routes_version(self, route_ids):
+        """
+        Version stamp of the saved data of route_ids, changes when any of the routes' ticks are updated.
+        Routes only rechecked on Mountain Project keep the same stamp.
+        """
+        return hash_route_versions(route_ids, self.saved_route_versions(route_ids))
+
+    def saved_route_versions(self, route_ids):
+        """Saved route ID to the fields that change when the route's ticks are updated, for routes_version"""
+        route_versions = {}
+        with self.lock:
+            for chunk_start in range(0, len(route_ids), 500):
+                chunk = [str(route_id) for route_id in route_ids[chunk_start:chunk_start + 500]]
+                for route_id, *version_fields in self.conn.execute(
+                        "SELECT route_id, cache_last_updated, last_total_mp, newest_tick_id FROM routes"
+                        f" WHERE route_id IN ({', '.join('?' for _ in chunk)})", chunk):
+                    route_versions[route_id] = version_fields
+        return route_versions
+
+    def update_route(self, route_id, **route_fields):
+        """Create or update a route's fields, the route is written on the next commit"""
+        with self.lock:
+            route = self.get(route_id)
+            if route is None:
+                route = self.routes[route_id] = RouteRecord()
+                if self.record_lookups:
+                    self.accessed_routes.add(route_id)
+            for field, value in route_fields.items():
+                setattr(route, field, value)
+            self.dirty_routes.add(route_id)
+
+    def add_user_ticks(self, route_id, user_ticks):
+        """Add users to a route's tick list, only users new to the route or renamed are written on commit"""
+        with self.lock:
+            route = self[route_id]
+            new_user_ticks = self.new_user_ticks.setdefault(route_id, {})
+            removed_user_ticks = self.removed_user_ticks.get(route_id, set())
+            added_user_ids = []
+            for user_id, user_name in user_ticks.items():
+                user_id = int(user_id)
+                renamed = self.users.add(user_id, user_name)
+                if renamed or route.has_user(user_id) is False:
+                    added_user_ids.append(user_id)
+                    new_user_ticks[user_id] = user_name
+                    removed_user_ticks.discard(user_id)
+            if added_user_ids:
+                route.user_ids = np.union1d(route.user_ids, np.array(added_user_ids, dtype=USER_ID_DTYPE))
+
+    def replace_user_ticks(self, route_id, user_ticks):
+        """Replace a route's tick list, users no longer in it are deleted on commit"""
+        with self.lock:
+            route = self[route_id]
+            kept_user_ids = np.array([int(user_id) for user_id in user_ticks], dtype=USER_ID_DTYPE)
+            removed_user_ids = np.setdiff1d(route.user_ids, kept_user_ids).tolist()
+            route.user_ids = np.intersect1d(route.user_ids, kept_user_ids)
+            new_user_ticks = self.new_user_ticks.get(route_id, {})
+            for user_id in removed_user_ids:
+                new_user_ticks.pop(user_id, None)
+            self.removed_user_ticks.setdefault(route_id, set()).update(removed_user_ids)
+            self.add_user_ticks(route_id, user_ticks)
+
+    def commit(self, route_ids=None):
+        """Write changed routes and route users to the database, only route_ids if given"""
+        with self.lock:
+            if route_ids is None:
+                dirty_routes = set(self.dirty_routes) | set(self.new_user_ticks) | set(self.removed_user_ticks)
+            else:
+                dirty_routes = set(route_ids)
+            route_rows = [(route_id,) + tuple(getattr(self.routes[route_id], field) for field in ROUTE_FIELDS)
+                          for route_id in dirty_routes & self.dirty_routes]
+            user_rows = [(route_id, str(user_id), user_name)
+                         for route_id in dirty_routes
+                         for user_id, user_name in self.new_user_ticks.get(route_id, {}).items()]
+            removed_user_rows = [(route_id, str(user_id))
+                                 for route_id in dirty_routes
+                                 for user_id in self.removed_user_ticks.get(route_id, ())]
+            # Lookups of routes not saved yet are recorded when the route is committed
+            accessed_routes = {route_id for route_id in self.accessed_routes
+                               if route_id in dirty_routes or route_id not in self.dirty_routes}
+            accessed_time = datetime.now()
+            lookup_window_start = accessed_time - timedelta(minutes=ROUTE_LOOKUP_WINDOW_MINS)
+            accessed_rows = [(lookup_window_start.strftime(TIMESTAMP_STR_FORMAT),
+                              accessed_time.strftime(TIMESTAMP_STR_FORMAT), route_id)
+                             for route_id in accessed_routes]
+            self.write_changes(route_rows, user_rows, removed_user_rows, accessed_rows)
+            self.accessed_routes -= accessed_routes
+            for route_id in dirty_routes:
+                self.dirty_routes.discard(route_id)
+                self.new_user_ticks.pop(route_id, None)
+                self.removed_user_ticks.pop(route_id, None)
+            logging.info("Saved %s routes, %s route users and removed %s route users in %s",
+                         len(route_rows), len(user_rows), len(removed_user_rows), self.cache_db_file)
+
+    def write_changes(self, route_rows, user_rows, removed_user_rows, accessed_rows):
+        """Write changed route rows, new and removed route users, and route lookups in one transaction"""
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    f"INSERT INTO routes (route_id, {', '.join(ROUTE_FIELDS)})"
+                    f" VALUES (?, {', '.join('?' for _ in ROUTE_FIELDS)}) ON CONFLICT (route_id) DO UPDATE SET "
+                    + ', '.join(f"{field} = excluded.{field}" for field in ROUTE_FIELDS),
+                    route_rows)
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO route_users (route_id, user_id, user_name) VALUES (?, ?, ?)",
+                    user_rows)
+                self.conn.executemany(
+                    "DELETE FROM route_users WHERE route_id = ? AND user_id = ?", removed_user_rows)
+                self.conn.executemany(
+                    "UPDATE routes SET lookup_count = CASE WHEN last_accessed IS NULL OR last_accessed < ? THEN 1"
+                    " ELSE lookup_count + 1 END, last_accessed = ? WHERE route_id = ?", accessed_rows)
+
+    def routes_to_warm(self, now, checked_before, accessed_after, limit):
+        """
+        Routes looked up since accessed_after and last checked on Mountain Project before checked_before,
+        as route ID, name and score, most popular and stalest first,
+        scored by lookup count times days since last checked.
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT route_id, route_name, lookup_count * (julianday(?) - julianday(mp_last_checked)) AS score"
+                " FROM routes WHERE lookup_count > 0 AND last_accessed >= ?"
+                " AND mp_last_checked IS NOT NULL AND mp_last_checked < ?"
+                " ORDER BY score DESC, route_id LIMIT ?",
+                (now, accessed_after, checked_before, limit)).fetchall()
+
+    def eviction_candidates(self, max_age_mins, max_route_users):
+        """
+        Saved routes to evict, as route ID and route user count.
+        Routes not looked up within max_age_mins are evicted, then the least recently looked up routes
+        until at most max_route_users route users remain. Routes never looked up since last_accessed was
+        added use the time they were last checked.
+        """
+        cutoff_time = (datetime.now() - timedelta(minutes=max_age_mins)).strftime(TIMESTAMP_STR_FORMAT)
+        with self.lock:
+            route_rows = self.conn.execute(
+                "SELECT routes.route_id,"
+                " COALESCE(last_accessed, mp_last_checked, cache_last_updated, '') AS route_accessed,"
+                " COUNT(route_users.user_id)"
+                " FROM routes LEFT JOIN route_users ON route_users.route_id = routes.route_id"
+                " GROUP BY routes.route_id ORDER BY route_accessed DESC, routes.route_id").fetchall()
+        evicted_routes = []
+        route_users_kept = 0
+        for route_id, route_accessed, route_user_count in route_rows:
+            # Routes are newest first, so once one is evicted all older routes are evicted too
+            if evicted_routes or route_accessed < cutoff_time or\
+            route_users_kept + route_user_count > max_route_users:
+                evicted_routes.append((route_id, route_user_count))
+            else:
+                route_users_kept += route_user_count
+        return evicted_routes
+
+    def delete_route(self, route_id):
+        """Delete a route and its users from the database, dropping any unsaved changes to it"""
+        with self.lock:
+            self.delete_saved_route(route_id)
+            for route_set in (self.routes, self.new_user_ticks, self.removed_user_ticks):
+                route_set.pop(route_id, None)
+            self.dirty_routes.discard(route_id)
+            self.accessed_routes.discard(route_id)
+
+    def delete_saved_route(self, route_id):
+        """Delete a route and its users from the database"""
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM route_users WHERE route_id = ?", (route_id,))
+                self.conn.execute("DELETE FROM routes WHERE route_id = ?", (route_id,))
+
+    def size_stats(self):
+        """Database file size in bytes including the WAL, with route and route user counts"""
+        with self.lock:
+            page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+            page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+            free_pages = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+            num_routes = self.conn.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+            num_route_users = self.conn.execute("SELECT COUNT(*) FROM route_users").fetchone()[0]
+        wal_file = self.cache_db_file + '-wal'
+        wal_size = os.path.getsize(wal_file) if os.path.isfile(wal_file) else 0
+        return {"bytes": page_count * page_size + wal_size,
+                "free_bytes": free_pages * page_size,
+                "routes": num_routes,
+                "route_users": num_route_users}
+
+    def vacuum(self):
+        """Delete route users of missing routes, then rebuild the database file to return free pages"""
+        with self.lock:
+            with self.conn:
+                orphaned = self.conn.execute(
+                    "DELETE FROM route_users WHERE route_id NOT IN (SELECT route_id FROM routes)").rowcount
+            self.conn.execute("VACUUM")
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        if orphaned > 0:
+            logging.info("Deleted %s route users of missing routes", orphaned)
+
+    def import_json(self, json_file):
+        """Import a route_ticks_cache.json file into an empty database"""
+        if self.is_empty() is False:
+            return
+        json_data = read_route_ticks_json(json_file)
+        if json_data is not None:
+            self.import_routes(json_data)
+
+    def is_empty(self):
+        """Check if no routes are saved"""
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM routes LIMIT 1").fetchone() is None
+
+    def import_routes(self, json_data):
+        """Import routes read from a route_ticks_cache.json file, only if the database is empty"""
+        with self.lock:
+            if self.is_empty() is False:
+                return
+            with self.conn:
+                self.conn.executemany(
+                    f"INSERT INTO routes (route_id, {', '.join(ROUTE_FIELDS)})"
+                    f" VALUES (?, {', '.join('?' for _ in ROUTE_FIELDS)})",
+                    ((route_id,) + tuple(route.get(field) for field in ROUTE_FIELDS)
+                     for route_id, route in json_data.items()))
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO route_users (route_id, user_id, user_name) VALUES (?, ?, ?)",
+                    ((route_id, str(user_id), user_name)
+                     for route_id, route in json_data.items()
+                     for user_id, user_name in route.get("user_ticks", {}).items()))
+            logging.info("Imported %s routes into %s", len(json_data), self.cache_db_file)
+
+    def close(self):
+        """Close the database connection"""
+        with self.lock:
+            self.conn.close()
+
+
+def hash_route_versions(route_ids, route_versions):
+    """Hash saved_route_versions of route_ids, routes not saved are hashed as None"""
+    version_hash = hashlib.blake2b(digest_size=16)
+    for route_id in sorted(str(route_id) for route_id in route_ids):
+        version_hash.update(repr((route_id, route_versions.get(route_id))).encode())
+    return version_hash.hexdigest()
+
+
+def read_route_ticks_json(json_file):
+    """Read a route_ticks_cache.json file, None if it is missing or not valid"""
+    if os.path.isfile(json_file) is False:
+        return None
+    logging.info("Importing %s", json_file)
+    try:
+        with open(json_file, encoding='utf-8') as open_json_file:
+            return json.load(open_json_file)
+    except (PermissionError, JSONDecodeError) as err:
+        logging.error(err)
+        logging.error("Not importing %s", json_file)
+        return None
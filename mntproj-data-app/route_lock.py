@@ -0,0 +1,38 @@
+"""Host wide locks so only one process or thread fetches a route at a time"""
+
+import fcntl
+import logging
+import os
+import time
+import zlib
+
+
+class RouteLock:
+    """
+    Exclusive lock for a route, shared by all processes on the host.
+    Routes are hashed to a fixed number of lock files so the lock directory stays small.
+    Each RouteLock opens its own file, so threads in one process also exclude each other.
+    """
+
+    def __init__(self, lock_dir, route_id, lock_stripes) -> None:
+        os.makedirs(lock_dir, exist_ok=True)
+        stripe = zlib.crc32(str(route_id).encode()) % lock_stripes
+        self.lock_file = f"{lock_dir}/route_{stripe}.lock"
+        self.route_id = route_id
+        self.open_lock_file = None
+
+    def __enter__(self):
+        self.open_lock_file = open(self.lock_file, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+        try:
+            fcntl.flock(self.open_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.info("Waiting for route/%s fetch by another worker", self.route_id)
+            start_time = time.monotonic()
+            fcntl.flock(self.open_lock_file, fcntl.LOCK_EX)
+            logging.info("Waited %.2f seconds for route/%s", time.monotonic() - start_time, self.route_id)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.open_lock_file, fcntl.LOCK_UN)
+        self.open_lock_file.close()
+        self.open_lock_file = None
@@ -0,0 +1,345 @@
+"""
+Route cache split into shards by route ID, for nodes sharing one cache.
+Each route is placed on one shard by the crc32 of its ID, the same way on every node.
+A shard is a local cache database file or the URL of a shard_server.py serving one.
+ShardedRouteTicksCache has the methods of RouteTicksCache, so scrapes use it the same way.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+
+import numpy as np
+import requests
+
+from constants import ROUTE_TICKS_CACHE_DB, ROUTE_CACHE_SHARDS, ROUTE_CACHE_SHARD_TIMEOUT
+from route_cache import RouteTicksCache, RouteRecord, UserTable, USER_ID_DTYPE
+from route_cache import hash_route_versions, read_route_ticks_json
+from route_snapshot import write_snapshot
+
+
+class ShardUnavailableError(sqlite3.Error):
+    """A shard server could not be reached or failed, a sqlite3.Error so it is handled like database errors"""
+
+
+def shard_index(route_id, num_shards):
+    """Shard of a route ID"""
+    return zlib.crc32(str(route_id).encode()) % num_shards
+
+
+def is_remote_shard(shard):
+    """Check if a shard is a shard_server.py URL rather than a database file"""
+    return shard.startswith(("http://", "https://"))
+
+
+def configured_shards(cache_db_file=ROUTE_TICKS_CACHE_DB, shards_setting=ROUTE_CACHE_SHARDS):
+    """
+    Shard files and URLs from ROUTE_CACHE_SHARDS, an empty list for one database.
+    A number of shards is numbered database files next to cache_db_file.
+    """
+    shards_setting = shards_setting.strip()
+    if shards_setting.isdigit():
+        base_name, extension = os.path.splitext(cache_db_file)
+        num_shards = int(shards_setting)
+        return [f"{base_name}.{shard_i}{extension}" for shard_i in range(num_shards)] if num_shards > 1 else []
+    return [shard.strip() for shard in shards_setting.split(',') if shard.strip() != '']
+
+
+def local_cache_files(cache_db_file=ROUTE_TICKS_CACHE_DB):
+    """Database files of the cache on this host, the local shards or cache_db_file"""
+    shards = configured_shards(cache_db_file)
+    if len(shards) == 0:
+        return [cache_db_file]
+    return [shard for shard in shards if is_remote_shard(shard) is False]
+
+
+def route_cache_exists(cache_db_file=ROUTE_TICKS_CACHE_DB):
+    """Check if there is a cache to read, remote shards are assumed to exist"""
+    shards = configured_shards(cache_db_file) or [cache_db_file]
+    return any(is_remote_shard(shard) or os.path.isfile(shard) for shard in shards)
+
+
+def open_route_cache(cache_db_file=ROUTE_TICKS_CACHE_DB, legacy_json_file=None):
+    """Open the route cache, sharded if ROUTE_CACHE_SHARDS is set, otherwise cache_db_file"""
+    shards = configured_shards(cache_db_file)
+    if len(shards) == 0:
+        return RouteTicksCache(cache_db_file, legacy_json_file)
+    return ShardedRouteTicksCache(shards, legacy_json_file)
+
+
+def write_snapshots(cache_db_file=ROUTE_TICKS_CACHE_DB):
+    """Write the snapshot of each database file on this host, returns the number of routes written"""
+    return sum(write_snapshot(local_cache_file) for local_cache_file in local_cache_files(cache_db_file))
+
+
+class RemoteRouteShard(RouteTicksCache):
+    """
+    Route cache shard served by shard_server.py.
+    Routes are loaded and changed locally like RouteTicksCache, reads and commits go to the server.
+    """
+
+    def __init__(self, shard_url, timeout=ROUTE_CACHE_SHARD_TIMEOUT) -> None:  # pylint: disable=super-init-not-called
+        self.cache_db_file = shard_url
+        self.shard_url = shard_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.lock = threading.RLock()
+        self.routes = {}
+        self.snapshot = None
+        self.users = UserTable()
+        self.dirty_routes = set()
+        self.new_user_ticks = {}
+        self.removed_user_ticks = {}
+        self.accessed_routes = set()
+        self.record_lookups = True
+
+    def call(self, method, *args):
+        """Call a RouteTicksCache method on the shard server"""
+        try:
+            response = self.session.post(f"{self.shard_url}/call/{method}", json={"args": args},
+                                         timeout=self.timeout)
+        except requests.RequestException as err:
+            raise ShardUnavailableError(f"{self.shard_url}: {err}") from err
+        if response.status_code != 200:
+            raise ShardUnavailableError(f"{self.shard_url}: {method} returned HTTP status code "
+                                        f"{response.status_code}")
+        return response.json()["result"]
+
+    def read_route(self, route_id):
+        route_data = self.call("read_route", route_id)
+        if route_data is None:
+            return None
+        user_names = self.users.names
+        for user_id, user_name in route_data["users"]:
+            if user_id not in user_names:
+                user_names[user_id] = user_name
+        return RouteRecord(*route_data["fields"], user_ids=np.array(
+            [user_id for user_id, _ in route_data["users"]], dtype=USER_ID_DTYPE))
+
+    def write_changes(self, route_rows, user_rows, removed_user_rows, accessed_rows):
+        self.call("write_changes", route_rows, user_rows, removed_user_rows, accessed_rows)
+
+    def route_ids(self):
+        return self.call("route_ids")
+
+    def iter_route_user_ids(self):
+        yield from self.call("iter_route_user_ids")
+
+    def user_names(self, user_ids):
+        return self.call("user_names", [str(user_id) for user_id in user_ids])
+
+    def user_route_counts(self, user_ids):
+        return self.call("user_route_counts", [str(user_id) for user_id in user_ids])
+
+    def user_route_pairs(self, user_ids):
+        return np.array(self.call("user_route_pairs", [str(user_id) for user_id in user_ids]),
+                        dtype=np.int64).reshape(-1, 2)
+
+    def saved_route_versions(self, route_ids):
+        return self.call("saved_route_versions", [str(route_id) for route_id in route_ids])
+
+    def routes_to_warm(self, now, checked_before, accessed_after, limit):
+        return [tuple(route) for route in self.call("routes_to_warm", now, checked_before, accessed_after, limit)]
+
+    def eviction_candidates(self, max_age_mins, max_route_users):
+        return [tuple(route) for route in self.call("eviction_candidates", max_age_mins, max_route_users)]
+
+    def delete_saved_route(self, route_id):
+        self.call("delete_saved_route", route_id)
+
+    def size_stats(self):
+        return self.call("size_stats")
+
+    def vacuum(self):
+        self.call("vacuum")
+
+    def is_empty(self):
+        return self.call("is_empty")
+
+    def import_routes(self, json_data):
+        self.call("import_routes", json_data)
+
+    def close(self):
+        self.session.close()
+
+
+class ShardedUserTable:
+    """User names from the users tables of every shard"""
+
+    def __init__(self, shards) -> None:
+        self.shards = shards
+
+    def name(self, user_id):
+        """Get a user's name from the first shard that has it loaded, None if none do"""
+        for shard in self.shards:
+            user_name = shard.users.name(user_id)
+            if user_name is not None:
+                return user_name
+        return None
+
+
+class ShardedRouteTicksCache:
+    """
+    Route tick data keyed by route ID, with each route on the shard shard_index places it on.
+    Route lookups and changes go to the route's shard, commits and queries over many routes
+    are split by shard and their results combined.
+    """
+
+    def __init__(self, shards, legacy_json_file=None) -> None:
+        self.cache_db_file = ','.join(shards)
+        self.shards = [RemoteRouteShard(shard) if is_remote_shard(shard) else RouteTicksCache(shard)
+                       for shard in shards]
+        self.lock = threading.RLock()
+        self.users = ShardedUserTable(self.shards)
+        if legacy_json_file is not None:
+            self.import_json(legacy_json_file)
+
+    def __contains__(self, route_id):
+        return route_id in self.shard(route_id)
+
+    def __getitem__(self, route_id):
+        return self.shard(route_id)[route_id]
+
+    @property
+    def record_lookups(self):
+        """Whether lookups are recorded, set on every shard"""
+        return all(shard.record_lookups for shard in self.shards)
+
+    @record_lookups.setter
+    def record_lookups(self, record_lookups):
+        for shard in self.shards:
+            shard.record_lookups = record_lookups
+
+    def shard(self, route_id):
+        """The shard a route is placed on"""
+        return self.shards[shard_index(route_id, len(self.shards))]
+
+    def shard_route_ids(self, route_ids):
+        """Split route_ids by shard, as shard to the route IDs placed on it"""
+        shard_route_ids = {}
+        for route_id in route_ids:
+            shard_route_ids.setdefault(shard_index(route_id, len(self.shards)), []).append(route_id)
+        return {self.shards[shard_i]: shard_ids for shard_i, shard_ids in shard_route_ids.items()}
+
+    def get(self, route_id, default=None):
+        """Get a route from its shard"""
+        return self.shard(route_id).get(route_id, default)
+
+    def reload(self, route_id):
+        """Drop a loaded route without unsaved changes and read it again from its shard"""
+        return self.shard(route_id).reload(route_id)
+
+    def route_ids(self):
+        """Get all cached route IDs"""
+        return [route_id for shard in self.shards for route_id in shard.route_ids()]
+
+    def iter_route_user_ids(self):
+        """Yield each saved route ID with the IDs of the users who ticked it, a shard at a time"""
+        return itertools.chain.from_iterable(shard.iter_route_user_ids() for shard in self.shards)
+
+    def user_names(self, user_ids):
+        """Get the cached names of user IDs from every shard"""
+        names = {}
+        for shard in self.shards:
+            names.update(shard.user_names([user_id for user_id in user_ids if str(user_id) not in names]))
+        return names
+
+    def user_route_counts(self, user_ids):
+        """Count the saved routes of each user ID on every shard, in the order of user_ids"""
+        counts = np.zeros(len(user_ids), dtype=np.int64)
+        for shard in self.shards:
+            counts += np.array(shard.user_route_counts(user_ids), dtype=np.int64)
+        return counts.tolist()
+
+    def user_route_pairs(self, user_ids):
+        """Saved route ID and user ID of every route ticked by user_ids on every shard"""
+        return np.concatenate([shard.user_route_pairs(user_ids) for shard in self.shards])
+
+    def routes_version(self, route_ids):
+        """Version stamp of the saved data of route_ids, the same as one database with the same routes"""
+        return hash_route_versions(route_ids, self.saved_route_versions(route_ids))
+
+    def saved_route_versions(self, route_ids):
+        """Saved route ID to the fields that change when the route's ticks are updated, from each route's shard"""
+        route_versions = {}
+        for shard, shard_ids in self.shard_route_ids(route_ids).items():
+            route_versions.update(shard.saved_route_versions(shard_ids))
+        return route_versions
+
+    def update_route(self, route_id, **route_fields):
+        """Create or update a route's fields on its shard"""
+        with self.lock:
+            self.shard(route_id).update_route(route_id, **route_fields)
+
+    def add_user_ticks(self, route_id, user_ticks):
+        """Add users to a route's tick list on its shard"""
+        with self.lock:
+            self.shard(route_id).add_user_ticks(route_id, user_ticks)
+
+    def replace_user_ticks(self, route_id, user_ticks):
+        """Replace a route's tick list on its shard"""
+        with self.lock:
+            self.shard(route_id).replace_user_ticks(route_id, user_ticks)
+
+    def commit(self, route_ids=None):
+        """Write changed routes to their shards, only route_ids if given"""
+        with self.lock:
+            if route_ids is None:
+                for shard in self.shards:
+                    shard.commit()
+            else:
+                for shard, shard_ids in self.shard_route_ids(route_ids).items():
+                    shard.commit(shard_ids)
+
+    def routes_to_warm(self, now, checked_before, accessed_after, limit):
+        """The limit highest scored routes to warm across shards, as route ID, name and score"""
+        shard_routes = [shard.routes_to_warm(now, checked_before, accessed_after, limit) for shard in self.shards]
+        return heapq.nsmallest(limit, itertools.chain.from_iterable(shard_routes),
+                               key=lambda route: (-route[2], route[0]))
+
+    def eviction_candidates(self, max_age_mins, max_route_users):
+        """Saved routes to evict from every shard, each shard keeps an equal part of max_route_users"""
+        return [evicted_route for shard in self.shards
+                for evicted_route in shard.eviction_candidates(max_age_mins, max_route_users // len(self.shards))]
+
+    def delete_route(self, route_id):
+        """Delete a route and its users from its shard"""
+        with self.lock:
+            self.shard(route_id).delete_route(route_id)
+
+    def size_stats(self):
+        """Sizes and row counts added up over the shards"""
+        size_stats = {"bytes": 0, "free_bytes": 0, "routes": 0, "route_users": 0}
+        for shard in self.shards:
+            for stat, value in shard.size_stats().items():
+                size_stats[stat] += value
+        return size_stats
+
+    def vacuum(self):
+        """Vacuum every shard"""
+        for shard in self.shards:
+            shard.vacuum()
+
+    def is_empty(self):
+        """Check if no routes are saved on any shard"""
+        return all(shard.is_empty() for shard in self.shards)
+
+    def import_json(self, json_file):
+        """Import a route_ticks_cache.json file, each route into its shard, if no shard has routes"""
+        if self.is_empty() is False:
+            return
+        json_data = read_route_ticks_json(json_file)
+        if json_data is None:
+            return
+        for shard, shard_ids in self.shard_route_ids(json_data).items():
+            shard.import_routes({route_id: json_data[route_id] for route_id in shard_ids})
+        logging.info("Imported %s routes into %s shards", len(json_data), len(self.shards))
+
+    def close(self):
+        """Close every shard"""
+        for shard in self.shards:
+            shard.close()
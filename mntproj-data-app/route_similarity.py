@@ -0,0 +1,203 @@
+"""Route by user incidence matrix for finding users with the most routes in common"""
+
+import heapq
+import sys
+
+import numpy as np
+
+from route_cache import USER_ID_DTYPE
+
+# overlap: shared routes / user's routes, jaccard: shared / union, cosine: shared / sqrt(product of totals),
+# idf: shared routes weighted by log(1 + users / route's Mountain Project tick total), over user's own weighted routes.
+# Other users' totals for jaccard and cosine are their routes in the cache, not their whole tick lists.
+SIMILARITY_METRICS = ("overlap", "jaccard", "cosine", "idf")
+
+
+class RouteUserMatrix:
+    """
+    Sparse route x user incidence matrix in CSR form.
+    Row i holds the column indices of the users who ticked route_ids[i],
+    columns are numbered in the order users are first seen.
+    user_ids is an array of the user ID of each column, names are looked up in the cache's users table.
+    route_tick_totals is each row's tick total on Mountain Project when last checked.
+    """
+
+    def __init__(self, route_ids, indptr, indices, user_ids, users, route_tick_totals) -> None:
+        self.route_ids = route_ids
+        self.route_index = {route_id: row for row, route_id in enumerate(route_ids)}
+        self.indptr = indptr
+        self.indices = indices
+        self.user_ids = user_ids
+        self.users = users
+        self.route_tick_totals = route_tick_totals
+        self.nnz_rows = np.repeat(np.arange(len(route_ids), dtype=np.int32), np.diff(indptr))
+
+    @classmethod
+    def from_cache(cls, route_ticks_cached_data, route_ids):
+        """Build the matrix from the cached user ID arrays of route_ids"""
+        matrix_route_ids = []
+        route_user_ids = []
+        route_tick_totals = []
+        for route_id in route_ids:
+            route = route_ticks_cached_data.get(route_id)
+            if route is None:
+                continue
+            matrix_route_ids.append(route_id)
+            route_user_ids.append(route.user_ids)
+            route_tick_totals.append(route.last_total_mp or 0)
+        indptr = np.zeros(len(route_user_ids) + 1, dtype=np.int64)
+        np.cumsum([len(user_ids) for user_ids in route_user_ids], out=indptr[1:])
+        all_user_ids = np.concatenate(route_user_ids) if route_user_ids else np.array([], dtype=USER_ID_DTYPE)
+
+        # Number the columns by where each user is first seen
+        unique_user_ids, first_seen, unique_cols = np.unique(all_user_ids, return_index=True, return_inverse=True)
+        first_seen_order = np.argsort(first_seen, kind='stable')
+        cols = np.empty(len(unique_user_ids), dtype=np.int32)
+        cols[first_seen_order] = np.arange(len(unique_user_ids), dtype=np.int32)
+        return cls(matrix_route_ids, indptr, cols[unique_cols], unique_user_ids[first_seen_order],
+                   route_ticks_cached_data.users, np.array(route_tick_totals, dtype=np.int64))
+
+    def user_col(self, user_id):
+        """Column of a user ID, None if the user is not in the matrix"""
+        cols = np.flatnonzero(self.user_ids == int(user_id))
+        return int(cols[0]) if len(cols) > 0 else None
+
+    def user_name(self, user_col):
+        """Name of the user in a column"""
+        return self.users.name(self.user_ids[user_col])
+
+    def route_vector(self, route_ids):
+        """Indicator vector over the matrix rows for route_ids"""
+        route_vector = np.zeros(len(self.route_ids))
+        rows = [self.route_index[route_id] for route_id in route_ids if route_id in self.route_index]
+        route_vector[rows] = 1
+        return route_vector
+
+    def overlap_counts(self, route_ids):
+        """Count routes in common with route_ids for every user, one sparse transposed mat-vec"""
+        route_vector = self.route_vector(route_ids)
+        counts = np.bincount(self.indices, weights=route_vector[self.nnz_rows], minlength=len(self.user_ids))
+        return counts.astype(np.int64)
+
+    def idf_weighted_counts(self, route_ids):
+        """
+        Shared routes for every user with each route weighted by the inverse of its tick total,
+        at least the route's user count in case ticks were added since it was last checked
+        """
+        route_ticks = np.maximum(self.route_tick_totals, np.diff(self.indptr))
+        route_weights = np.log1p(len(self.user_ids) / np.maximum(route_ticks, 1))
+        route_vector = self.route_vector(route_ids) * route_weights
+        return np.bincount(self.indices, weights=route_vector[self.nnz_rows], minlength=len(self.user_ids))
+
+    def total_scores(self, counts, user_total, metric, limit, user_route_counts, block_size=500):
+        """
+        Jaccard or cosine scores, which need each user's total route count from user_route_counts.
+        The cache only has the routes scraped for someone, so a user's total is the routes they ticked
+        among those, not their whole tick list, and scores are close to overlap when few of their routes are cached.
+        Users are scored in blocks by descending shared count, stopping once no later user can reach
+        the current top limit, since jaccard <= shared / user_total and cosine <= sqrt(shared / user_total).
+        Users not scored are left at 0.
+        """
+        scores = np.zeros(len(counts))
+        kth_score = -1.0
+        order = np.argsort(-counts, kind='stable')
+        for start in range(0, len(order), block_size):
+            block = order[start:start + block_size]
+            max_score = counts[block[0]] / user_total
+            if metric == "cosine":
+                max_score = np.sqrt(max_score)
+            if max_score < kth_score:
+                break
+            block_counts = counts[block]
+            block_totals = np.maximum(user_route_counts(self.user_ids[block].tolist()), block_counts)
+            if metric == "jaccard":
+                scores[block] = block_counts / (user_total + block_totals - block_counts)
+            else:
+                scores[block] = block_counts / np.sqrt(user_total * block_totals)
+            scored = order[:start + len(block)]
+            if len(scored) >= limit:
+                kth_score = np.partition(scores[scored], len(scored) - limit)[len(scored) - limit]
+        return scores
+
+    def similarity_scores(self, route_ids, user_col, metric, limit, user_route_counts=None):
+        """
+        Shared route counts and similarity scores against route_ids for every user.
+        user_col is the user's own column, None if the user is not in the matrix.
+        user_route_counts is only needed for jaccard and cosine.
+        """
+        counts = self.overlap_counts(route_ids)
+        user_total = counts[user_col] if user_col is not None else len(route_ids)
+        if metric == "overlap":
+            scores = counts / max(user_total, 1)
+        elif metric == "idf":
+            weighted_counts = self.idf_weighted_counts(route_ids)
+            user_weighted_total = weighted_counts[user_col] if user_col is not None else weighted_counts.max()
+            scores = weighted_counts / max(user_weighted_total, 1e-12)
+        elif metric in ("jaccard", "cosine"):
+            scores = self.total_scores(counts, max(user_total, 1), metric, limit, user_route_counts)
+        else:
+            raise ValueError(f"Unknown similarity metric {metric}")
+        return counts, scores
+
+    def top_users(self, scores, limit):
+        """Column indices of the limit highest scores, ties in the order users were first seen"""
+        cols = self.top_user_cols(scores, limit)
+        return cols[np.lexsort((cols, -scores[cols]))]
+
+    def top_user_cols(self, scores, limit):
+        """Unsorted column indices of the limit highest scores, ties at the limit in the order users were first seen"""
+        limit = min(limit, len(scores))
+        if limit <= 0:
+            return np.array([], dtype=np.int64)
+        kth_score = -np.partition(-scores, limit - 1)[limit - 1]
+        above = np.flatnonzero(scores > kth_score)
+        ties = np.flatnonzero(scores == kth_score)[:limit - len(above)]
+        return np.concatenate((above, ties))
+
+
+class SimilarUsers:
+    """
+    The users most similar to one user, with their shared route counts and scores, kept unsorted.
+    Pages are picked with a heap of the users up to the end of the page, so only those are ordered.
+    Users are ranked like RouteUserMatrix.top_users, by score with ties in the order users were first seen.
+    """
+
+    __slots__ = ("user_ids", "names", "counts", "scores", "cols")
+
+    def __init__(self, user_ids, names, counts, scores, cols) -> None:
+        self.user_ids = user_ids
+        self.names = names
+        self.counts = counts
+        self.scores = scores
+        self.cols = cols
+
+    def __len__(self):
+        return len(self.cols)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sum(sys.getsizeof(column) + sum(sys.getsizeof(value) for value in column)
+                                             for column in (self.user_ids, self.names, self.counts, self.scores,
+                                                            self.cols))
+
+    def to_dict(self):
+        """Columns as a dict of lists, for JSON"""
+        return {column: getattr(self, column) for column in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, columns):
+        """SimilarUsers from to_dict"""
+        return cls(**columns)
+
+    @classmethod
+    def from_scores(cls, route_user_matrix, counts, scores, limit):
+        """Keep the limit users with the highest scores"""
+        cols = route_user_matrix.top_user_cols(scores, limit)
+        return cls(route_user_matrix.user_ids[cols].tolist(), [route_user_matrix.user_name(col) for col in cols],
+                   counts[cols].tolist(), scores[cols].tolist(), cols.tolist())
+
+    def page(self, offset, limit):
+        """Users offset to offset + limit in rank order, as user ID, name, shared route count and score"""
+        ranked = heapq.nsmallest(offset + limit, range(len(self.cols)),
+                                 key=lambda user_i: (-self.scores[user_i], self.cols[user_i]))
+        return [(self.user_ids[user_i], self.names[user_i], self.counts[user_i], self.scores[user_i])
+                for user_i in ranked[offset:]]
@@ -0,0 +1,174 @@
+"""
+Memory mapped snapshot of the route cache's route users.
+Written next to the cache database, the snapshot holds each route's sorted user IDs in CSR form
+and every user's name, in flat arrays after a JSON header. Readers map the arrays instead of reading them,
+so opening it takes the same time whatever its size, and processes on a host share its pages.
+A route is only read from the snapshot while its version matches the database.
+"""
+
+import hashlib
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import struct
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from constants import TIMESTAMP_STR_FORMAT
+
+SNAPSHOT_MAGIC = b"MPSNAP01"
+SNAPSHOT_ALIGN = 64
+SNAPSHOT_ARRAYS = ("route_ids", "route_versions", "indptr", "user_ids", "user_table_ids", "name_offsets",
+                   "name_bytes")
+
+# Snapshots already mapped in this process by file name, with the file's inode and mtime
+_open_snapshots = {}
+_open_snapshots_lock = threading.Lock()
+
+
+def snapshot_file_for(cache_db_file):
+    """Snapshot file name of a cache database"""
+    return os.path.splitext(cache_db_file)[0] + '.snapshot'
+
+
+def route_version(cache_last_updated, last_total_mp, newest_tick_id):
+    """64 bit version of a route's saved users, changes whenever the route's ticks are updated"""
+    version_hash = hashlib.blake2b(repr((cache_last_updated, last_total_mp, newest_tick_id)).encode(),
+                                   digest_size=8)
+    return int.from_bytes(version_hash.digest(), 'little')
+
+
+class RouteSnapshot:
+    """Read only view of a snapshot file, arrays are memory mapped"""
+
+    def __init__(self, snapshot_file, header, arrays) -> None:
+        self.snapshot_file = snapshot_file
+        self.created = header["created"]
+        self.route_ids = arrays["route_ids"]
+        self.route_versions = arrays["route_versions"]
+        self.indptr = arrays["indptr"]
+        self.user_ids = arrays["user_ids"]
+        self.user_table_ids = arrays["user_table_ids"]
+        self.name_offsets = arrays["name_offsets"]
+        self.name_bytes = arrays["name_bytes"]
+
+    def __len__(self):
+        return len(self.route_ids)
+
+    @classmethod
+    def open(cls, snapshot_file):
+        """Map a snapshot file, returns None if it is missing or not valid"""
+        try:
+            file_stat = os.stat(snapshot_file)
+        except FileNotFoundError:
+            return None
+        with _open_snapshots_lock:
+            open_snapshot = _open_snapshots.get(snapshot_file)
+            if open_snapshot is not None and open_snapshot[0] == (file_stat.st_ino, file_stat.st_mtime_ns):
+                return open_snapshot[1]
+            try:
+                with open(snapshot_file, 'rb') as open_snapshot_file:
+                    if open_snapshot_file.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                        raise ValueError("not a route snapshot")
+                    header_len, = struct.unpack("<Q", open_snapshot_file.read(8))
+                    header = json.loads(open_snapshot_file.read(header_len))
+                arrays = {name: np.memmap(snapshot_file, dtype=array["dtype"], mode='r', offset=array["offset"],
+                                          shape=tuple(array["shape"])) if array["shape"][0] > 0
+                          else np.empty(tuple(array["shape"]), dtype=array["dtype"])
+                          for name, array in header["arrays"].items()}
+            except (OSError, ValueError, KeyError, struct.error) as err:
+                logging.error("Not using snapshot %s: %s", snapshot_file, err)
+                return None
+            snapshot = cls(snapshot_file, header, arrays)
+            _open_snapshots[snapshot_file] = ((file_stat.st_ino, file_stat.st_mtime_ns), snapshot)
+        logging.info("Mapped snapshot %s with %s routes", snapshot_file, len(snapshot))
+        return snapshot
+
+    def route_user_ids(self, route_id, version):
+        """A route's sorted user IDs as a read only array, None if not in the snapshot or the version differs"""
+        try:
+            route_key = int(route_id)
+        except ValueError:
+            return None
+        route_i = np.searchsorted(self.route_ids, route_key)
+        if route_i == len(self.route_ids) or self.route_ids[route_i] != route_key or\
+        self.route_versions[route_i] != version:
+            return None
+        return self.user_ids[self.indptr[route_i]:self.indptr[route_i + 1]]
+
+    def user_name(self, user_id):
+        """A user's name, None if not in the snapshot"""
+        user_i = np.searchsorted(self.user_table_ids, user_id)
+        if user_i == len(self.user_table_ids) or self.user_table_ids[user_i] != user_id:
+            return None
+        return bytes(self.name_bytes[self.name_offsets[user_i]:self.name_offsets[user_i + 1]]).decode()
+
+
+def write_snapshot(cache_db_file, snapshot_file=None):
+    """
+    Write a snapshot of a cache database, read in one transaction so routes and users match.
+    The file is written under a temporary name and renamed, processes with the old one mapped keep it.
+    Returns the number of routes written.
+    """
+
+    snapshot_file = snapshot_file or snapshot_file_for(cache_db_file)
+    conn = sqlite3.connect(cache_db_file, timeout=60)
+    try:
+        conn.execute("BEGIN")
+        route_rows = conn.execute(
+            "SELECT CAST(route_id AS INTEGER), cache_last_updated, last_total_mp, newest_tick_id FROM routes"
+            " ORDER BY 1").fetchall()
+        route_users = np.fromiter(itertools.chain.from_iterable(conn.execute(
+            "SELECT CAST(route_id AS INTEGER), CAST(user_id AS INTEGER) FROM route_users ORDER BY 1, 2")),
+            dtype=np.int64).reshape(-1, 2)
+        user_rows = conn.execute(
+            "SELECT CAST(user_id AS INTEGER), MAX(user_name) FROM route_users GROUP BY 1 ORDER BY 1").fetchall()
+        conn.rollback()
+    finally:
+        conn.close()
+
+    route_ids = np.fromiter((route_id for route_id, *_ in route_rows), dtype=np.int64, count=len(route_rows))
+    route_versions = np.fromiter((route_version(*route_row[1:]) for route_row in route_rows), dtype=np.uint64,
+                                 count=len(route_rows))
+    # Route users of routes missing from the routes table are left out
+    route_users = route_users[np.isin(route_users[:, 0], route_ids)]
+    indptr = np.append(np.searchsorted(route_users[:, 0], route_ids), len(route_users)).astype(np.int64)
+    user_names = [(user_name or '').encode() for _, user_name in user_rows]
+    name_offsets = np.zeros(len(user_names) + 1, dtype=np.int64)
+    np.cumsum([len(user_name) for user_name in user_names], out=name_offsets[1:])
+
+    arrays = {"route_ids": route_ids,
+              "route_versions": route_versions,
+              "indptr": indptr,
+              "user_ids": np.ascontiguousarray(route_users[:, 1]),
+              "user_table_ids": np.fromiter((user_id for user_id, _ in user_rows), dtype=np.int64,
+                                            count=len(user_rows)),
+              "name_offsets": name_offsets,
+              "name_bytes": np.frombuffer(b''.join(user_names), dtype=np.uint8)}
+
+    # Array offsets depend on the header length, so lay out the arrays after a header of fixed size
+    header = {"created": datetime.now().strftime(TIMESTAMP_STR_FORMAT), "cache_db_file": cache_db_file,
+              "arrays": {name: {"dtype": arrays[name].dtype.str, "shape": list(arrays[name].shape), "offset": 0}
+                         for name in SNAPSHOT_ARRAYS}}
+    header_len = len(json.dumps(header)) + 32 * len(SNAPSHOT_ARRAYS)
+    offset = -(-(len(SNAPSHOT_MAGIC) + 8 + header_len) // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+    for name in SNAPSHOT_ARRAYS:
+        header["arrays"][name]["offset"] = offset
+        offset += -(-arrays[name].nbytes // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+    header_bytes = json.dumps(header).encode().ljust(header_len)
+
+    tmp_snapshot_file = f"{snapshot_file}.{os.getpid()}.tmp"
+    with open(tmp_snapshot_file, 'wb') as open_snapshot_file:
+        open_snapshot_file.write(SNAPSHOT_MAGIC + struct.pack("<Q", header_len) + header_bytes)
+        for name in SNAPSHOT_ARRAYS:
+            open_snapshot_file.seek(header["arrays"][name]["offset"])
+            open_snapshot_file.write(arrays[name].tobytes())
+        open_snapshot_file.truncate(offset)
+    os.replace(tmp_snapshot_file, snapshot_file)
+    logging.info("Wrote snapshot %s with %s routes and %s route users", snapshot_file, len(route_ids),
+                 len(route_users))
+    return len(route_ids)
@@ -0,0 +1,405 @@
+"""Background jobs for Mountain Project scrapes"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from constants import TIMESTAMP_STR_FORMAT, SCRAPE_JOB_POLL_SECS, SCRAPE_JOB_STALE_MINS
+from constants import SCRAPE_JOB_HEARTBEAT_SECS
+from route_similarity import SimilarUsers
+
+JOB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    mp_uid TEXT NOT NULL,
+    mp_name TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    status TEXT NOT NULL,
+    routes_done INTEGER NOT NULL DEFAULT 0,
+    routes_total INTEGER NOT NULL DEFAULT 0,
+    partial_results TEXT,
+    results TEXT,
+    similar_users TEXT,
+    route_ids TEXT,
+    routes_version TEXT,
+    error TEXT,
+    submitted TEXT NOT NULL,
+    finished TEXT,
+    owner_pid INTEGER,
+    updated TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (mp_uid, metric, submitted);
+"""
+
+JOB_COLUMNS = ("job_id", "mp_uid", "mp_name", "metric", "status", "routes_done", "routes_total", "partial_results",
+               "results", "similar_users", "route_ids", "routes_version", "error", "submitted", "finished", "owner_pid",
+               "version")
+JOB_COLUMNS_ADDED = {"route_ids": "TEXT", "routes_version": "TEXT", "owner_pid": "INTEGER"}
+JSON_COLUMNS = ("partial_results", "results", "route_ids")
+ACTIVE_STATUSES = ("queued", "running")
+
+
+class ScrapeJob:
+    """
+    State and progress of one scrape of a user's tick list.
+    The process running the job writes each change to the job store and wakes up its own waiters,
+    jobs read from the store by other processes poll it for changes.
+    """
+
+    def __init__(self, mp_uid, mp_name, metric, store=None, job_id=None) -> None:
+        self.job_id = job_id or uuid.uuid4().hex
+        self.mp_uid = mp_uid
+        self.mp_name = mp_name
+        self.metric = metric
+        self.store = store
+        self.owned = job_id is None
+        self.status = "queued"
+        self.routes_done = 0
+        self.routes_total = 0
+        self.partial_results = None
+        self.results = None
+        self.similar_users = None
+        self.route_ids = None
+        self.routes_version = None
+        self.error = None
+        self.submitted = datetime.now()
+        self.finished = None
+        self.owner_pid = os.getpid()
+        self.version = 0
+        self.changed = threading.Condition()
+
+    def notify_changed(self, *columns):
+        """Save the changed columns to the job store and wake up anything waiting for the job to change"""
+        with self.changed:
+            self.version += 1
+            if self.store is not None:
+                self.store.save(self, columns)
+            self.changed.notify_all()
+
+    def wait_for_change(self, version, timeout):
+        """Wait until the job changes from version, or timeout seconds, returns the current version"""
+        if self.owned or self.store is None:
+            with self.changed:
+                self.changed.wait_for(lambda: self.version != version, timeout)
+                return self.version
+        end_time = time.monotonic() + timeout
+        while True:
+            self.store.refresh(self)
+            remaining = end_time - time.monotonic()
+            if self.version != version or remaining <= 0:
+                return self.version
+            time.sleep(min(SCRAPE_JOB_POLL_SECS, remaining))
+
+    def update_progress(self, routes_done, routes_total):
+        """Progress callback for start_scrape_mntproj"""
+        self.routes_done = routes_done
+        self.routes_total = routes_total
+        self.notify_changed("routes_done", "routes_total")
+
+    def update_partial_results(self, partial_results):
+        """Partial results callback for start_scrape_mntproj"""
+        self.partial_results = partial_results
+        self.notify_changed("partial_results")
+
+    def set_similar_users(self, similar_users):
+        """Similar users callback for start_scrape_mntproj, for the JSON API, saved when the job finishes"""
+        self.similar_users = similar_users
+
+    def set_cached_routes(self, route_ids, routes_version):
+        """Cached callback for start_scrape_mntproj, saved when the job finishes for other processes to reuse"""
+        self.route_ids = list(route_ids)
+        self.routes_version = routes_version
+
+    def to_dict(self):
+        """Job status for the status endpoint"""
+        return {"job_id": self.job_id,
+                "uid": self.mp_uid,
+                "name": self.mp_name,
+                "metric": self.metric,
+                "status": self.status,
+                "routes_done": self.routes_done,
+                "routes_total": self.routes_total,
+                "error": self.error}
+
+
+class ScrapeJobStore:
+    """
+    Job status and results in a SQLite database shared by every worker process on the host,
+    so any worker can report on a job whichever one runs it.
+    Running jobs whose heartbeat is older than SCRAPE_JOB_STALE_MINS, and queued jobs whose owning process
+    has exited, are marked failed, as nothing will finish them.
+    """
+
+    def __init__(self, job_db_file) -> None:
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(job_db_file, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(JOB_SCHEMA)
+        self.add_missing_columns()
+
+    def add_missing_columns(self):
+        """Add columns missing from a database created by an older version"""
+        job_columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        for column, column_type in JOB_COLUMNS_ADDED.items():
+            if column not in job_columns:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+
+    @staticmethod
+    def column_value(job, column):
+        """A job attribute as stored in its column"""
+        value = getattr(job, column)
+        if column in JSON_COLUMNS:
+            return json.dumps(value) if value is not None else None
+        if column == "similar_users":
+            return json.dumps(value.to_dict()) if value is not None else None
+        if column in ("submitted", "finished"):
+            return value.strftime(TIMESTAMP_STR_FORMAT) if value is not None else None
+        return value
+
+    @staticmethod
+    def load_column(job, column, value):
+        """Set a job attribute from its stored column"""
+        if value is not None and column in JSON_COLUMNS:
+            value = json.loads(value)
+            if column == "partial_results" and value == job.partial_results:
+                return
+        elif value is not None and column == "similar_users":
+            value = SimilarUsers.from_dict(json.loads(value))
+        elif value is not None and column in ("submitted", "finished"):
+            value = datetime.strptime(value, TIMESTAMP_STR_FORMAT)
+        setattr(job, column, value)
+
+    def job_from_row(self, row):
+        """ScrapeJob from a jobs table row"""
+        job = ScrapeJob(row[1], row[2], row[3], self, row[0])
+        for column, value in zip(JOB_COLUMNS[4:], row[4:]):
+            self.load_column(job, column, value)
+        return job
+
+    def add_or_get_active(self, job, stale_time):
+        """Add a queued job, or get the active job for its UID and metric if there is one"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.mark_stale(stale_time)
+                row = self.conn.execute(
+                    f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE mp_uid = ? AND metric = ? AND status IN (?, ?)"
+                    " ORDER BY submitted DESC LIMIT 1", (job.mp_uid, job.metric, *ACTIVE_STATUSES)).fetchone()
+                if row is None:
+                    self.conn.execute(f"INSERT INTO jobs ({', '.join(JOB_COLUMNS)}, updated)"
+                                      f" VALUES ({', '.join('?' * len(JOB_COLUMNS))}, ?)",
+                                      (*(self.column_value(job, column) for column in JOB_COLUMNS),
+                                       datetime.now().strftime(TIMESTAMP_STR_FORMAT)))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return self.job_from_row(row) if row is not None else None
+
+    def save(self, job, columns):
+        """Write a job's changed columns"""
+        columns = (*columns, "version")
+        with self.lock:
+            self.conn.execute(f"UPDATE jobs SET {', '.join(f'{column} = ?' for column in columns)}, updated = ?"
+                              " WHERE job_id = ?",
+                              (*(self.column_value(job, column) for column in columns),
+                               datetime.now().strftime(TIMESTAMP_STR_FORMAT), job.job_id))
+
+    def start(self, job):
+        """Mark a queued job running, returns False if it is no longer queued"""
+        with self.lock:
+            return self.conn.execute(
+                "UPDATE jobs SET status = 'running', updated = ? WHERE job_id = ? AND status = 'queued'",
+                (datetime.now().strftime(TIMESTAMP_STR_FORMAT), job.job_id)).rowcount == 1
+
+    def heartbeat(self, job_ids):
+        """Record that running jobs are still running"""
+        with self.lock:
+            now = datetime.now().strftime(TIMESTAMP_STR_FORMAT)
+            self.conn.executemany("UPDATE jobs SET updated = ? WHERE job_id = ? AND status = 'running'",
+                                  ((now, job_id) for job_id in job_ids))
+
+    def latest_finished(self, mp_uid, metric, finished_after):
+        """
+        Get the most recently finished job for a UID and metric with reusable results,
+        None if none finished after finished_after
+        """
+        with self.lock:
+            row = self.conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE mp_uid = ? AND metric = ?"
+                                    " AND status = 'finished' AND routes_version IS NOT NULL AND finished >= ?"
+                                    " ORDER BY finished DESC LIMIT 1",
+                                    (mp_uid, metric, finished_after.strftime(TIMESTAMP_STR_FORMAT))).fetchone()
+        return self.job_from_row(row) if row is not None else None
+
+    def get(self, job_id):
+        """Get a job by ID, None if not found"""
+        with self.lock:
+            row = self.conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE job_id = ?",
+                                    (job_id,)).fetchone()
+        return self.job_from_row(row) if row is not None else None
+
+    def latest(self, mp_uid, metric):
+        """Get the most recently submitted job for a UID and metric, None if there is none"""
+        with self.lock:
+            row = self.conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE mp_uid = ? AND metric = ?"
+                                    " ORDER BY submitted DESC LIMIT 1", (mp_uid, metric)).fetchone()
+        return self.job_from_row(row) if row is not None else None
+
+    def refresh(self, job):
+        """Reload a job from the store if its version changed"""
+        with self.lock:
+            row = self.conn.execute("SELECT version FROM jobs WHERE job_id = ?", (job.job_id,)).fetchone()
+            if row is None or row[0] == job.version:
+                return
+            row = self.conn.execute(f"SELECT {', '.join(JOB_COLUMNS[4:])} FROM jobs WHERE job_id = ?",
+                                    (job.job_id,)).fetchone()
+        for column, value in zip(JOB_COLUMNS[4:], row):
+            self.load_column(job, column, value)
+
+    def has_active(self):
+        """Check if any job is queued or running"""
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM jobs WHERE status IN (?, ?) LIMIT 1",
+                                     ACTIVE_STATUSES).fetchone() is not None
+
+    @staticmethod
+    def process_exists(pid):
+        """Check if a process is still running on this host"""
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def mark_stale(self, stale_time):
+        """
+        Mark running jobs without a heartbeat since stale_time failed,
+        and queued jobs whose owning process has exited, or with no owner and not updated since stale_time.
+        Queued jobs of a live process are only waiting for one of its workers.
+        """
+        with self.lock:
+            now = datetime.now().strftime(TIMESTAMP_STR_FORMAT)
+            stale_time = stale_time.strftime(TIMESTAMP_STR_FORMAT)
+            queued_jobs = self.conn.execute("SELECT job_id, owner_pid, updated FROM jobs WHERE status = 'queued'")
+            stale_job_ids = [job_id for job_id, owner_pid, updated in queued_jobs
+                             if (updated < stale_time if owner_pid is None else not self.process_exists(owner_pid))]
+            stale_job_ids += [row[0] for row in self.conn.execute(
+                "SELECT job_id FROM jobs WHERE status = 'running' AND updated < ?", (stale_time,))]
+            self.conn.executemany("UPDATE jobs SET status = 'failed', error = 'Job stopped responding', finished = ?,"
+                                  " version = version + 1, updated = ? WHERE job_id = ? AND status IN (?, ?)",
+                                  ((now, now, job_id, *ACTIVE_STATUSES) for job_id in stale_job_ids))
+
+    def prune(self, expired_time):
+        """Delete jobs that finished before expired_time"""
+        with self.lock:
+            self.conn.execute("DELETE FROM jobs WHERE finished < ?", (expired_time.strftime(TIMESTAMP_STR_FORMAT),))
+
+
+class ScrapeJobQueue:
+    """
+    Bounded pool of background scrapes.
+    Submitting a UID and metric that already have a queued or running job returns that job,
+    whichever worker process is running it.
+    Job status and results are kept in a ScrapeJobStore, jobs running in this process are also kept in memory.
+    A heartbeat thread, started with the first job, records every SCRAPE_JOB_HEARTBEAT_SECS
+    that this process's running jobs are still running.
+    """
+
+    def __init__(self, scrape_function, max_workers, retention_mins, job_db_file) -> None:
+        self.scrape_function = scrape_function
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scrape-job")
+        self.retention = timedelta(minutes=retention_mins)
+        self.store = ScrapeJobStore(job_db_file)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.heartbeat_thread = None
+
+    def submit(self, mp_uid, mp_name, metric):
+        """Queue a scrape for a user, or return the user's active job"""
+        self.prune_jobs()
+        job = ScrapeJob(mp_uid, mp_name, metric, self.store)
+        with self.lock:
+            active_job = self.store.add_or_get_active(job, datetime.now() - timedelta(minutes=SCRAPE_JOB_STALE_MINS))
+            if active_job is not None:
+                logging.info("Scrape job %s already active for %s", active_job.job_id, mp_uid)
+                return self.jobs.get(active_job.job_id, active_job)
+            self.jobs[job.job_id] = job
+            self.start_heartbeat()
+        logging.info("Queueing scrape job %s for %s:%s", job.job_id, mp_name, mp_uid)
+        self.executor.submit(self.run_job, job)
+        return job
+
+    def start_heartbeat(self):
+        """Start the heartbeat thread if it is not running, called with the lock held"""
+        if self.heartbeat_thread is None or not self.heartbeat_thread.is_alive():
+            self.heartbeat_thread = threading.Thread(target=self.heartbeat, name="scrape-job-heartbeat", daemon=True)
+            self.heartbeat_thread.start()
+
+    def heartbeat(self):
+        """Record that this process's running jobs are still running, until the process exits"""
+        while True:
+            time.sleep(SCRAPE_JOB_HEARTBEAT_SECS)
+            with self.lock:
+                job_ids = [job.job_id for job in self.jobs.values() if job.status == "running"]
+            try:
+                self.store.heartbeat(job_ids)
+            except sqlite3.Error:
+                logging.exception("Scrape job heartbeat could not be saved")
+
+    def busy(self):
+        """Check if any job is queued or running in any worker process"""
+        self.store.mark_stale(datetime.now() - timedelta(minutes=SCRAPE_JOB_STALE_MINS))
+        return self.store.has_active()
+
+    def get(self, job_id):
+        """Get a job by ID, None if not found"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+        return job if job is not None else self.store.get(job_id)
+
+    def latest(self, mp_uid, metric):
+        """Get the most recently submitted job for a UID and metric that is still kept, None if there is none"""
+        job = self.store.latest(mp_uid, metric)
+        if job is None:
+            return None
+        with self.lock:
+            return self.jobs.get(job.job_id, job)
+
+    def run_job(self, job):
+        """Run a scrape job in a worker thread"""
+        try:
+            if self.store.start(job) is False:
+                logging.info("Scrape job %s is no longer queued", job.job_id)
+                return
+            job.status = "running"
+            job.notify_changed("status")
+            try:
+                job.results = self.scrape_function(job.mp_uid, job.mp_name, progress=job.update_progress,
+                                                   metric=job.metric, partial=job.update_partial_results,
+                                                   similar=job.set_similar_users, cached=job.set_cached_routes)
+                job.status = "finished"
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                logging.exception("Scrape job %s failed", job.job_id)
+                job.error = str(err) or type(err).__name__
+                job.status = "failed"
+            job.finished = datetime.now()
+            job.notify_changed("status", "results", "similar_users", "route_ids", "routes_version", "error", "finished")
+        except sqlite3.Error:
+            logging.exception("Scrape job %s could not be saved", job.job_id)
+        finally:
+            with self.lock:
+                self.jobs.pop(job.job_id, None)
+
+    def prune_jobs(self):
+        """Forget jobs that finished longer ago than the retention time"""
+        self.store.prune(datetime.now() - self.retention)
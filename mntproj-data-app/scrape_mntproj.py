@@ -8,6 +8,9 @@ python scrape_mntproj.py thomas-anderson 60
 
 Options:
 -n  Try to use cached user's csv file
+-r  Resume an unfinished run, skipping routes it already refreshed
+-m  Similarity metric: overlap (default), jaccard, cosine or idf
+    python scrape_mntproj.py thomas-anderson -m jaccard
 
 MNTPROJ_USER_IDS_FILE yaml file example:
 thomas-anderson: 123456789
@@ -17,24 +20,42 @@ suzy-bishop: 000000002
 import json
 import os
 import logging
+import sqlite3
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from json import JSONDecodeError
 
-import pandas as pd
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
 
 from constants import USER_TICK_CSV_DIR
-from constants import MNTPROJ_USER_IDS_FILE, ROUTE_TICKS_CACHE_FILE
-from constants import MNT_PROJ_BASE_URL, API_V2_ROUTES
+from constants import MNTPROJ_USER_IDS_FILE, ROUTE_TICKS_CACHE_FILE, ROUTE_TICKS_CACHE_DB
+from constants import MNT_PROJ_BASE_URL, API_V2_ROUTES, ROUTE_TICKS_PER_PAGE
 from constants import TIMESTAMP_STR_FORMAT
 from constants import LOG_DIR , LOG_FILE_SCRAPE_MNTPROJ, LOG_FORMAT
 from constants import CHECK_MP_LIMIT_MINS, SAME_ROUTE_MAX_LIMIT
-from common_functions import get_csv_file
+from constants import FETCH_WORKERS, FETCH_RATE_INITIAL, FETCH_RATE_MIN, FETCH_RATE_MAX
+from constants import FETCH_RATE_INCREASE, FETCH_RATE_DECREASE
+from constants import CHECKPOINT_DIR, CHECKPOINT_ROUTES, CHECKPOINT_SECS
+from constants import ROUTE_LOCK_DIR, ROUTE_LOCK_STRIPES
+from constants import RESULT_CACHE_TTL_MINS, RESULT_CACHE_MAX_MB, PARTIAL_RESULTS_SECS, API_SIMILAR_MAX_USERS
+from common_functions import get_csv_file, CsvFetchError
+from metrics import METRICS
+from rate_limiter import AdaptiveRateLimiter, parse_retry_after
+from result_cache import ResultCache
+from route_lock import RouteLock
+from route_shards import open_route_cache
+from route_similarity import RouteUserMatrix, SimilarUsers, SIMILARITY_METRICS
+from tick_csv import read_tick_routes
+from user_similarity_index import record_route_users
 
 GET_USER_CSV = True
+RESUME_SCRAPE = False
+SIMILARITY_METRIC = "overlap"
 
 # LOG_LEVEL = logging.DEBUG
 LOG_LEVEL = logging.INFO
@@ -42,219 +63,597 @@ LOG_LEVEL = logging.INFO
 
 LOG_FILE = f"{LOG_DIR}/{LOG_FILE_SCRAPE_MNTPROJ}"
 
+# Shared by all scrapes in this process so concurrent requests stay under the upstream limit
+RATE_LIMITER = AdaptiveRateLimiter(FETCH_RATE_INITIAL, FETCH_RATE_MIN, FETCH_RATE_MAX,
+                                   FETCH_RATE_INCREASE, FETCH_RATE_DECREASE)
+
+# Rankings from earlier scrapes in this process, returned while the user's routes are unchanged
+RESULT_CACHE = ResultCache(RESULT_CACHE_TTL_MINS, RESULT_CACHE_MAX_MB * 1024 * 1024)
+
+class RouteFetchError(Exception):
+    """A route's tick list could not be fetched from Mountain Project"""
+
+
+class RequestBudgetError(RouteFetchError):
+    """A route page was not requested because the scrape's request budget was used up"""
+
+
 class ScrapeMntProj:
-    """Compare users in Mountain Project route tick lists"""
+    """
+    Compare users in Mountain Project route tick lists.
+    With request_budget, route page requests past the budget raise RequestBudgetError instead of being sent.
+    """
 
-    def __init__(self, route_ticks_cache_file, session) -> None:
+    def __init__(self, route_ticks_cache_file, session, rate_limiter=RATE_LIMITER, checkpoint_file=None,
+                 request_budget=None) -> None:
         self.date_time_now = datetime.now()
         self.route_ticks_cache_file = route_ticks_cache_file
         self.route_ticks_cached_data = self.load_cached_data()
-        self.route_user_data = {}
         self.session = session
+        self.rate_limiter = rate_limiter
+        self.checkpoint_file = checkpoint_file
+        self.route_errors = {}
+        self.routes_done = set()
+        self.new_route_users = {}
+        self.page_requests = 0
+        self.page_requests_lock = threading.Lock()
+        self.request_budget = request_budget
 
     def load_cached_data(self):
-        """Load cached route data"""
+        """Open cached route data, routes are loaded as they are looked up"""
         try:
-            with open(self.route_ticks_cache_file, encoding='utf-8') as open_cached_data_file:
-                return json.load(open_cached_data_file)
-        except (PermissionError, JSONDecodeError) as err:
+            with METRICS.timer("phase_seconds", phase="cache_load"):
+                return open_route_cache(self.route_ticks_cache_file, ROUTE_TICKS_CACHE_FILE)
+        except sqlite3.Error as err:
             logging.critical(err)
             sys.exit(1)
-        except FileNotFoundError:
-            logging.error("%s not found, creating empty object", ROUTE_TICKS_CACHE_FILE)
-            return {}
 
-    def dump_cached_data(self):
-        """Dump cached route data"""
+    def load_checkpoint(self):
+        """Load the route IDs refreshed by an unfinished run"""
+        if self.checkpoint_file is None or os.path.isfile(self.checkpoint_file) is False:
+            return set()
+        try:
+            with open(self.checkpoint_file, encoding='utf-8') as open_checkpoint_file:
+                checkpoint = json.load(open_checkpoint_file)
+        except (PermissionError, JSONDecodeError) as err:
+            logging.error(err)
+            logging.error("Not resuming from %s", self.checkpoint_file)
+            return set()
+        logging.info("Resuming run started %s from %s", checkpoint["started"], self.checkpoint_file)
+        return set(checkpoint["routes_done"])
+
+    def save_checkpoint(self, routes_done):
+        """Save changed route data and the route IDs refreshed so far in this run"""
+        self.dump_cached_data()
+        if self.checkpoint_file is None:
+            return
+        checkpoint = {"started": self.date_time_now.strftime(TIMESTAMP_STR_FORMAT),
+                      "routes_done": sorted(routes_done),
+                      "route_errors": self.route_errors}
         try:
-            with open(self.route_ticks_cache_file, 'w', encoding='utf-8') as open_cached_data_file:
-                json.dump(self.route_ticks_cached_data, open_cached_data_file, indent=4)  # use to make human readable
-                # json.dump(self.route_ticks_cached_data, open_cached_data_file)  # use to save space
+            os.makedirs(os.path.dirname(self.checkpoint_file) or '.', exist_ok=True)
+            with open(self.checkpoint_file + '.tmp', 'w', encoding='utf-8') as open_checkpoint_file:
+                json.dump(checkpoint, open_checkpoint_file)
+            os.replace(self.checkpoint_file + '.tmp', self.checkpoint_file)
         except (FileNotFoundError, PermissionError) as err:
+            logging.error(err)
+            logging.error("Not saving checkpoint")
+
+    def remove_checkpoint(self):
+        """Remove the checkpoint file after a run with no route errors"""
+        if self.checkpoint_file is not None and os.path.isfile(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+    def dump_cached_data(self):
+        """Save changed route data"""
+        try:
+            with METRICS.timer("phase_seconds", phase="cache_dump"), self.route_ticks_cached_data.lock:
+                self.route_ticks_cached_data.commit()
+                saved_route_ids = list(self.new_route_users)
+        except sqlite3.Error as err:
             logging.error(err)
             logging.error("Not saving new route data")
+            return
+        self.record_new_route_users(saved_route_ids)
 
-    def cache_route_user_data(self, route_id, route_name, route_ticks_total, route_json_list):
-        """Cache route user data"""
+    def commit_route(self, route_id):
+        """Save a route's changed data"""
+        try:
+            self.route_ticks_cached_data.commit([route_id])
+        except sqlite3.Error as err:
+            logging.error(err)
+            logging.error("Not saving new route data for route/%s", route_id)
+            return
+        self.record_new_route_users([route_id])
+
+    def record_new_route_users(self, route_ids):
+        """Add the saved users of routes to the similar users index's pending file"""
+        for route_id in route_ids:
+            user_ids = self.new_route_users.pop(route_id, None)
+            if user_ids is not None:
+                try:
+                    record_route_users(route_id, user_ids)
+                except OSError as err:
+                    logging.error(err)
+                    logging.error("Not adding route/%s users to the similar users index", route_id)
 
-        logging.debug("Parsing new route data")
-        timestamp = self.date_time_now.strftime(TIMESTAMP_STR_FORMAT)
-        for entry in route_json_list:
-            if entry.get("user") is None or entry["user"] is False:
-                continue
-            user_id2 = entry["user"]["id"]
-            name2 =  entry["user"]["name"]
-            if self.route_user_data.get(route_id) is None:
-                self.route_user_data[route_id] = {"route_name": route_name,
-                                                  "last_total_mp": route_ticks_total,
-                                                  "cache_last_updated": timestamp, 
-                                                  "mp_last_checked": timestamp,
-                                                  "user_ticks": {}}
-            self.route_user_data[route_id]["user_ticks"][user_id2] = name2
-
-        if self.route_ticks_cached_data.get(route_id) is None:
-            self.route_ticks_cached_data[route_id] = self.route_user_data[route_id]
-        else:
-            self.route_ticks_cached_data[route_id]["last_total_mp"] = route_ticks_total
-            self.route_ticks_cached_data[route_id]["cache_last_updated"] = timestamp
-            self.route_ticks_cached_data[route_id]["mp_last_checked"] = timestamp
+    def cache_route_user_data(self, route_id, route_name, route_ticks_total, newest_tick_id, user_ticks,
+                              replace=False):
+        """Cache route user data, with replace users not in user_ticks are removed"""
 
-            for user_tick in self.route_user_data[route_id]["user_ticks"]:
-                user_tick_key_str = str(user_tick)
-                user_tick_value = self.route_user_data[route_id]["user_ticks"][user_tick]
-                user_tick_k_v = {user_tick_key_str:user_tick_value}
-                self.route_ticks_cached_data[route_id]["user_ticks"].update(user_tick_k_v)
+        logging.debug("Caching new route data")
+        timestamp = self.date_time_now.strftime(TIMESTAMP_STR_FORMAT)
 
-        logging.debug(self.route_user_data[route_id]["user_ticks"])
+        # Hold the cache lock so a checkpoint never saves the new total without the new users
+        with self.route_ticks_cached_data.lock:
+            self.route_ticks_cached_data.update_route(route_id,
+                                                      route_name=route_name,
+                                                      last_total_mp=route_ticks_total,
+                                                      cache_last_updated=timestamp,
+                                                      mp_last_checked=timestamp,
+                                                      newest_tick_id=newest_tick_id)
+            if replace is True:
+                self.route_ticks_cached_data.replace_user_ticks(route_id, user_ticks)
+            else:
+                self.route_ticks_cached_data.add_user_ticks(route_id, user_ticks)
+            self.new_route_users[route_id] = list(user_ticks)
 
-    def evaluate_cached_data(self, route_id, route_name):
-        """Evaluate and update cached Mountain Project route data"""
+        logging.debug(user_ticks)
 
-        update_last_checked_timestamp_only = False
+    def route_checked_within_limit(self, route):
+        """Check if Mountain Project was checked for a cached route within CHECK_MP_LIMIT_MINS"""
 
         check_mp_time_limit = timedelta(minutes=CHECK_MP_LIMIT_MINS)
-        # route_cache_limit = timedelta(minutes=ROUTE_CACHE_LIM_MIN)
 
-        mp_last_checked = self.date_time_now + check_mp_time_limit
-        if self.route_ticks_cached_data.get(route_id) and\
-        self.route_ticks_cached_data[route_id].get("mp_last_checked"):
-            try:
-                mp_last_checked = datetime.strptime(self.route_ticks_cached_data[route_id]["mp_last_checked"], TIMESTAMP_STR_FORMAT)
-                if self.date_time_now - mp_last_checked < check_mp_time_limit:
-                    logging.info("Mountain Project last checked within time limit, using cached data")
-                    return
-            except ValueError:
-                pass
-
-        route_ticks_data, route_ticks_total, update_last_checked_timestamp_only = self.get_route_ticks(route_id)
-
-        if update_last_checked_timestamp_only is False:
-            logging.debug("Updating route data cache")
-            self.cache_route_user_data(route_id, route_name, route_ticks_total, route_ticks_data)
+        if route is None or route.mp_last_checked is None:
+            return False
+        try:
+            mp_last_checked = datetime.strptime(route.mp_last_checked, TIMESTAMP_STR_FORMAT)
+        except ValueError:
+            return False
+        return self.date_time_now - mp_last_checked < check_mp_time_limit
+
+    def evaluate_cached_data(self, route_id, route_name):
+        """
+        Evaluate and update cached Mountain Project route data.
+        The route is fetched under a host wide route lock and saved before the lock is released,
+        so workers waiting on the same route use that result instead of fetching it again.
+        """
+
+        route = self.route_ticks_cached_data.get(route_id)
+        if self.route_checked_within_limit(route):
+            logging.info("Mountain Project last checked within time limit, using cached data")
+            METRICS.inc("route_cache_lookups_total", result="hit", path="checked_within_limit")
+            return
+        mp_last_checked = route.mp_last_checked if route is not None else None
+
+        with RouteLock(ROUTE_LOCK_DIR, route_id, ROUTE_LOCK_STRIPES):
+            route = self.route_ticks_cached_data.reload(route_id)
+            if route is not None and route.mp_last_checked != mp_last_checked:
+                logging.info("Route refreshed by another worker, using cached data, route/%s", route_id)
+                METRICS.inc("route_cache_lookups_total", result="hit", path="refreshed_by_other_worker")
+                return
+
+            user_ticks, route_ticks_total, newest_tick_id, sync_mode = self.get_route_ticks(route_id)
+
+            if sync_mode != "unchanged":
+                METRICS.inc("route_cache_lookups_total", result="miss",
+                            path="not_cached" if route is None else f"{sync_mode}_sync")
+                logging.debug("Updating route data cache, %s sync", sync_mode)
+                self.cache_route_user_data(route_id, route_name, route_ticks_total, newest_tick_id, user_ticks,
+                                           replace=sync_mode == "full")
+            else:
+                METRICS.inc("route_cache_lookups_total", result="hit", path="same_total")
+                logging.info("Updating last checked timestamp only, route/%s", route_id)
+                self.route_ticks_cached_data.update_route(
+                    route_id, mp_last_checked=self.date_time_now.strftime(TIMESTAMP_STR_FORMAT))
+
+            self.commit_route(route_id)
+
+    def refresh_route(self, route_id, route_name):
+        """
+        Fetch every page of a route's tick list and replace its cached users, whatever the cached total,
+        for routes whose cached users are known to be wrong. Saved before the route lock is released.
+        """
+
+        with RouteLock(ROUTE_LOCK_DIR, route_id, ROUTE_LOCK_STRIPES):
+            route_ticks_json = self.get_first_route_page_json(route_id)
+            newest_tick_id = route_ticks_json['data'][0].get("id") if route_ticks_json['data'] else None
+            user_ticks, all_pages = self.get_all_route_ticks(route_ticks_json)
+            logging.info("Refreshed all %s ticks, route/%s", route_ticks_json['total'], route_id)
+            self.cache_route_user_data(route_id, route_name, route_ticks_json['total'], newest_tick_id, user_ticks,
+                                       replace=all_pages)
+            self.commit_route(route_id)
+
+    def evaluate_routes(self, routes, label, progress=None, resume=False):
+        """
+        Evaluate and update cached data for routes, fetching from Mountain Project concurrently.
+        progress is called with the number of routes done and the total after each route.
+        Route data is checkpointed every CHECKPOINT_ROUTES routes or CHECKPOINT_SECS seconds,
+        with resume routes refreshed by the checkpointed run are skipped.
+        Routes that fail are recorded in route_errors, routes refreshed are added to routes_done.
+        """
+
+        routes_total = len(routes)
+        routes_done = self.routes_done = self.load_checkpoint() if resume is True else set()
+        routes = [(route_id, route_name) for route_id, route_name in routes if route_id not in routes_done]
+        routes_done_count = routes_total - len(routes)
+        if routes_done_count > 0:
+            logging.info("Skipping %s routes refreshed by the checkpointed run", routes_done_count)
+        if progress is not None:
+            progress(routes_done_count, routes_total)
+
+        routes_since_checkpoint = 0
+        last_checkpoint_time = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+        futures = {executor.submit(self.evaluate_cached_data, route_id, route_name): route_id
+                   for route_id, route_name in routes}
+        try:
+            for future in as_completed(futures):
+                route_id = futures[future]
+                routes_done_count += 1
+                try:
+                    future.result()
+                except RouteFetchError as err:
+                    logging.error("Failed to get route/%s: %s", route_id, err)
+                    METRICS.inc("route_fetch_errors_total")
+                    self.route_errors[route_id] = str(err)
+                else:
+                    routes_done.add(route_id)
+                    self.route_errors.pop(route_id, None)
+                logging.info("%s/%s %s route/%s", routes_done_count, routes_total, label, route_id)
+                if progress is not None:
+                    progress(routes_done_count, routes_total)
+
+                routes_since_checkpoint += 1
+                if routes_since_checkpoint >= CHECKPOINT_ROUTES or\
+                time.monotonic() - last_checkpoint_time >= CHECKPOINT_SECS:
+                    logging.info("Checkpointing route data, %s/%s routes", routes_done_count, routes_total)
+                    self.save_checkpoint(routes_done)
+                    routes_since_checkpoint = 0
+                    last_checkpoint_time = time.monotonic()
+        finally:
+            executor.shutdown(cancel_futures=True)
+            self.save_checkpoint(routes_done)
+
+        if len(self.route_errors) == 0:
+            self.remove_checkpoint()
         else:
-            logging.info("Updating last checked timestamp only, route/%s", route_id)
-            self.route_ticks_cached_data[route_id]["mp_last_checked"] = self.date_time_now.strftime(TIMESTAMP_STR_FORMAT)
-            # self.dump_cached_data()
+            logging.warning("%s routes failed, resume to retry them: %s",
+                            len(self.route_errors), ' '.join(self.route_errors))
 
     def get_route_page(self, next_page_url):
         """Get an individual page of a route's tick list"""
 
         max_retries = 5
         retries = 0
-
-        try:
-            response = self.session.get(next_page_url, timeout=10)
-        except requests.RequestException as err:
-            logging.critical(err)
-            sys.exit(1)
-
-        while response.status_code == 429 and retries < max_retries:
-            wait_time = 2 ** retries
-            logging.warning("Received HTTP 429, sleeping for %s seconds (retry %s)", wait_time, retries)
-            time.sleep(wait_time)
+        start_time = time.perf_counter()
+
+        while True:
+            with self.page_requests_lock:
+                if self.request_budget is not None and self.page_requests >= self.request_budget:
+                    raise RequestBudgetError(f"{next_page_url}: request budget of {self.request_budget} used up")
+                self.page_requests += 1
+            self.rate_limiter.acquire()
             try:
                 response = self.session.get(next_page_url, timeout=10)
             except requests.RequestException as err:
-                logging.critical(err)
-                sys.exit(1)
+                METRICS.inc("route_page_requests_total", status="error")
+                raise RouteFetchError(f"{next_page_url}: {err}") from err
+            METRICS.inc("route_page_requests_total", status=response.status_code)
+            if response.status_code != 429 or retries >= max_retries:
+                break
+            METRICS.inc("route_page_retries_total")
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is None:
+                retry_after = 2 ** retries
+            rate = self.rate_limiter.on_rate_limited(retry_after)
+            logging.warning("Received HTTP 429, waiting %s seconds and lowering rate to %.2f requests/sec (retry %s)",
+                            retry_after, rate, retries)
+            retries += 1
+        METRICS.observe("route_page_seconds", time.perf_counter() - start_time)
 
         if response.status_code == 200:
             logging.debug(response.headers)
+            self.rate_limiter.on_success()
             return response
         if response.status_code == 429:
-            logging.critical("Exceeded max retries due to HTTP 429.")
-        else:
-            logging.critical("HTTP status code: %s", response.status_code)
-            sys.exit(1)
+            raise RouteFetchError(f"{next_page_url}: exceeded max retries due to HTTP 429")
+        raise RouteFetchError(f"{next_page_url}: HTTP status code {response.status_code}")
 
-        return None
+    def get_route_page_json(self, next_page_url):
+        """
+        Get an individual page of a route's tick list as JSON, trying once more if not valid.
+        Raises RouteFetchError if the page is still not valid JSON or is missing tick list fields.
+        """
+
+        logging.info("Getting %s", next_page_url)
+        try:
+            return route_page_json(self.get_route_page(next_page_url))
+        except ValueError as err:
+            logging.error(err)
+            logging.warning("Trying to get %s again", next_page_url)
+        try:
+            return route_page_json(self.get_route_page(next_page_url))
+        except ValueError as err2:
+            raise RouteFetchError(f"{next_page_url}: {err2}") from err2
+
+    def get_first_route_page_json(self, route_id):
+        """Get the first page of a route's tick list, newest ticks first"""
+        return self.get_route_page_json(
+            f"{MNT_PROJ_BASE_URL}/{API_V2_ROUTES}/{route_id}/ticks?per_page={ROUTE_TICKS_PER_PAGE}&page=1")
 
     def get_route_ticks(self, route_id):
-        """Get all pages of a route's tick list from Mountain Project"""
+        """
+        Get a route's tick list from Mountain Project.
+        When the route is cached and its total has grown, only the newest pages are fetched, as long as
+        the cached newest tick is found right after the new ticks. Otherwise ticks were deleted or reordered
+        and all pages are fetched to replace the cached users.
+        Returns the users, the total, the newest tick ID, and the sync mode: unchanged, delta or full.
+        """
+
+        route_ticks_json = self.get_first_route_page_json(route_id)
+        route_ticks_total = route_ticks_json['total']
+        newest_tick_id = route_ticks_json['data'][0].get("id") if route_ticks_json['data'] else None
+
+        cached_route = self.route_ticks_cached_data.get(route_id)
+        if cached_route is not None:
+            cached_newest_tick_id = cached_route.newest_tick_id
+            total_difference = route_ticks_total - cached_route.last_total_mp
+            logging.info("Total difference: %s, route/%s", total_difference, route_id)
+
+            if total_difference == 0 and\
+            (cached_newest_tick_id is None or str(newest_tick_id) == str(cached_newest_tick_id)):
+                logging.info("Route tick total same as cached, using cached data, route/%s", route_id)
+                return None, route_ticks_total, newest_tick_id, "unchanged"
 
-        ticks_per_page = 250
-        page_count_limit = 100
-        page_count = 0
+            # Without a cached newest tick the new ticks can't be checked, so only trust the first page
+            if total_difference > 0 and (cached_newest_tick_id is not None or total_difference <= ROUTE_TICKS_PER_PAGE):
+                user_ticks = self.get_new_route_ticks(route_ticks_json, total_difference, cached_newest_tick_id)
+                if user_ticks is not None:
+                    return user_ticks, route_ticks_total, newest_tick_id, "delta"
 
-        route_ticks_data = []
-        route_ticks_total = 0
-        update_last_checked_timestamp_only = False
+            logging.info("Cached ticks don't match, getting all pages, route/%s", route_id)
 
-        next_page_url = f"{MNT_PROJ_BASE_URL}/{API_V2_ROUTES}/{route_id}/ticks?per_page={ticks_per_page}&page=1"
+        user_ticks, all_pages = self.get_all_route_ticks(route_ticks_json)
+        return user_ticks, route_ticks_total, newest_tick_id, "full" if all_pages is True else "delta"
+
+    def get_new_route_ticks(self, route_ticks_json, total_difference, cached_newest_tick_id):
+        """
+        Get users from the newest total_difference ticks, a page at a time.
+        Returns None if the tick after them is not the cached newest tick.
+        """
+
+        page_count_limit = 100
+        page_count = 1
+        user_ticks = {}
+        tick_i = 0
+
+        while True:
+            for entry in route_ticks_json['data']:
+                if tick_i == total_difference:
+                    if cached_newest_tick_id is None or str(entry.get("id")) == str(cached_newest_tick_id):
+                        return user_ticks
+                    logging.info("Cached newest tick %s not found after %s new ticks",
+                                 cached_newest_tick_id, total_difference)
+                    return None
+                add_page_user_ticks(user_ticks, entry)
+                tick_i += 1
 
-        while next_page_url is not None:
+            next_page_url = route_ticks_json['next_page_url']
+            if next_page_url is None:
+                return user_ticks if cached_newest_tick_id is None else None
             page_count += 1
             if page_count > page_count_limit:
                 logging.info("Page count has exceeded limit of %s for %s", page_count_limit, next_page_url)
-                break
-            logging.info("Getting %s", next_page_url)
-            route_ticks = self.get_route_page(next_page_url)
+                return None
+            route_ticks_json = self.get_route_page_json(next_page_url)
 
-            try:
-                route_ticks_json = route_ticks.json()
-            except JSONDecodeError as err:
-                logging.error(err)
-                logging.warning("Trying to get %s again", next_page_url)
-                try:
-                    route_ticks = self.get_route_page(next_page_url)
-                    route_ticks_json = route_ticks.json()
-                except JSONDecodeError as err2:
-                    logging.critical(err2)
-                    logging.critical("Failed to get %s", next_page_url)
-                    sys.exit(1)
-
-            if route_ticks_json.get("current_page") == 1 and\
-            self.route_ticks_cached_data.get(route_id) and\
-            route_ticks_json["total"] == self.route_ticks_cached_data[route_id]["last_total_mp"]:
-                logging.info("Route tick total same as cached, using cached data, route/%s", route_id)
-                update_last_checked_timestamp_only = True
-                break
+    def get_all_route_ticks(self, route_ticks_json):
+        """
+        Get users from all pages of a route's tick list, a page at a time.
+        Also returns False if the page count limit was reached before the last page.
+        """
 
-            route_ticks_data = route_ticks_data + route_ticks_json['data']
+        page_count_limit = 100
+        page_count = 1
+        user_ticks = {}
+
+        while True:
+            for entry in route_ticks_json['data']:
+                add_page_user_ticks(user_ticks, entry)
             next_page_url = route_ticks_json['next_page_url']
-            route_ticks_total = route_ticks_json['total']
+            if next_page_url is None:
+                return user_ticks, True
+            page_count += 1
+            if page_count > page_count_limit:
+                logging.info("Page count has exceeded limit of %s for %s", page_count_limit, next_page_url)
+                return user_ticks, False
+            route_ticks_json = self.get_route_page_json(next_page_url)
+
+
+def route_page_json(response):
+    """A route tick list page's JSON, raises ValueError if it is not valid JSON or is missing fields"""
+    route_ticks_json = response.json()
+    if isinstance(route_ticks_json, dict) is False or isinstance(route_ticks_json.get('data'), list) is False:
+        raise ValueError("tick list page has no data list")
+    if isinstance(route_ticks_json.get('total'), int) is False or 'next_page_url' not in route_ticks_json:
+        raise ValueError("tick list page is missing total or next_page_url")
+    for entry in route_ticks_json['data']:
+        if isinstance(entry, dict) is False:
+            raise ValueError("tick list entry is not an object")
+        if entry.get("user") and (isinstance(entry["user"], dict) is False or
+                                  "id" not in entry["user"] or "name" not in entry["user"]):
+            raise ValueError("tick list entry user is missing id or name")
+    return route_ticks_json
 
-            if route_ticks_json.get("current_page") == 1 and\
-            self.route_ticks_cached_data.get(route_id):
-                total_difference = route_ticks_json["total"] - self.route_ticks_cached_data[route_id]["last_total_mp"]
-                logging.info("Total difference: %s, route/%s", total_difference, route_id)
-                if 0 < total_difference <= ticks_per_page:
-                    break
 
-        return route_ticks_data, route_ticks_total, update_last_checked_timestamp_only
+def add_page_user_ticks(user_ticks, entry):
+    """Add the user from a tick list entry, entries without a public user are skipped"""
+    if entry.get("user") is None or entry["user"] is False:
+        return
+    user_ticks[entry["user"]["id"]] = entry["user"]["name"]
 
 
-def start_scrape_mntproj(mp_uid, mp_name):
-    "Start everything, get user's csv file and ticks from each route."
+def get_user_routes(mp_uid, mp_name, session):
+    """Get user's csv file and return the unique routes in it, route ID to route name"""
+
+    user_csv_file = f"{USER_TICK_CSV_DIR}/{mp_name}_{mp_uid}_ticks.csv"
+    with METRICS.timer("phase_seconds", phase="csv_download"):
+        get_csv_file(mp_uid, mp_name, session, user_csv_file, GET_USER_CSV)
+
+    with METRICS.timer("phase_seconds", phase="csv_parse"):
+        logging.info("Reading unique routes from %s", user_csv_file)
+        return read_tick_routes(user_csv_file)
+
+
+def rank_users(route_user_matrix, route_ids, mp_uid, metric="overlap", route_ticks_cached_data=None):
+    """
+    Users with the most similar tick lists to route_ids, as name, count, and percent lines.
+    The percent is the metric's score, for overlap the shared route count over the user's own count.
+    route_ticks_cached_data is needed for the jaccard and cosine metrics.
+    """
+    return format_results(rank_similar_users(route_user_matrix, route_ids, mp_uid, metric, route_ticks_cached_data,
+                                             SAME_ROUTE_MAX_LIMIT))
+
+
+def rank_similar_users(route_user_matrix, route_ids, mp_uid, metric="overlap", route_ticks_cached_data=None,
+                       limit=SAME_ROUTE_MAX_LIMIT):
+    """
+    SimilarUsers with the limit users with the most similar tick lists to route_ids.
+    route_ticks_cached_data is needed for the jaccard and cosine metrics.
+    """
+
+    user_col = route_user_matrix.user_col(mp_uid)
+    if user_col is None:
+        logging.warning("%s not found in cached route data, using tick list route count", mp_uid)
+
+    logging.info("Finding user counts per route and %s scores", metric)
+    user_route_counts = route_ticks_cached_data.user_route_counts if route_ticks_cached_data is not None else None
+    with METRICS.timer("phase_seconds", phase="aggregation"):
+        same_route_counts, scores = route_user_matrix.similarity_scores(route_ids, user_col, metric, limit,
+                                                                        user_route_counts)
+
+    logging.info("Selecting top %s users", limit)
+    with METRICS.timer("phase_seconds", phase="sort"):
+        return SimilarUsers.from_scores(route_user_matrix, same_route_counts, scores, limit)
+
+
+def format_results(similar_users, limit=SAME_ROUTE_MAX_LIMIT):
+    """The top limit similar users as name, shared route count, and percent lines"""
+    results = []
+    for _, name, same_route_count, score in similar_users.page(0, limit):
+        same_route_percent = round(score * 100, 1)
+        result_line = f"{name}, {same_route_count}, {same_route_percent}%"
+        results.append(result_line)
+    return results
+
+
+def saved_routes_version(route_ids):
+    """Version stamp of the saved data of route_ids"""
+    route_ticks_cached_data = open_route_cache(ROUTE_TICKS_CACHE_DB)
+    try:
+        return route_ticks_cached_data.routes_version(list(route_ids))
+    finally:
+        route_ticks_cached_data.close()
+
+
+def get_stored_result(mp_uid, metric, job_store):
+    """
+    Get the ranking entry of the user's latest finished scrape job in job_store, from any worker process,
+    if it finished within RESULT_CACHE_TTL_MINS and none of the user's routes changed since, and cache it
+    """
+    job = job_store.latest_finished(mp_uid, metric, datetime.now() - timedelta(minutes=RESULT_CACHE_TTL_MINS))
+    if job is None or saved_routes_version(job.route_ids) != job.routes_version:
+        return None
+    logging.info("Using results of scrape job %s for %s", job.job_id, mp_uid)
+    return RESULT_CACHE.put(mp_uid, metric, job.results, job.route_ids, job.routes_version, job.similar_users,
+                            (datetime.now() - job.finished).total_seconds())
+
+
+def get_cached_result(mp_uid, metric, job_store=None):
+    """
+    Get the cached ranking entry from an earlier scrape of the user if none of the user's routes changed since.
+    Rankings not cached in this process are looked up in job_store, a ScrapeJobStore, if given.
+    """
+    try:
+        cached_result = RESULT_CACHE.get_entry(mp_uid, metric, saved_routes_version)
+        if cached_result is None and job_store is not None:
+            cached_result = get_stored_result(mp_uid, metric, job_store)
+    except sqlite3.Error as err:
+        logging.error(err)
+        cached_result = None
+    METRICS.inc("result_cache_lookups_total", result="miss" if cached_result is None else "hit")
+    return cached_result
+
+
+def get_cached_results(mp_uid, metric, job_store=None):
+    """Get the ranking lines from an earlier scrape of the user if none of the user's routes changed since"""
+    cached_result = get_cached_result(mp_uid, metric, job_store)
+    return cached_result.results if cached_result is not None else None
+
+
+def get_cached_similar_users(mp_uid, metric, job_store=None):
+    """Get the SimilarUsers from an earlier scrape of the user if none of the user's routes changed since"""
+    cached_result = get_cached_result(mp_uid, metric, job_store)
+    return cached_result.similar_users if cached_result is not None else None
+
+
+def rank_routes_done(scrape_mnt_proj, routes, mp_uid, metric):
+    """Rank users by the routes refreshed so far in a scrape"""
+    routes_done = [route_id for route_id in routes if route_id in scrape_mnt_proj.routes_done]
+    route_user_matrix = RouteUserMatrix.from_cache(scrape_mnt_proj.route_ticks_cached_data, routes_done)
+    return rank_users(route_user_matrix, routes_done, mp_uid, metric, scrape_mnt_proj.route_ticks_cached_data)
+
+
+def start_scrape_mntproj(mp_uid, mp_name, progress=None, metric=None, partial=None, similar=None, cached=None):
+    """
+    Start everything, get user's csv file and ticks from each route.
+    progress is called with the number of routes done and the total.
+    partial is called with the ranking by the routes done so far, at most every PARTIAL_RESULTS_SECS.
+    similar is called with the SimilarUsers of the API_SIMILAR_MAX_USERS most similar users.
+    cached is called with the route IDs and their version stamp when the ranking can be reused.
+    metric is one of SIMILARITY_METRICS, SIMILARITY_METRIC if not given.
+    Returns the cached ranking instead if none of the user's routes changed since it was computed.
+    """
+
+    metric = metric or SIMILARITY_METRIC
+    cached_result = get_cached_result(mp_uid, metric)
+    if cached_result is not None:
+        logging.info("Using cached results for %s:%s", mp_name, mp_uid)
+        if similar is not None:
+            similar(cached_result.similar_users)
+        if cached is not None:
+            cached(cached_result.route_ids, cached_result.version)
+        return cached_result.results
 
     start_time = datetime.now().timestamp()
 
     logging.info("Creating session")
     session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=FETCH_WORKERS))
+    session.mount("http://", HTTPAdapter(pool_maxsize=FETCH_WORKERS))
 
-    user_csv_file = f"{USER_TICK_CSV_DIR}/{mp_name}_{mp_uid}_ticks.csv"
-    get_csv_file(mp_uid, mp_name, session, user_csv_file, GET_USER_CSV)
+    routes = get_user_routes(mp_uid, mp_name, session)
 
-    logging.info("Creating dataframe from %s", user_csv_file)
-    df = pd.read_csv(user_csv_file)
+    checkpoint_file = f"{CHECKPOINT_DIR}/{mp_name}_{mp_uid}_checkpoint.json"
+    scrape_mnt_proj = ScrapeMntProj(ROUTE_TICKS_CACHE_DB, session, checkpoint_file=checkpoint_file)
 
-    logging.info("Removing duplicates routes from user's tick list")
-    route_urls = df['URL'].drop_duplicates().reset_index(drop=True)
+    last_partial_time = time.monotonic()
 
-    scrape_mnt_proj = ScrapeMntProj(ROUTE_TICKS_CACHE_FILE, session)
+    def route_progress(routes_done, routes_total):
+        nonlocal last_partial_time
+        if progress is not None:
+            progress(routes_done, routes_total)
+        if partial is not None and 0 < routes_done < routes_total and\
+        time.monotonic() - last_partial_time >= PARTIAL_RESULTS_SECS:
+            partial(rank_routes_done(scrape_mnt_proj, routes, mp_uid, metric))
+            last_partial_time = time.monotonic()
 
     logging.info("Getting route ticks for all routes from either cached data or API")
-    routes_total = len(route_urls)
-    for route_url_i in range(routes_total):
-        route_url = route_urls[route_url_i]
-        running_count_url = f"{route_url_i + 1}/{routes_total} {mp_name}:{mp_uid} {route_url}"
-        logging.info(running_count_url)
-        try:
-            _,_,_,_, route_id_from_url, route_name_from_url = route_url.split('/')
-        except ValueError:
-            logging.warning("Either route ID or name is missing from URL. Skipping route.")
-        else:
-            scrape_mnt_proj.evaluate_cached_data(route_id_from_url, route_name_from_url)
+    with METRICS.timer("phase_seconds", phase="route_fetch"):
+        scrape_mnt_proj.evaluate_routes(list(routes.items()), f"{mp_name}:{mp_uid}", route_progress,
+                                        RESUME_SCRAPE)
 
     logging.info("Closing session")
     session.close()
@@ -262,50 +661,32 @@ def start_scrape_mntproj(mp_uid, mp_name):
     logging.info("Saving new route data")
     scrape_mnt_proj.dump_cached_data()
 
-    logging.info("Finding user counts per route")
-    user_counts = {}
-    for route_url in route_urls:
+    logging.info("Building route user matrix")
+    with METRICS.timer("phase_seconds", phase="matrix_build"):
+        route_user_matrix = RouteUserMatrix.from_cache(scrape_mnt_proj.route_ticks_cached_data, routes)
+
+    similar_users = rank_similar_users(route_user_matrix, routes, mp_uid, metric,
+                                       scrape_mnt_proj.route_ticks_cached_data, API_SIMILAR_MAX_USERS)
+    results = format_results(similar_users)
+    if similar is not None:
+        similar(similar_users)
+
+    if len(scrape_mnt_proj.route_errors) == 0:
         try:
-            route_id_from_url = route_url.split('/')[4]
-        except IndexError:
-            continue
-        user_ids = scrape_mnt_proj.route_ticks_cached_data[route_id_from_url]['user_ticks']
-        for user_id in user_ids:
-            if user_counts.get(user_id):
-                user_counts[user_id]["same_route_count"] = user_counts[user_id]["same_route_count"] + 1
-            else:
-                name = scrape_mnt_proj.route_ticks_cached_data[route_id_from_url]['user_ticks'][user_id]
-                user_counts[user_id] = {}
-                user_counts[user_id]["name"] = name
-                user_counts[user_id]["same_route_count"] = 1
-
-    logging.info("Creating list of tuples with users and same route counts")
-    user_list = []
-    for user_id in user_counts:
-        name = user_counts[user_id]["name"]
-        same_route_count = user_counts[user_id]["same_route_count"]
-        user_list.append((name, same_route_count))
-
-    logging.info("Sorting user list")
-    sorted_user_list = sorted(user_list, key=lambda x: x[1], reverse=True)
-
-    logging.info("Printing users, shared route counts, and percentages")
-    results = []
-    try:
-        user_route_total = user_counts[int(mp_uid)]["same_route_count"]  # empty object was created
-    except KeyError:
-        user_route_total = user_counts[str(mp_uid)]["same_route_count"]  # json cache file was loaded
-    for user_i in range(len(sorted_user_list)):
-        name, same_route_count = sorted_user_list[user_i]
-        if user_i + 1 > SAME_ROUTE_MAX_LIMIT:
-            break
-        same_route_percent = round(same_route_count / user_route_total * 100, 1)
-        result_line = f"{name}, {same_route_count}, {same_route_percent}%"
-        results.append(result_line)
+            cached_result = RESULT_CACHE.put(mp_uid, metric, results, routes,
+                                             scrape_mnt_proj.route_ticks_cached_data.routes_version(list(routes)),
+                                             similar_users)
+            if cached is not None:
+                cached(cached_result.route_ids, cached_result.version)
+        except sqlite3.Error as err:
+            logging.error(err)
+    scrape_mnt_proj.route_ticks_cached_data.close()
 
     end_time = datetime.now().timestamp()
     runtime = end_time - start_time
     logging.info("Mountain Project scraper finished for %s in %.2f seconds", mp_name, runtime)
+    METRICS.observe("phase_seconds", runtime, phase="total")
+    METRICS.inc("scrapes_total", result="finished" if len(scrape_mnt_proj.route_errors) == 0 else "route_errors")
 
     return results
 
@@ -326,6 +707,13 @@ if __name__ == "__main__":
 
         if '-n' in sys.argv:
             GET_USER_CSV = False
+        if '-r' in sys.argv:
+            RESUME_SCRAPE = True
+        if '-m' in sys.argv:
+            SIMILARITY_METRIC = sys.argv[sys.argv.index('-m') + 1] if sys.argv[-1] != '-m' else ''
+            if SIMILARITY_METRIC not in SIMILARITY_METRICS:
+                print("Similarity metric must be one of:", ', '.join(SIMILARITY_METRICS))
+                sys.exit(2)
 
     if os.path.isdir(LOG_DIR) is False:
         print(LOG_DIR + " not found, logging to local logs directory")
@@ -346,6 +734,10 @@ if __name__ == "__main__":
 
     mntproj_uid = mntproj_user_ids[mntproj_name]
 
-    mp_scrape_results = start_scrape_mntproj(mntproj_uid, mntproj_name)
+    try:
+        mp_scrape_results = start_scrape_mntproj(mntproj_uid, mntproj_name)
+    except CsvFetchError as err:
+        logging.critical(err)
+        sys.exit(1)
     for result in mp_scrape_results:
         print(result)
@@ -3,94 +3,181 @@
 Compare users in Mountain Project route tick lists.
 This script does not use caching.
 
+Route tick lists are fetched by FETCH_WORKERS threads over pooled connections, a page at a time,
+while the main thread counts the users on each page as it arrives. Only each route's user IDs so far
+and the users' shared route counts are kept, so memory stays bounded whatever the route sizes.
+The ranking is the same as the cached scraper's overlap ranking, printed the same way:
+the top SAME_ROUTE_MAX_LIMIT users as name, shared route count, and percent lines.
+
 Example:
 python scrape_mntproj_nocache.py 123456789/thomas-anderson
 """
 
+import heapq
+import queue
 import sys
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from json import JSONDecodeError
+
 import requests
-from constants import MNT_PROJ_BASE_URL, API_V2_ROUTES, USER_PROFILE_BASE_URL
+from requests.adapters import HTTPAdapter
+
+from constants import MNT_PROJ_BASE_URL, API_V2_ROUTES, USER_PROFILE_BASE_URL, ROUTE_TICKS_PER_PAGE
+from constants import SAME_ROUTE_MAX_LIMIT, FETCH_WORKERS, NOCACHE_PAGE_QUEUE_SIZE
+from constants import FETCH_RATE_INITIAL, FETCH_RATE_MIN, FETCH_RATE_MAX, FETCH_RATE_INCREASE, FETCH_RATE_DECREASE
+from rate_limiter import AdaptiveRateLimiter, parse_retry_after
+from tick_csv import iter_tick_routes
+
 
 class ScrapeMntProj:
     """Compare users in Mountain Project route tick lists"""
 
-    def __init__(self) -> None:
+    def __init__(self, session, rate_limiter=None) -> None:
+        self.session = session
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter(FETCH_RATE_INITIAL, FETCH_RATE_MIN, FETCH_RATE_MAX,
+                                                                FETCH_RATE_INCREASE, FETCH_RATE_DECREASE)
+        # User ID to name, shared route count, and the first route the user was seen on
         self.users_all_routes = {}
+        self.route_errors = []
 
-    def get_route_ticks(self, route_id):
-        """Get route tick list from Mountain Project api and create list of users"""
+    def get_route_page_json(self, next_page_url):
+        """Get an individual page of a route's tick list, waiting and trying again on HTTP 429"""
 
-        next_page_url = f"{MNT_PROJ_BASE_URL}/{API_V2_ROUTES}/{route_id}/ticks?per_page=250&page=1"
+        max_retries = 5
+        for retries in range(max_retries + 1):
+            self.rate_limiter.acquire()
+            route_ticks = self.session.get(next_page_url, timeout=10)
+            if route_ticks.status_code != 429 or retries == max_retries:
+                break
+            retry_after = parse_retry_after(route_ticks.headers.get("Retry-After"))
+            self.rate_limiter.on_rate_limited(retry_after if retry_after is not None else 2 ** retries)
+        route_ticks.raise_for_status()
+        self.rate_limiter.on_success()
+        return route_ticks.json()
+
+    def get_route_ticks(self, route_i, route_id, page_queue):
+        """
+        Get a route's tick list a page at a time, putting each page's users on page_queue.
+        A final None page marks the end of the route, also when it failed.
+        """
+
+        next_page_url = f"{MNT_PROJ_BASE_URL}/{API_V2_ROUTES}/{route_id}/ticks?per_page={ROUTE_TICKS_PER_PAGE}&page=1"
         page_count_limit = 100
         page_count = 0
-        route_ticks_data = []
-
-        while next_page_url is not None:
-            if page_count < page_count_limit:
-                page_count += 1
-                route_ticks = requests.get(next_page_url)
-                route_ticks_json = route_ticks.json()
-                route_ticks_data = route_ticks_data + route_ticks_json['data']
-                next_page_url = route_ticks_json['next_page_url']
-            else:
-                print("Page count has exceeded limit of", page_count_limit, "for", next_page_url)
-                break
 
-        user_ids_current_route = []
-        for entry in route_ticks_data:
-            # print(entry)  # debugging
-            if entry.get("user") is None or entry["user"] is False:
-                continue
-            user_id = entry["user"]["id"]
-            if user_id not in user_ids_current_route:
-                user_ids_current_route.append(user_id)
-                if user_id not in self.users_all_routes:
-                    self.users_all_routes[user_id] = {"name": entry["user"]["name"], "same_route_count": 1}
+        try:
+            while next_page_url is not None:
+                if page_count < page_count_limit:
+                    page_count += 1
+                    route_ticks_json = self.get_route_page_json(next_page_url)
+                    page_users = [(entry["user"]["id"], entry["user"]["name"]) for entry in route_ticks_json['data']
+                                  if entry.get("user") is not None and entry["user"] is not False]
+                    page_queue.put((route_i, page_users))
+                    next_page_url = route_ticks_json['next_page_url']
                 else:
-                    same_route_count_p1 = self.users_all_routes[user_id]["same_route_count"] + 1
-                    self.users_all_routes[user_id]["same_route_count"] = same_route_count_p1
-
-
-if __name__ == "__main__":
+                    print("Page count has exceeded limit of", page_count_limit, "for", next_page_url)
+                    break
+        except (requests.RequestException, JSONDecodeError, KeyError) as err:
+            print("Failed to get route", route_id, err)
+            self.route_errors.append(route_id)
+        finally:
+            page_queue.put((route_i, None))
+
+    def add_page_users(self, route_i, page_users, user_ids_current_route):
+        """Count the users on a page who were not already on an earlier page of the route"""
+        for user_id, user_name in page_users:
+            if user_id in user_ids_current_route:
+                continue
+            user_ids_current_route.add(user_id)
+            user = self.users_all_routes.get(user_id)
+            if user is None:
+                self.users_all_routes[user_id] = [user_name, 1, route_i]
+            else:
+                user[1] += 1
+                user[2] = min(user[2], route_i)
+
+    def evaluate_routes(self, routes):
+        """
+        Fetch every route's tick list and count the users in them.
+        Pages are counted as they arrive, and the bounded page queue holds the fetch threads back
+        when counting falls behind.
+        """
+
+        route_ids = list(routes)
+        page_queue = queue.Queue(maxsize=NOCACHE_PAGE_QUEUE_SIZE)
+        routes_user_ids = {}
+        routes_done = 0
+
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            for route_i, route_id in enumerate(route_ids):
+                executor.submit(self.get_route_ticks, route_i, route_id, page_queue)
+
+            while routes_done < len(route_ids):
+                route_i, page_users = page_queue.get()
+                if page_users is None:
+                    routes_user_ids.pop(route_i, None)
+                    routes_done += 1
+                    print(f"{MNT_PROJ_BASE_URL}/route/{route_ids[route_i]}/{routes[route_ids[route_i]]}")
+                    continue
+                self.add_page_users(route_i, page_users, routes_user_ids.setdefault(route_i, set()))
+
+    def rank_users(self, mp_uid, routes_total):
+        """
+        Users with the most routes in common with mp_uid, as name, count, and percent lines.
+        The percent is the shared route count over the user's own count, and ties are in the order
+        users are first seen going through the routes in order, by user ID within a route,
+        the same as the cached scraper's overlap ranking.
+        """
+
+        user = self.users_all_routes.get(int(mp_uid))
+        user_total = max(user[1] if user is not None else routes_total, 1)
+        top_users = heapq.nsmallest(SAME_ROUTE_MAX_LIMIT, self.users_all_routes.items(),
+                                    key=lambda user_item: (-user_item[1][1], user_item[1][2], user_item[0]))
+
+        results = []
+        for _, (name, same_route_count, _) in top_users:
+            same_route_percent = round(same_route_count / user_total * 100, 1)
+            results.append(f"{name}, {same_route_count}, {same_route_percent}%")
+        return results
+
+
+def main():
+    """Rank the users who ticked the same routes as the user given on the command line"""
 
     if len(sys.argv) < 2:
         print(__doc__)
         sys.exit(2)
 
     uid_name = sys.argv[1]
-    USER_PROFILE_URL = f"{USER_PROFILE_BASE_URL}/{uid_name}"
-
-    USER_TICK_CSV_EXPORT_URL = USER_PROFILE_URL + '/' + 'tick-export'
-    df = pd.read_csv(USER_TICK_CSV_EXPORT_URL)
+    user_profile_url = f"{USER_PROFILE_BASE_URL}/{uid_name}"
 
-    route_urls = df['URL'].drop_duplicates().reset_index(drop=True)
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=FETCH_WORKERS))
+    session.mount("http://", HTTPAdapter(pool_maxsize=FETCH_WORKERS))
 
-    # route_urls = ['https://www.mountainproject.com/route/105717367/incredible-hand-crack']  # testing
+    tick_csv_export_url = user_profile_url + '/' + 'tick-export'
+    with session.get(tick_csv_export_url, stream=True, timeout=10) as tick_csv_response:
+        try:
+            tick_csv_response.raise_for_status()
+        except requests.HTTPError as err:
+            print("Failed to get tick list", err)
+            sys.exit(1)
+        tick_csv_response.encoding = 'utf-8-sig'
+        routes = dict(iter_tick_routes(tick_csv_response.iter_lines(decode_unicode=True)))
 
-    scrape_mnt_proj = ScrapeMntProj()
+    # routes = {'105717367': 'incredible-hand-crack'}  # testing
 
-    for route_url in route_urls:
-        print(route_url)
-        route_id_from_url = route_url.split('/')[4]
-        scrape_mnt_proj.get_route_ticks(route_id_from_url)
+    scrape_mnt_proj = ScrapeMntProj(session)
+    scrape_mnt_proj.evaluate_routes(routes)
+    session.close()
 
-    # print(scrape_mnt_proj.users_all_routes)  # debugging
+    if len(scrape_mnt_proj.route_errors) != 0:
+        print(len(scrape_mnt_proj.route_errors), "routes failed:", ' '.join(scrape_mnt_proj.route_errors))
 
-    user_list = []
-    for user_id2 in scrape_mnt_proj.users_all_routes:
-        name = scrape_mnt_proj.users_all_routes[user_id2]['name']
-        same_route_count = scrape_mnt_proj.users_all_routes[user_id2]['same_route_count']
-        user_list.append((name, same_route_count))
+    user_id3 = int(uid_name.split('/')[0])
+    for result in scrape_mnt_proj.rank_users(user_id3, len(routes)):
+        print(result)
 
-    sorted_user_list = sorted(user_list, key=lambda x: x[1], reverse=True)
 
-    user_id3 = int(USER_PROFILE_URL.split('/')[4])
-    user_route_total = scrape_mnt_proj.users_all_routes[user_id3]['same_route_count']
-
-    SAME_ROUTE_PERCENT_LIMIT = .198
-    for user in sorted_user_list:
-        name = user[0]
-        same_route_count = user[1]
-        if same_route_count >= (user_route_total * SAME_ROUTE_PERCENT_LIMIT):
-            print(name, same_route_count)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Serve one route cache shard database over HTTP, a local stand-in for a shared cache service.
+Nodes list the server's URL in ROUTE_CACHE_SHARDS, in the same position on every node,
+and call the shard's RouteTicksCache methods with POST /call/<method>.
+
+Example:
+python shard_server.py route_ticks_cache.0.db --port 5101
+python shard_server.py route_ticks_cache.1.db --port 5102
+ROUTE_CACHE_SHARDS=http://127.0.0.1:5101,http://127.0.0.1:5102 python scrape_mntproj.py thomas-anderson
+"""
+
+import argparse
+import sqlite3
+
+from flask import Flask, jsonify, request
+
+from route_cache import RouteTicksCache
+
+# Methods nodes may call, reads never load routes into the server's memory
+SHARD_METHODS = ("write_changes", "route_ids", "user_names", "user_route_counts", "saved_route_versions",
+                 "routes_to_warm", "eviction_candidates", "delete_saved_route", "size_stats", "vacuum", "is_empty",
+                 "import_routes")
+
+
+def read_route_data(route_ticks_cache, route_id):
+    """
+    A saved route's fields with its user IDs and names, None if not saved.
+    Names are read for each request and not kept in the server's users table, so its memory doesn't grow.
+    """
+    route = route_ticks_cache.read_saved_route(route_id)
+    if route is None:
+        return None
+    if route.user_ids is not None:
+        users = [(user_id, route_ticks_cache.users.name(user_id)) for user_id in route.user_ids.tolist()]
+    else:
+        users = route_ticks_cache.read_route_users(route_id)
+    return {"fields": [route.route_name, route.last_total_mp, route.cache_last_updated, route.mp_last_checked,
+                       route.newest_tick_id],
+            "users": users}
+
+
+def create_app(route_ticks_cache):
+    """Flask app serving route_ticks_cache"""
+
+    shard_app = Flask(__name__)
+
+    @shard_app.route('/call/<method>', methods=['POST'])
+    def call(method):
+        body = request.get_json(silent=True)
+        if isinstance(body, dict) is False or isinstance(body.get("args"), list) is False:
+            return jsonify({"error": "body must be a JSON object with an args list"}), 400
+        method_args = body["args"]
+        try:
+            if method == "read_route":
+                result = read_route_data(route_ticks_cache, *method_args)
+            elif method == "iter_route_user_ids":
+                result = list(route_ticks_cache.iter_route_user_ids())
+            elif method == "user_route_pairs":
+                result = route_ticks_cache.user_route_pairs(*method_args).tolist()
+            elif method in SHARD_METHODS:
+                result = getattr(route_ticks_cache, method)(*method_args)
+            else:
+                return jsonify({"error": f"unknown method {method}"}), 404
+        except sqlite3.Error as err:
+            shard_app.logger.error("%s failed: %s", method, err)
+            return jsonify({"error": str(err)}), 500
+        return jsonify({"result": result})
+
+    return shard_app
+
+
+def main():
+    """Serve the shard database given on the command line"""
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('shard_db_file')
+    parser.add_argument('--port', type=int, default=5101)
+    args = parser.parse_args()
+
+    create_app(RouteTicksCache(args.shard_db_file)).run(host="127.0.0.1", port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""Streaming reader for Mountain Project tick-export csv files"""
+
+import csv
+import logging
+
+
+def iter_tick_routes(csv_lines):
+    """
+    Yield route ID and route name for each unique route in tick-export csv lines, in tick list order.
+    Only the URL column is kept, routes are deduplicated by route ID as rows are read.
+    """
+
+    csv_reader = csv.reader(csv_lines)
+    header = next(csv_reader, None)
+    if header is None:
+        return
+    try:
+        url_col = header.index("URL")
+    except ValueError:
+        logging.error("URL column missing from tick list csv header: %s", header)
+        return
+
+    route_ids = set()
+    for row in csv_reader:
+        if len(row) <= url_col:
+            continue
+        route_url = row[url_col]
+        try:
+            _,_,_,_, route_id_from_url, route_name_from_url = route_url.split('/')
+        except ValueError:
+            logging.warning("Either route ID or name is missing from URL %s. Skipping route.", route_url)
+            continue
+        if route_id_from_url not in route_ids:
+            route_ids.add(route_id_from_url)
+            yield route_id_from_url, route_name_from_url
+
+
+def read_tick_routes(csv_file):
+    """Unique routes in a tick-export csv file, route ID to route name"""
+    with open(csv_file, encoding='utf-8-sig', newline='') as open_csv_file:
+        return dict(iter_tick_routes(open_csv_file))
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""
+MinHash signatures with LSH banding for every user in the route cache.
+Finds the users most similar to any cached user, including users who never submitted a tick list.
+Similarity is the estimated Jaccard similarity of the users' cached route sets.
+Once built, scrapes append the route users they save to the index's pending file,
+which is applied whenever the index is loaded and folded into it when saved.
+The cache warmer folds the pending file once it passes USER_INDEX_PENDING_FOLD_MB.
+
+Example usage:
+python user_similarity_index.py build
+python user_similarity_index.py update
+python user_similarity_index.py query 123456789
+python user_similarity_index.py query 123456789 20
+"""
+
+import fcntl
+import json
+import logging
+import os
+import sys
+import threading
+import zlib
+
+import numpy as np
+
+from constants import ROUTE_TICKS_CACHE_DB, USER_INDEX_FILE, MINHASH_NUM_HASHES, MINHASH_BANDS
+from constants import SAME_ROUTE_MAX_LIMIT
+from constants import LOG_DIR, LOG_FILE_USER_INDEX, LOG_FORMAT
+from route_shards import open_route_cache
+
+LOG_LEVEL = logging.INFO
+LOG_FILE = f"{LOG_DIR}/{LOG_FILE_USER_INDEX}"
+
+HASH_SEED = 7
+
+
+def pending_file_for(index_file):
+    """Pending route users file of an index file"""
+    return f"{os.path.splitext(index_file)[0]}.pending"
+
+
+def record_route_users(route_id, user_ids, index_file=USER_INDEX_FILE):
+    """Append a route's saved users to the index's pending file, nothing is recorded before the index is built"""
+    user_ids = [str(user_id) for user_id in user_ids]
+    if len(user_ids) == 0 or os.path.isfile(index_file) is False:
+        return
+    with open(pending_file_for(index_file), 'a', encoding='utf-8') as open_pending_file:
+        fcntl.flock(open_pending_file, fcntl.LOCK_EX)
+        open_pending_file.write(json.dumps([str(route_id), user_ids]) + '\n')
+
+
+def route_key(route_id):
+    """Integer key for hashing a route ID"""
+    route_id = str(route_id)
+    return int(route_id) if route_id.isdigit() else zlib.crc32(route_id.encode())
+
+
+class UserMinHashIndex:
+    """
+    MinHash signature of each user's route set, with band hashes kept sorted per band
+    so candidates for a query are found by binary search.
+    Users whose signatures changed since the last sort are kept in pending_rows and checked directly,
+    the sorted bands are rebuilt once pending_rows grows past a tenth of the index.
+    """
+
+    def __init__(self, num_hashes, bands, seed=HASH_SEED) -> None:
+        if num_hashes % bands != 0:
+            raise ValueError("num_hashes must be a multiple of bands")
+        self.num_hashes = num_hashes
+        self.bands = bands
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self.hash_a = rng.integers(1, 2 ** 63, size=num_hashes, dtype=np.uint64) | np.uint64(1)
+        self.hash_b = rng.integers(0, 2 ** 63, size=num_hashes, dtype=np.uint64)
+        self.band_multipliers = rng.integers(1, 2 ** 63, size=num_hashes // bands, dtype=np.uint64) | np.uint64(1)
+        self.user_ids = []
+        self.user_index = {}
+        self.signatures = np.empty((0, num_hashes), dtype=np.uint32)
+        self.band_hashes = np.empty((0, bands), dtype=np.uint64)
+        self.sorted_band_hashes = np.empty((bands, 0), dtype=np.uint64)
+        self.sorted_band_rows = np.empty((bands, 0), dtype=np.int64)
+        self.pending_rows = set()
+        self.pending_file_size = 0
+        self.lock = threading.Lock()
+
+    def route_hashes(self, route_keys):
+        """MinHash values of routes, one row of num_hashes values per route"""
+        route_keys = np.asarray(route_keys, dtype=np.uint64)
+        return ((route_keys[:, None] * self.hash_a + self.hash_b) >> np.uint64(32)).astype(np.uint32)
+
+    def compute_band_hashes(self, signatures):
+        """Hash each band of rows_per_band signature values to one value"""
+        band_values = signatures.reshape(-1, self.bands, self.num_hashes // self.bands).astype(np.uint64)
+        return (band_values * self.band_multipliers).sum(axis=2, dtype=np.uint64)
+
+    def add_users(self, user_ids):
+        """Get rows for user IDs, adding new users with empty signatures"""
+        new_user_ids = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in self.user_index]
+        num_users = len(self.user_ids) + len(new_user_ids)
+        if num_users > len(self.signatures):
+            capacity = max(num_users, 2 * len(self.signatures))
+            signatures = np.full((capacity, self.num_hashes), np.iinfo(np.uint32).max, dtype=np.uint32)
+            signatures[:len(self.user_ids)] = self.signatures[:len(self.user_ids)]
+            band_hashes = np.zeros((capacity, self.bands), dtype=np.uint64)
+            band_hashes[:len(self.user_ids)] = self.band_hashes[:len(self.user_ids)]
+            self.signatures = signatures
+            self.band_hashes = band_hashes
+        for user_id in new_user_ids:
+            self.user_index[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+        return np.array([self.user_index[user_id] for user_id in user_ids], dtype=np.int64)
+
+    def add_route_users(self, route_id, user_ids):
+        """Update the signatures of users who ticked a route"""
+        user_ids = [str(user_id) for user_id in user_ids]
+        if len(user_ids) == 0:
+            return
+        route_hash = self.route_hashes([route_key(route_id)])[0]
+        with self.lock:
+            rows = self.add_users(user_ids)
+            signatures = np.minimum(self.signatures[rows], route_hash)
+            changed_rows = rows[(signatures != self.signatures[rows]).any(axis=1)]
+            self.signatures[rows] = signatures
+            self.band_hashes[changed_rows] = self.compute_band_hashes(self.signatures[changed_rows])
+            self.pending_rows.update(changed_rows.tolist())
+            if len(self.pending_rows) > max(1000, self.sorted_band_rows.shape[1] // 10):
+                self.sort_bands()
+
+    def sort_bands(self):
+        """Sort every band's hashes so candidates can be found by binary search"""
+        band_hashes = self.band_hashes[:len(self.user_ids)]
+        band_order = np.argsort(band_hashes, axis=0, kind='stable')
+        self.sorted_band_rows = band_order.T.copy()
+        self.sorted_band_hashes = np.take_along_axis(band_hashes, band_order, axis=0).T.copy()
+        self.pending_rows.clear()
+
+    def candidate_rows(self, row):
+        """Rows of users sharing at least one band hash with row"""
+        user_band_hashes = self.band_hashes[row]
+        found_rows = []
+        for band in range(self.bands):
+            sorted_hashes = self.sorted_band_hashes[band]
+            start = np.searchsorted(sorted_hashes, user_band_hashes[band], side='left')
+            end = np.searchsorted(sorted_hashes, user_band_hashes[band], side='right')
+            found_rows.append(self.sorted_band_rows[band, start:end])
+        found_rows.append(np.fromiter(self.pending_rows, dtype=np.int64, count=len(self.pending_rows)))
+        candidates = np.unique(np.concatenate(found_rows))
+        # Sorted entries for rows changed since the last sort are out of date
+        candidates = candidates[(self.band_hashes[candidates] == user_band_hashes).any(axis=1)]
+        return candidates[candidates != row]
+
+    def similar_users(self, user_id, limit):
+        """Most similar users to user_id, as user ID and estimated Jaccard similarity"""
+        with self.lock:
+            row = self.user_index.get(str(user_id))
+            if row is None:
+                return []
+            candidates = self.candidate_rows(row)
+            similarity = (self.signatures[candidates] == self.signatures[row]).mean(axis=1)
+        if len(candidates) > limit:
+            top = np.argpartition(-similarity, limit - 1)[:limit]
+            candidates, similarity = candidates[top], similarity[top]
+        order = np.lexsort((candidates, -similarity))
+        return [(self.user_ids[candidate], float(similarity[i])) for i, candidate in
+                zip(order, candidates[order])]
+
+    @classmethod
+    def build(cls, route_ticks_cached_data, num_hashes, bands):
+        """Build the index from every saved route in the cache"""
+        index = cls(num_hashes, bands)
+        route_keys = []
+        route_rows = []
+        user_ids = []
+        for route_id, route_user_ids in route_ticks_cached_data.iter_route_user_ids():
+            route_rows.extend([len(route_keys)] * len(route_user_ids))
+            route_keys.append(route_key(route_id))
+            user_ids.extend(route_user_ids)
+        logging.info("Building MinHash index from %s routes and %s route users", len(route_keys), len(user_ids))
+
+        if len(user_ids) == 0:
+            return index
+        user_rows = index.add_users(user_ids)
+        route_rows = np.array(route_rows, dtype=np.int64)
+        order = np.argsort(user_rows, kind='stable')
+        user_rows = user_rows[order]
+        route_rows = route_rows[order]
+        user_starts = np.flatnonzero(np.r_[True, user_rows[1:] != user_rows[:-1]])
+        route_hashes = index.route_hashes(route_keys)
+        for hash_i in range(num_hashes):
+            index.signatures[user_rows[user_starts], hash_i] = np.minimum.reduceat(
+                route_hashes[route_rows, hash_i], user_starts)
+        num_users = len(index.user_ids)
+        index.band_hashes[:num_users] = index.compute_band_hashes(index.signatures[:num_users])
+        index.sort_bands()
+        logging.info("Built MinHash index for %s users", num_users)
+        return index
+
+    def apply_pending(self, index_file):
+        """Add the route users in the index's pending file past what this index already has"""
+        pending_file = pending_file_for(index_file)
+        if os.path.isfile(pending_file) is False:
+            return
+        with open(pending_file, encoding='utf-8') as open_pending_file:
+            fcntl.flock(open_pending_file, fcntl.LOCK_SH)
+            open_pending_file.seek(self.pending_file_size)
+            pending_lines = open_pending_file.readlines()
+            self.pending_file_size = open_pending_file.tell()
+        for pending_line in pending_lines:
+            route_id, user_ids = json.loads(pending_line)
+            self.add_route_users(route_id, user_ids)
+        logging.info("Applied %s pending routes to the MinHash index", len(pending_lines))
+
+    def save(self, index_file):
+        """
+        Save the index, band hashes are recomputed on load.
+        Pending route users the index has are removed from the pending file, ones added since are kept.
+        """
+        with self.lock, open(pending_file_for(index_file), 'a+', encoding='utf-8') as open_pending_file:
+            fcntl.flock(open_pending_file, fcntl.LOCK_EX)
+            num_users = len(self.user_ids)
+            with open(index_file + '.tmp', 'wb') as open_index_file:
+                np.savez(open_index_file,
+                         params=np.array([self.num_hashes, self.bands, self.seed]),
+                         user_ids=np.array(self.user_ids, dtype=np.int64),
+                         signatures=self.signatures[:num_users])
+            os.replace(index_file + '.tmp', index_file)
+            open_pending_file.seek(self.pending_file_size)
+            newer_pending_lines = open_pending_file.read()
+            open_pending_file.truncate(0)
+            open_pending_file.write(newer_pending_lines)
+            self.pending_file_size = 0
+        logging.info("Saved MinHash index for %s users to %s", num_users, index_file)
+
+    @classmethod
+    def load(cls, index_file):
+        """Load an index saved with save"""
+        with np.load(index_file) as index_data:
+            num_hashes, bands, seed = (int(param) for param in np.asarray(index_data["params"]))
+            index = cls(num_hashes, bands, seed)
+            index.add_users([str(user_id) for user_id in np.asarray(index_data["user_ids"])])
+            index.signatures[:len(index.user_ids)] = index_data["signatures"]
+        num_users = len(index.user_ids)
+        index.band_hashes[:num_users] = index.compute_band_hashes(index.signatures[:num_users])
+        index.sort_bands()
+        logging.info("Loaded MinHash index for %s users from %s", num_users, index_file)
+        index.apply_pending(index_file)
+        return index
+
+
+def fold_pending(index_file=USER_INDEX_FILE, min_mb=0):
+    """Fold the index's pending file into the index file if it has at least min_mb, returns True if folded"""
+    pending_file = pending_file_for(index_file)
+    if os.path.isfile(index_file) is False or os.path.isfile(pending_file) is False or \
+       os.path.getsize(pending_file) == 0 or os.path.getsize(pending_file) < min_mb * 1024 * 1024:
+        return False
+    UserMinHashIndex.load(index_file).save(index_file)
+    return True
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ("build", "update", "query") or \
+       (sys.argv[1] == "query" and len(sys.argv) < 3):
+        print(__doc__)
+        sys.exit(2)
+
+    if os.path.isdir(LOG_DIR) is False:
+        print(LOG_DIR + " not found, logging to local logs directory")
+        os.makedirs("logs", exist_ok=True)
+        LOG_FILE = f"logs/{LOG_FILE_USER_INDEX}"
+
+    logging.basicConfig(filename=LOG_FILE, level=LOG_LEVEL, format=LOG_FORMAT)
+    logging.info("Starting user similarity index %s", sys.argv[1])
+
+    route_ticks_cache = open_route_cache(ROUTE_TICKS_CACHE_DB)
+
+    if sys.argv[1] == "build":
+        # Route users pending before the build are in the cache it reads
+        pending_file_size = os.path.getsize(pending_file_for(USER_INDEX_FILE)) \
+            if os.path.isfile(pending_file_for(USER_INDEX_FILE)) else 0
+        user_index = UserMinHashIndex.build(route_ticks_cache, MINHASH_NUM_HASHES, MINHASH_BANDS)
+        user_index.pending_file_size = pending_file_size
+        user_index.save(USER_INDEX_FILE)
+        print("Indexed", len(user_index.user_ids), "users")
+    elif os.path.isfile(USER_INDEX_FILE) is False:
+        print(USER_INDEX_FILE, "not found, run: python user_similarity_index.py build")
+        sys.exit(1)
+    elif sys.argv[1] == "update":
+        user_index = UserMinHashIndex.load(USER_INDEX_FILE)
+        user_index.save(USER_INDEX_FILE)
+        print("Indexed", len(user_index.user_ids), "users")
+    else:
+        query_limit = int(sys.argv[3]) if len(sys.argv) > 3 else SAME_ROUTE_MAX_LIMIT
+        user_index = UserMinHashIndex.load(USER_INDEX_FILE)
+        similar_users = user_index.similar_users(sys.argv[2], query_limit)
+        user_names = route_ticks_cache.user_names([user_id for user_id, _ in similar_users])
+        for similar_user_id, jaccard in similar_users:
+            print(f"{user_names.get(similar_user_id, similar_user_id)}, {similar_user_id}, {round(jaccard * 100, 1)}%")
+
+    route_ticks_cache.close()